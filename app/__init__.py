@@ -8,8 +8,17 @@ import datadog
 from ddtrace import tracer
 from flask import Flask
 from kubernetes import config
-from redis import StrictRedis
 
+from app.models.dinghy_data import (
+    configure_history,
+    configure_redis,
+    get_redis_client,
+    history_cache,
+)
+from app.utils.http_client import configure_http_pool
+from app.utils.informer import configure_informers
+from app.utils.ping_writer import configure_ping_writer
+from app.utils.stream_hub import configure_stream_hubs
 from config import Config
 
 
@@ -58,7 +67,39 @@ def create_app(config_class=Config):
     app = Flask(__name__, static_folder="templates/static")
     app.config.from_object(config_class)
     app.jinja_env.filters["tojson_pretty"] = to_pretty_json
-    app.redis = StrictRedis(host=app.config["REDIS_HOST"])
+    configure_redis(
+        max_connections=int(app.config["REDIS_MAX_CONNECTIONS"]),
+        timeout=float(app.config["REDIS_POOL_TIMEOUT"]),
+        socket_timeout=float(app.config["REDIS_SOCKET_TIMEOUT"]),
+        socket_connect_timeout=float(app.config["REDIS_SOCKET_TIMEOUT"]),
+        health_check_interval=int(app.config["REDIS_HEALTH_CHECK_INTERVAL"]),
+    )
+    app.redis = get_redis_client(app.config["REDIS_HOST"])
+    configure_history(
+        retention_seconds=int(app.config["HISTORY_RETENTION_SECONDS"]),
+        max_samples=int(app.config["HISTORY_MAX_SAMPLES"]),
+        codec=app.config["PING_STORAGE_CODEC"],
+    )
+    history_cache.configure(
+        maxsize=int(app.config["HISTORY_CACHE_SIZE"]),
+        ttl=float(app.config["HISTORY_CACHE_TTL"]),
+    )
+    configure_ping_writer(
+        enabled=app.config["WRITE_BEHIND_ENABLED"] == "True",
+        queue_size=int(app.config["WRITE_BEHIND_QUEUE_SIZE"]),
+        batch_size=int(app.config["WRITE_BEHIND_BATCH_SIZE"]),
+        flush_interval=float(app.config["WRITE_BEHIND_FLUSH_INTERVAL"]),
+        policy=app.config["WRITE_BEHIND_POLICY"],
+        block_timeout=float(app.config["WRITE_BEHIND_BLOCK_TIMEOUT"]),
+    )
+    configure_http_pool(
+        pool_connections=int(app.config["HTTP_POOL_CONNECTIONS"]),
+        pool_maxsize=int(app.config["HTTP_POOL_MAXSIZE"]),
+    )
+    configure_stream_hubs(
+        subscriber_queue_size=int(app.config["STREAM_SUBSCRIBER_QUEUE_SIZE"]),
+        overflow_policy=app.config["STREAM_OVERFLOW_POLICY"],
+    )
 
     from app.errors import bp as errors_bp
 
@@ -76,6 +117,13 @@ def create_app(config_class=Config):
         logging.info("TESTING is True, not loading k8s client")
     else:
         config.load_incluster_config()
+    configure_informers(
+        enabled=app.config["INFORMER_ENABLED"] == "True"
+        and app.config["TESTING"] != "True",
+        resync_seconds=int(app.config["INFORMER_RESYNC_SECONDS"]),
+        max_staleness=int(app.config["INFORMER_MAX_STALENESS"]),
+        sync_timeout=float(app.config["INFORMER_SYNC_TIMEOUT"]),
+    )
 
     environment = app.config["ENVIRONMENT"]
     dd_tags = [f"environment={environment}"]
@@ -0,0 +1,18 @@
+import click
+
+from app.models.dinghy_data import migrate_pings
+from app.models.ping_codec import CODECS
+
+
+def register(app):
+    @app.cli.group()
+    def pings():
+        """Ping history commands."""
+        pass
+
+    @pings.command()
+    @click.argument("codec", type=click.Choice(list(CODECS)))
+    def migrate(codec):
+        """Rewrite stored ping records with the given storage codec."""
+        migrated = migrate_pings(app.config["REDIS_HOST"], codec)
+        click.echo(f"Migrated {migrated} ping records to the {codec} codec")
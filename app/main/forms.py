@@ -1,7 +1,18 @@
 from flask_wtf import FlaskForm
-from wtforms import IntegerField, StringField, SubmitField, TextAreaField, URLField
+from wtforms import (
+    BooleanField,
+    IntegerField,
+    SelectField,
+    SelectMultipleField,
+    StringField,
+    SubmitField,
+    TextAreaField,
+    URLField,
+)
 from wtforms.validators import DataRequired, Optional
 
+from app.models.dinghy_dns import DNS_RECORD_TYPES
+
 
 class HTTPCheckForm(FlaskForm):
     """
@@ -14,6 +25,7 @@ class HTTPCheckForm(FlaskForm):
         render_kw={"placeholder": '{"Content-Type": "application/json"}'},
         validators=[Optional()],
     )
+    cold_connection = BooleanField("Cold connection (skip keep-alive pool)")
     submit = SubmitField("Ping")
 
 
@@ -46,4 +58,29 @@ class DNSCheckForm(FlaskForm):
         validators=[Optional()],
         render_kw={"placeholder": "10.96.0.10"},
     )
+    record_types = SelectMultipleField(
+        "Optional Record Types",
+        choices=[(t, t) for t in DNS_RECORD_TYPES],
+        validators=[Optional()],
+    )
     submit = SubmitField("Ping")
+
+
+class DNSCompareForm(FlaskForm):
+    """
+    Form for domain input and the nameservers to compare its answers from,
+    prefixed so its fields do not clash with DNSCheckForm's
+    """
+
+    domain = StringField(
+        "Hostname", validators=[DataRequired()], render_kw={"placeholder": "domain"}
+    )
+    nameservers = TextAreaField(
+        "Nameservers",
+        validators=[DataRequired()],
+        render_kw={"placeholder": "system, 10.96.0.10, 169.254.20.10, 8.8.8.8"},
+    )
+    record_type = SelectField(
+        "Record Type", choices=[(t, t) for t in DNS_RECORD_TYPES], default="A"
+    )
+    submit = SubmitField("Compare")
@@ -2,31 +2,132 @@ import json
 import logging
 import sys
 import traceback
+from operator import itemgetter
 
 import datadog
-from flask import current_app, jsonify, make_response, render_template, request
+from flask import (
+    current_app,
+    jsonify,
+    make_response,
+    render_template,
+    request,
+    stream_with_context,
+    url_for,
+)
 from kubernetes import client
+from kubernetes.client.rest import ApiException
 
+from app.api.errors import bad_request, error_response
 from app.main import bp
-from app.main.forms import DNSCheckForm, HTTPCheckForm, TCPCheckForm
+from app.main.forms import DNSCheckForm, DNSCompareForm, HTTPCheckForm, TCPCheckForm
+from app.models.dinghy_data import parse_history_cursor
+from app.utils.informer import informer_stats
 from app.utils.k8s import (
+    LOG_WINDOWS,
+    PodLogWindow,
     describe_pod,
     get_all_namespaces,
     get_all_pods,
-    get_deployment_logs,
+    get_deployment_pods,
     get_pod_events,
-    get_pod_logs,
+    iter_deployment_logs,
+    list_deployments,
+    sort_deployments,
+    truncated_marker,
+)
+from app.utils.log_cursor import (
+    CursorFilter,
+    CursorTracker,
+    iter_lines,
+    parse_cursor,
+    since_seconds,
 )
 from app.utils.network import (
+    bulk_dns_lookups,
     dns_check,
-    get_all_pinged_urls,
+    dns_compare,
+    get_ping_stats,
+    get_pinged_urls,
     http_check,
+    ping_domain_entries,
+    ping_domains,
     process_request,
+    resolve_names,
+    scan_tcp,
     tcp_check,
+    tcp_targets,
 )
+from app.utils.ping_writer import get_ping_writer
+from app.utils.stream_filters import EVENT_FILTER_ARGS, LOG_FILTER_ARGS, filter_query
+from app.utils.stream_hub import hub_stats
 
 from .. import default
 
+NDJSON_MIMETYPE = "application/x-ndjson"
+# starts the last line of a plain log read with a cursor
+LOG_CURSOR_LINE = "X-Log-Cursor: "
+
+
+def ndjson_response(results):
+    """Stream an iterable of JSON serializable results, one per line"""
+    lines = (json.dumps(result, default=default) + "\n" for result in results)
+    return current_app.response_class(
+        stream_with_context(lines), mimetype=NDJSON_MIMETYPE
+    )
+
+
+def stream_template(template_name, **context):
+    """Render a template as a streamed response, chunk by chunk"""
+    current_app.update_template_context(context)
+    template = current_app.jinja_env.get_template(template_name)
+    return current_app.response_class(stream_with_context(template.stream(context)))
+
+
+def log_budget(args):
+    """
+    limit_bytes (default and capped at LOGS_MAX_BYTES) and head or tail
+    window from the request args, raises ValueError on bad args
+    """
+    max_bytes = int(current_app.config["LOGS_MAX_BYTES"])
+    limit_bytes = min(max(int(args.get("limit_bytes", max_bytes)), 1), max_bytes)
+    window = args.get("window", "tail")
+    if window not in LOG_WINDOWS:
+        raise ValueError(f"window must be one of {', '.join(LOG_WINDOWS)}")
+    return limit_bytes, window
+
+
+def batch_limits(data, max_concurrency, max_timeout, default_deadline):
+    """
+    concurrency, per item timeout and deadline (seconds) of a batch request
+    body. concurrency is capped at max_concurrency and the timeout at
+    max_timeout and the deadline, so no item keeps a thread busy long after
+    the batch is answered. Raises ValueError on bad values
+    """
+    try:
+        concurrency = min(
+            int(data.get("concurrency", max_concurrency)), max_concurrency
+        )
+        timeout = float(data.get("timeout", max_timeout))
+        deadline = float(data.get("deadline", default_deadline))
+    except (TypeError, ValueError):
+        raise ValueError("concurrency, timeout and deadline must be numbers")
+    if concurrency < 1 or timeout <= 0 or deadline <= 0:
+        raise ValueError("concurrency, timeout and deadline must be more than 0")
+    return concurrency, min(timeout, max_timeout, deadline), deadline
+
+
+def compare_nameservers(text):
+    """
+    The nameservers to compare from comma or whitespace separated text,
+    raises ValueError when there are none or more than
+    DNS_COMPARE_MAX_NAMESERVERS
+    """
+    nameservers = list(dict.fromkeys(text.replace(",", " ").split()))
+    max_nameservers = int(current_app.config["DNS_COMPARE_MAX_NAMESERVERS"])
+    if not nameservers or len(nameservers) > max_nameservers:
+        raise ValueError(f"compare 1 to {max_nameservers} nameservers")
+    return nameservers
+
 
 @bp.route("/health")
 def dinghy_health():
@@ -37,31 +138,247 @@ def dinghy_health():
 
 @bp.route("/history")
 def dinghy_history():
-    """Return list of pinged history"""
-    data = {"history": get_all_pinged_urls(current_app.config["REDIS_HOST"])}
+    """
+    Return a page of pinged history, most recently checked first. Optional
+    limit (capped at HISTORY_MAX_PAGE_SIZE) and cursor query params, pass the
+    returned next_cursor to get the next page
+    """
+    max_page_size = int(current_app.config["HISTORY_MAX_PAGE_SIZE"])
+    try:
+        limit = int(request.args.get("limit", current_app.config["HISTORY_PAGE_SIZE"]))
+    except ValueError:
+        return bad_request("limit must be an integer")
+    cursor = request.args.get("cursor") or None
+    try:
+        if cursor is not None:
+            parse_history_cursor(cursor)
+    except ValueError:
+        return bad_request("cursor must be a next_cursor value from /history")
+
+    history, next_cursor = get_pinged_urls(
+        current_app.config["REDIS_HOST"], min(max(limit, 1), max_page_size), cursor
+    )
+    data = {"history": history, "next_cursor": next_cursor}
     response = make_response(jsonify(data), 200)
     return response
 
 
+@bp.route("/api/ping-writer")
+def dinghy_ping_writer_stats():
+    """
+    Return this worker's write-behind counters: pings queued, flushed to
+    Redis, dropped because the queue was full and failed to write
+    """
+    writer = get_ping_writer(current_app.config["REDIS_HOST"])
+    return jsonify(writer.stats())
+
+
+@bp.route("/api/informers")
+def dinghy_informer_stats():
+    """
+    Return this worker's Kubernetes informer caches: whether they synced,
+    object count, resourceVersion and seconds since they last heard from the
+    API server
+    """
+    return make_response(jsonify(informer_stats()), 200)
+
+
+@bp.route("/api/stream-hubs")
+def dinghy_stream_hub_stats():
+    """
+    Return this worker's websocket streaming hubs: upstream streams open and
+    started, subscribers and messages dropped for subscribers that fell behind
+    """
+    return make_response(jsonify(hub_stats()), 200)
+
+
+@bp.route("/api/ping-stats")
+def dinghy_ping_stats():
+    """
+    Return count, error rate and min/avg/p50/p95/p99/max response time (ms) for a
+    pinged url (as listed in /history) over the last window seconds
+    """
+    url = request.args.get("url")
+    if not url:
+        return bad_request("url is required")
+    try:
+        window = int(request.args.get("window", 3600))
+    except ValueError:
+        return bad_request("window must be a number of seconds")
+    if window <= 0:
+        return bad_request("window must be more than 0 seconds")
+
+    stats = get_ping_stats(current_app.config["REDIS_HOST"], url, window)
+    return jsonify(stats)
+
+
+@bp.route("/api/dns/compare")
+def dinghy_dns_compare():
+    """
+    Send the same lookup of domain to each nameserver (repeatable or comma
+    separated, system for the system resolver) concurrently and return their
+    answers, TTLs, rcodes and latencies side by side, with the majority
+    consensus, null without one, and the ones that differ from it marked
+    """
+    domain = request.args.get("domain")
+    if not domain:
+        return bad_request("domain is required")
+    try:
+        nameservers = compare_nameservers(" ".join(request.args.getlist("nameserver")))
+        results, consensus = dns_compare(
+            domain,
+            nameservers,
+            current_app.config["REDIS_HOST"],
+            record_type=request.args.get("record_type", "A").upper(),
+            timeout=float(current_app.config["DNS_TIMEOUT"]),
+        )
+    except ValueError as e:
+        return bad_request(str(e))
+
+    return jsonify(
+        domain=domain,
+        divergent=any(r["divergent"] for r in results),
+        consensus=consensus,
+        results=results,
+    )
+
+
+@bp.route("/api/dns/bulk", methods=["POST"])
+def dinghy_dns_bulk():
+    """
+    Resolve a batch of names concurrently and stream one NDJSON result per
+    lookup as it completes. Post request data example
+    {
+      "names": ["web.default.svc.cluster.local", "10.96.0.10"],
+      "record_types": ["A", "AAAA"],
+      "nameserver": "10.96.0.10",
+      "concurrency": 50,
+      "timeout": 2,
+      "deadline": 30
+    }
+
+    Every name is looked up for each of record_types, A (PTR for addresses)
+    without them. nameserver (system resolver without it), concurrency,
+    timeout (per lookup) and deadline (whole batch) are optional and default
+    to DNS_TIMEOUT and the DNS_BULK_* configs, concurrency is capped by
+    DNS_BULK_CONCURRENCY and the timeout by DNS_TIMEOUT and the deadline, see
+    batch_limits. Lookups left when the deadline passes are returned with an
+    error.
+
+    Result lines
+    {"name": "web.default.svc.cluster.local", "record_type": "A",
+     "rcode": "NOERROR", "answers": ["10.0.12.7"], "ttl": 5,
+     "latency_ms": 1.204, "tcp": false, "error": null}
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data.get("names"), list):
+        return bad_request("request body must be JSON with a list of names")
+
+    try:
+        concurrency, timeout, deadline = batch_limits(
+            data,
+            int(current_app.config["DNS_BULK_CONCURRENCY"]),
+            float(current_app.config["DNS_TIMEOUT"]),
+            float(current_app.config["DNS_BULK_DEADLINE"]),
+        )
+        lookups = bulk_dns_lookups(data["names"], data.get("record_types"))
+    except ValueError as e:
+        return bad_request(str(e))
+    max_lookups = int(current_app.config["DNS_BULK_MAX_LOOKUPS"])
+    if len(lookups) > max_lookups:
+        return bad_request(f"at most {max_lookups} names times record types")
+
+    results = resolve_names(
+        lookups,
+        data.get("nameserver") or None,
+        max_workers=concurrency,
+        timeout=timeout,
+        deadline=deadline,
+    )
+    return ndjson_response(result for _, result in results)
+
+
+@bp.route("/api/tcp/bulk", methods=["POST"])
+def dinghy_tcp_bulk():
+    """
+    Check TCP reachability of a batch of host and port pairs concurrently and
+    stream one NDJSON result per target as it finishes. Post request data
+    example
+    {
+      "targets": [
+        {"host": "web.default.svc.cluster.local", "port": 80},
+        {"host": "10.0.12.7", "port": 5432}
+      ],
+      "concurrency": 200,
+      "timeout": 5
+    }
+
+    concurrency (connects in flight) and timeout (per target, for resolving
+    the host and again for the handshake) are optional and default to the
+    TCP_BULK_* configs and are capped by them. latency_ms times the
+    handshake alone, null when the host did not resolve.
+
+    Result lines
+    {"host": "10.0.12.7", "port": 5432, "reachable": false, "resolve_ms": 0.09,
+     "latency_ms": 0.412, "error_class": "ConnectionRefusedError",
+     "error": "[Errno 111] Connect call failed ('10.0.12.7', 5432)"}
+    """
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data.get("targets"), list):
+        return bad_request("request body must be JSON with a list of targets")
+
+    max_concurrency = int(current_app.config["TCP_BULK_CONCURRENCY"])
+    max_timeout = float(current_app.config["TCP_BULK_TIMEOUT"])
+    try:
+        concurrency = min(
+            int(data.get("concurrency", max_concurrency)), max_concurrency
+        )
+        timeout = min(float(data.get("timeout", max_timeout)), max_timeout)
+    except (TypeError, ValueError):
+        return bad_request("concurrency and timeout must be numbers")
+    if concurrency < 1 or timeout <= 0:
+        return bad_request("concurrency and timeout must be more than 0")
+
+    try:
+        targets = tcp_targets(data["targets"])
+    except ValueError as e:
+        return bad_request(str(e))
+    max_targets = int(current_app.config["TCP_BULK_MAX_TARGETS"])
+    if len(targets) > max_targets:
+        return bad_request(f"at most {max_targets} targets")
+
+    results = scan_tcp(targets, max_in_flight=concurrency, timeout=timeout)
+    return ndjson_response(result for _, result in results)
+
+
 @bp.route("/", methods=["GET", "POST"])
 @datadog.statsd.timed(metric="dinghy_ping_events_home_page_load_time.timer")
 def dinghy_html():
     """Index route to Dinghy-ping input html form"""
     http_form = HTTPCheckForm()
     dns_form = DNSCheckForm()
+    dns_compare_form = DNSCompareForm(prefix="compare")
     tcp_form = TCPCheckForm()
-    urls = get_all_pinged_urls(current_app.config["REDIS_HOST"])
+    redis_host = current_app.config["REDIS_HOST"]
+    page_size = int(current_app.config["HISTORY_PAGE_SIZE"])
+
+    def recent_pinged_urls():
+        # Only called by templates that show the history
+        urls, _ = get_pinged_urls(redis_host, page_size)
+        return urls
 
     if http_form.validate_on_submit():
         url = http_form.url.data
         headers = http_form.headers.data
+        cold = http_form.cold_connection.data
         (
             response_code,
             response_text,
             response_time_ms,
             response_headers,
             request_url,
-        ) = http_check(url, headers, current_app.config["REDIS_HOST"])
+            response_trace,
+        ) = http_check(url, headers, current_app.config["REDIS_HOST"], cold=cold)
         return render_template(
             "ping_response.html",
             request=request_url,
@@ -69,24 +386,52 @@ def dinghy_html():
             domain_response_text=response_text,
             domain_response_headers=response_headers,
             domain_response_time_ms=response_time_ms,
+            domain_response_trace=response_trace,
         )
 
     if dns_form.validate_on_submit():
         domain = dns_form.domain.data
         nameserver = dns_form.nameserver.data
 
-        dns_info_A, dns_info_NS, dns_info_MX = dns_check(
-            domain, nameserver, current_app.config["REDIS_HOST"]
+        dns_results = dns_check(
+            domain,
+            nameserver,
+            current_app.config["REDIS_HOST"],
+            record_types=dns_form.record_types.data,
+            timeout=float(current_app.config["DNS_TIMEOUT"]),
         )
 
         return render_template(
             "dns_info.html",
             domain=domain,
-            dns_info_A=dns_info_A,
-            dns_info_NS=dns_info_NS,
-            dns_info_MX=dns_info_MX,
+            nameserver=nameserver,
+            dns_results=dns_results,
         )
 
+    if dns_compare_form.validate_on_submit():
+        domain = dns_compare_form.domain.data
+        try:
+            nameservers = compare_nameservers(dns_compare_form.nameservers.data)
+        except ValueError as e:
+            # shown on the form again, with its validation errors
+            dns_compare_form.nameservers.errors.append(str(e))
+        else:
+            dns_results, consensus = dns_compare(
+                domain,
+                nameservers,
+                current_app.config["REDIS_HOST"],
+                record_type=dns_compare_form.record_type.data,
+                timeout=float(current_app.config["DNS_TIMEOUT"]),
+            )
+
+            return render_template(
+                "dns_compare.html",
+                domain=domain,
+                record_type=dns_compare_form.record_type.data,
+                dns_results=dns_results,
+                consensus=consensus,
+            )
+
     if tcp_form.validate_on_submit():
         tcp_endpoint = tcp_form.tcp_endpoint.data
         tcp_port = tcp_form.tcp_port.data
@@ -102,15 +447,16 @@ def dinghy_html():
         "index.html",
         http_form=http_form,
         dns_form=dns_form,
+        dns_compare_form=dns_compare_form,
         tcp_form=tcp_form,
-        get_all_pinged_urls=urls,
+        get_all_pinged_urls=recent_pinged_urls,
     )
 
 
 @bp.route("/ping/domains", methods=["POST"])
 def ping_multiple_domains():
     """
-    Async process to test multiple domains and return JSON with results
+    Concurrently test multiple domains and return JSON with results
     Post request data example
     {
       "domains": [
@@ -123,64 +469,99 @@ def ping_multiple_domains():
           "protocol": "https",
           "domain": "microsoft.com"
         }
-      ]
+      ],
+      "concurrency": 10,
+      "timeout": 5,
+      "deadline": 30,
+      "cold": false,
+      "stream": false
     }
 
+    concurrency, timeout (per domain) and deadline (whole batch) are optional
+    and default to the PING_DOMAINS_* configs, concurrency and timeout are
+    capped by PING_DOMAINS_CONCURRENCY and PING_DOMAINS_TIMEOUT, the timeout
+    by the deadline too. At most PING_DOMAINS_MAX domains. With "stream": true or an
+    "Accept: application/x-ndjson" header each result is sent as one NDJSON
+    line as soon as that domain finishes. "cold": true skips the pooled
+    keep-alive connections so every check pays for its own handshake, cold
+    and stream must be JSON booleans.
+
     Return results
     {
-      "domains": [
+      "domains_response_results": [
         {
           "protocol": "https",
           "domain": "google.com",
           "domain_response_code": "200",
-          "domain_response_time_ms": "30.0ms"
-          "
+          "domain_response_time_ms": "30.0ms",
+          "domain_response_trace": {
+            "cold_connection": false,
+            "connection_reused": true,
+            "dns_ms": 0.0,
+            "connect_ms": 0.0,
+            "tls_ms": 0.0,
+            "ttfb_ms": 28.1,
+            "transfer_ms": 1.9,
+            "total_ms": 30.2
+          },
+          "error": null
         },
         {
           "protocol": "https",
           "domain": "microsoft.com"
           "domain_response_code": "200",
-          "domain_response_time_ms": "200.1ms"
+          "domain_response_time_ms": "200.1ms",
+          "domain_response_trace": {
+            "cold_connection": false,
+            "connection_reused": false,
+            "dns_ms": 2.1,
+            "connect_ms": 20.4,
+            "tls_ms": 61.5,
+            "ttfb_ms": 110.3,
+            "transfer_ms": 5.8,
+            "total_ms": 200.1
+          },
+          "error": null
         }
       ]
     }
     """
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data.get("domains"), list):
+        return bad_request("request body must be JSON with a list of domains")
 
-    results = []
-
-    def build_domain_results(protocol, request_domain, results, headers):
-        (
-            response_code,
-            response_text,
-            response_time_ms,
-            response_headers,
-        ) = process_request(
-            protocol,
-            request_domain,
-            request.args,
-            headers,
-            current_app.config["REDIS_HOST"],
-        )
-        results.append(
-            {
-                "protocol": protocol,
-                "domain": request_domain,
-                "domain_response_code": response_code,
-                "domain_response_headers": response_headers,
-                "domain_response_time_ms": response_time_ms,
-            }
+    try:
+        domains = ping_domain_entries(data["domains"])
+        concurrency, timeout, deadline = batch_limits(
+            data,
+            int(current_app.config["PING_DOMAINS_CONCURRENCY"]),
+            float(current_app.config["PING_DOMAINS_TIMEOUT"]),
+            float(current_app.config["PING_DOMAINS_DEADLINE"]),
         )
+    except ValueError as e:
+        return bad_request(str(e))
+    max_domains = int(current_app.config["PING_DOMAINS_MAX"])
+    if len(domains) > max_domains:
+        return bad_request(f"at most {max_domains} domains")
+    cold, stream = data.get("cold", False), data.get("stream", False)
+    if not isinstance(cold, bool) or not isinstance(stream, bool):
+        return bad_request("cold and stream must be true or false")
+
+    results = ping_domains(
+        domains,
+        request.args,
+        current_app.config["REDIS_HOST"],
+        max_workers=concurrency,
+        timeout=timeout,
+        deadline=deadline,
+        cold=cold,
+    )
 
-    def gather_results(data):
-        for domain in data["domains"]:
-            protocol = domain["protocol"]
-            request_domain = domain["domain"]
-            headers = domain["headers"]
-            build_domain_results(protocol, request_domain, results, headers)
-
-    resp = {"domains_response_results": results, "wait": gather_results(request.data)}
+    if stream or request.accept_mimetypes.best == NDJSON_MIMETYPE:
+        return ndjson_response(result for _, result in results)
 
-    return jsonify(resp)
+    ordered = [result for _, result in sorted(results, key=itemgetter(0))]
+    return jsonify({"domains_response_results": ordered})
 
 
 @bp.route("/ping/<protocol>/<path:domain>")
@@ -191,7 +572,13 @@ def domain_response_html(*, protocol, domain):
     """
 
     headers = {}
-    response_code, response_text, response_time_ms, response_headers = process_request(
+    (
+        response_code,
+        response_text,
+        response_time_ms,
+        response_headers,
+        response_trace,
+    ) = process_request(
         protocol, domain, request.args, headers, current_app.config["REDIS_HOST"]
     )
 
@@ -202,6 +589,7 @@ def domain_response_html(*, protocol, domain):
         domain_response_text=response_text,
         domain_response_headers=response_headers,
         domain_response_time_ms=response_time_ms,
+        domain_response_trace=response_trace,
     )
 
     return resp
@@ -216,33 +604,11 @@ def dinghy_get_deployment_details():
         "tail_lines", current_app.config["TAIL_LINES_DEFAULT"]
     )
     name = request.args.get("name")
-    k8s_client = client.AppsV1Api()
-    deployment = k8s_client.read_namespaced_deployment(name, namespace)
-
-    # Find replica set
-    replica_set_result = k8s_client.list_namespaced_replica_set(namespace)
+    deployment = client.AppsV1Api().read_namespaced_deployment(name, namespace)
 
     all_pods = {}
-    replica_sets = []
-    for rs in replica_set_result.items:
-        if not bool(rs.status.replicas):
-            continue
-        deployment_ref = None
-        for reference in rs.metadata.owner_references:
-            if deployment.metadata.uid == reference.uid:
-                deployment_ref = reference
-                break
-        rs_is_ready = rs.status.available_replicas == rs.status.ready_replicas
-        if deployment_ref is not None and rs_is_ready:
-            replica_sets.append(rs)
-
     try:
-        pod_list = client.CoreV1Api().list_namespaced_pod(namespace, watch=False)
-        for pod in pod_list.items:
-            if pod.metadata.name.startswith(name):
-                for rs in replica_sets:
-                    if pod.metadata.name.startswith(rs.metadata.name):
-                        all_pods[pod.metadata.name] = pod.to_dict()
+        all_pods = get_deployment_pods(deployment)
     except Exception:
         logging.exception("List pods error")
 
@@ -256,44 +622,77 @@ def dinghy_get_deployment_details():
     return resp
 
 
+def deployments_page(args):
+    """
+    Filter, sort and slice the deployment list for the request args: namespace,
+    workloads, filter, sort, order, limit (capped at DEPLOYMENTS_MAX_PAGE_SIZE)
+    and offset. Raises ValueError on bad args, or when the list keeps expiring
+    """
+    limit = int(args.get("limit", current_app.config["DEPLOYMENTS_PAGE_SIZE"]))
+    limit = min(max(limit, 1), int(current_app.config["DEPLOYMENTS_MAX_PAGE_SIZE"]))
+    offset = max(int(args.get("offset", 0)), 0)
+    sort = args.get("sort", "namespace")
+    order = args.get("order", "asc")
+
+    try:
+        deployments = list_deployments(
+            namespace=args.get("namespace"),
+            workloads_only=bool(args.get("workloads", False)),
+            name_filter=args.get("filter"),
+        )
+    except ApiException as e:
+        if e.status != 410:
+            raise
+        raise ValueError("deployments changed faster than they could be listed")
+    deployments = sort_deployments(deployments, sort, order)
+    end = offset + limit
+    return {
+        "deployments": deployments[offset:end],
+        "total": len(deployments),
+        "offset": offset,
+        "limit": limit,
+        "sort": sort,
+        "order": order,
+    }
+
+
+@bp.route("/api/deployments")
+@datadog.statsd.timed(metric="dinghy_ping_events_api_deployment_list.timer")
+def dinghy_api_deployments():
+    """
+    Return a page of deployments, optional namespace, workloads and filter
+    query params as for /get/deployments, sort by name, namespace, revision,
+    date or ready, order asc or desc, limit and offset
+    """
+    try:
+        page = deployments_page(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    return make_response(jsonify(page), 200)
+
+
 @bp.route("/get/deployments")
 @datadog.statsd.timed(metric="dinghy_ping_events_render_deployment_list.timer")
 def dinghy_get_deployments():
-    """List deployments on the cluster"""
-    namespace = request.args.get("namespace")
-    workloads_only = bool(request.args.get("workloads", False))
-    name_filter = request.args.get("filter")
-
-    if namespace is None:
-        namespaces = get_all_namespaces()
-    else:
-        namespaces = [namespace]
-
-    deployments = []
-    k8s_client = client.AppsV1Api()
-
-    for namespace in namespaces:
-        ret = k8s_client.list_namespaced_deployment(namespace)
-        for i in ret.items:
-            deployment = i.metadata.name
-            if name_filter is not None and name_filter not in deployment:
-                continue
-            if workloads_only and namespace.startswith("kube"):
-                continue
-            if workloads_only and namespace.startswith("docker"):
-                continue
-            namespace = i.metadata.namespace
-            deployments.append(
-                {
-                    "name": deployment,
-                    "namespace": namespace,
-                    "revision": i.metadata.generation,
-                    "date": i.metadata.creation_timestamp,
-                    "status": i.status,
-                }
-            )
+    """List deployments on the cluster, a page at a time"""
+    try:
+        page = deployments_page(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    args = request.args.to_dict()
+    prev_url = next_url = None
+    if page["offset"] > 0:
+        args["offset"] = max(page["offset"] - page["limit"], 0)
+        prev_url = url_for("main.dinghy_get_deployments", **args)
+    if page["offset"] + page["limit"] < page["total"]:
+        args["offset"] = page["offset"] + page["limit"]
+        next_url = url_for("main.dinghy_get_deployments", **args)
 
-    resp = render_template("deployments_tabbed.html", deployments=deployments)
+    resp = render_template(
+        "deployments_tabbed.html", prev_url=prev_url, next_url=next_url, **page
+    )
 
     return resp
 
@@ -367,29 +766,91 @@ def dinghy_get_pod_details():
 @bp.route("/input-pod-logs")
 @datadog.statsd.timed(metric="dinghy_ping_events_display_pod_logs.timer")
 def form_input_pod_logs():
-    """List pods in namespace and click on one to display logs"""
+    """
+    Display a pod's logs, streamed from the API server in chunks so large
+    tail_lines do not sit in memory, plain for text/plain instead of html.
+    Optional limit_bytes and head or tail window, see log_budget. With a
+    cursor query param, empty for a first read, the response ends with
+    (an X-Log-Cursor: line when plain) a cursor to pass back for only the
+    lines logged since, the window is cut from those lines
+    """
     pod = request.args.get("pod")
     namespace = request.args.get("namespace", "default")
     tail_lines = request.args.get(
         "tail_lines", current_app.config["TAIL_LINES_DEFAULT"]
     )
     container = request.args.get("container", "")
+    cursor = request.args.get("cursor")
     logging.debug(f"Retrieving pods... {pod} in namespace {namespace}")
     logging.debug(f"Retrieving container logs... {container} in pod {pod}")
 
     try:
-        ret = get_pod_logs(pod, namespace, container, tail_lines)
-        resp = render_template("pod_logs_output.html", logs=ret)
+        limit_bytes, window = log_budget(request.args)
+        cursor_filter = CursorFilter(cursor) if cursor else None
+    except ValueError as e:
+        return bad_request(str(e))
 
-        return resp
-    except Exception:
-        traceback.print_exc(file=sys.stdout)
+    since = None
+    if cursor_filter is not None:
+        # everything since the cursor, not the last tail_lines
+        tail_lines = None
+        since = since_seconds(parse_cursor(cursor)[0])
+
+    try:
+        window_logs = PodLogWindow(
+            pod,
+            namespace,
+            container,
+            tail_lines,
+            limit_bytes,
+            window,
+            timestamps=cursor is not None,
+            since_seconds=since,
+            accept=cursor_filter,
+        )
+    except ApiException as e:
+        logging.error(f"Exception when calling CoreV1Api->read_namespaced_pod_log: {e}")
+        return error_response(e.status or 500, e.reason)
+
+    tracker = CursorTracker(cursor or None)
+
+    def logs():
+        if cursor is None:
+            yield from window_logs
+        else:
+            yield from tracker.strip(iter_lines(window_logs))
+        if window_logs.truncated:
+            yield truncated_marker(pod, limit_bytes, window)
+
+    def resume_url():
+        """The url of the lines logged after this response, once it is sent"""
+        if cursor is None or tracker.cursor is None:
+            return None
+        args = request.args.to_dict(flat=False)
+        args["cursor"] = tracker.cursor
+        return url_for(".form_input_pod_logs", **args)
+
+    def plain_logs():
+        yield from logs()
+        # only known once the lines are read, too late for a header
+        if tracker.cursor:
+            yield f"{LOG_CURSOR_LINE}{tracker.cursor}\n"
+
+    if "plain" in request.args:
+        return current_app.response_class(
+            stream_with_context(plain_logs()), mimetype="text/plain"
+        )
+
+    return stream_template("pod_logs_output.html", logs=logs(), resume_url=resume_url)
 
 
 @bp.route("/input-pod-logs-stream")
 @datadog.statsd.timed(metric="dinghy_ping_events_display_pod_logs_stream.timer")
 def form_input_pod_logs_stream(*, tail_lines=None):
-    """List pods in namespace and click on one to display logs"""
+    """
+    List pods in namespace and click on one to display logs, include,
+    exclude, regex, level and sample query params filter the lines sent
+    """
     tail_lines = tail_lines or current_app.config["TAIL_LINES_DEFAULT"]
     pod = request.args["pod"]
     namespace = request.args["namespace"]
@@ -400,6 +861,7 @@ def form_input_pod_logs_stream(*, tail_lines=None):
         namespace=namespace,
         name=pod,
         container=container,
+        filter_query=filter_query(request.args, LOG_FILTER_ARGS),
         dinghy_ping_web_socket_host=current_app.config["DINGHY_PING_WEB_SOCKET_HOST"],
     )
 
@@ -410,7 +872,8 @@ def form_input_pod_logs_stream(*, tail_lines=None):
 @datadog.statsd.timed(metric="dinghy_ping_events_display_namespace_events_stream.timer")
 def namespace_event_stream(namespace, filter):
     """Render page with streaming events in namespace,
-    default to just Pod events, optional all events"""
+    default to just Pod events, optional all events,
+    type and reason query params filter the events sent"""
 
     logging.info(f"filter: {filter}")
 
@@ -418,6 +881,7 @@ def namespace_event_stream(namespace, filter):
         "events_output_streaming.html",
         namespace=namespace,
         filter=filter,
+        filter_query=filter_query(request.args, EVENT_FILTER_ARGS),
         dinghy_ping_web_socket_host=current_app.config["DINGHY_PING_WEB_SOCKET_HOST"],
     )
 
@@ -457,19 +921,48 @@ def dinghy_pod_events(*, namespace, pod):
 
 
 @bp.route("/deployment-logs/<namespace>/<name>")
-def dinghy_deployment_logs(*, namespace, name, tail_lines, preview):
-    """Get pod logs for a given deployment"""
-    logs = get_deployment_logs(
-        namespace, name, current_app.config["TAIL_LINES_DEFAULT"]
+def dinghy_deployment_logs(*, namespace, name):
+    """
+    Get pod logs for a given deployment. Optional tail_lines, limit_bytes and
+    head or tail window as for /input-pod-logs, shared between the pods, merge
+    to interleave the pods' lines by timestamp, stream for a chunked text/plain
+    response and json, with preview for only the head preview (default 1000)
+    bytes
+    """
+    try:
+        tail_lines = int(
+            request.args.get("tail_lines", current_app.config["TAIL_LINES_DEFAULT"])
+        )
+        limit_bytes, window = log_budget(request.args)
+    except ValueError as e:
+        return bad_request(str(e))
+
+    is_json = "json" in request.args.keys()
+    if is_json and "preview" in request.args.keys():
+        preview = request.args.get("preview", default=1000, type=int)
+        limit_bytes, window = min(max(preview, 1), limit_bytes), "head"
+
+    truncated = []
+    logs = iter_deployment_logs(
+        namespace,
+        name,
+        tail_lines,
+        limit_bytes,
+        window,
+        max_workers=int(current_app.config["DEPLOYMENT_LOGS_CONCURRENCY"]),
+        merge="merge" in request.args,
+        truncated=truncated,
     )
-    logs_preview = logs[0:preview]
 
-    if "json" in request.args.keys():
-        if "preview" in request.args.keys():
-            resp = jsonify({"logs": logs_preview})
-        else:
-            resp = jsonify({"logs": logs})
-    else:
-        resp = render_template("pod_logs_output.html", logs=logs)
+    if "stream" in request.args:
+        return current_app.response_class(
+            stream_with_context(logs), mimetype="text/plain"
+        )
+
+    if not is_json:
+        return stream_template("pod_logs_output.html", logs=logs)
+
+    logs = "".join(logs)
+    resp = jsonify({"logs": logs, "truncated": truncated})
 
     return resp
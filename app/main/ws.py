@@ -1,53 +1,116 @@
 import json
 import logging
+import uuid
 
 import datadog
 from flask import current_app, request
 from flask_sock import Sock
-from kubernetes import client, watch
-from kubernetes.client.rest import ApiException
-
-from .. import default
+from simple_websocket import ConnectionClosed
+
+from app.utils.k8s import follow_pod_log, watch_namespace_events
+from app.utils.log_cursor import (
+    CursorFilter,
+    CursorTracker,
+    parse_cursor,
+    since_seconds,
+    split_timestamp,
+)
+from app.utils.stream_filters import EventFilter, LogFilter
+from app.utils.stream_hub import END, get_hub
 
 sock = Sock()
 
+# how often an idle viewer checks that its websocket is still open
+SUBSCRIPTION_POLL_SECONDS = 1
+
+
+def log_stream_key(namespace, name, container, tail_lines, cursor=None):
+    """
+    Hub key of a pod log stream. Viewers joining a running stream are
+    replayed only its last tail_lines lines, so a viewer resuming from a
+    cursor gets a stream of its own, following from the cursor's second
+    """
+    if not cursor:
+        return (namespace, name, container, tail_lines, None, None)
+    since = since_seconds(parse_cursor(cursor)[0])
+    return (namespace, name, container, tail_lines, since, uuid.uuid4().hex)
+
+
+def send_subscription(ws, hub, key, accept=None, coalesce=False, render="".join):
+    """
+    Relay a hub subscription to the websocket until the upstream ends, the
+    client goes away or, with the disconnect overflow policy, falls too far
+    behind, then drop the subscription. accept filters the messages sent,
+    render turns a frame of messages into the text sent. With coalesce
+    messages are joined into frames of up to STREAM_FRAME_MAX_BYTES or
+    STREAM_FRAME_WINDOW_MS
+    """
+    max_bytes = int(current_app.config["STREAM_FRAME_MAX_BYTES"])
+    window = int(current_app.config["STREAM_FRAME_WINDOW_MS"]) / 1000
+    subscription = hub.subscribe(key, accept)
+    try:
+        while ws.connected and not subscription.overflowed:
+            if coalesce:
+                frame = subscription.get_frame(
+                    max_bytes, window, timeout=SUBSCRIPTION_POLL_SECONDS
+                )
+            else:
+                message = subscription.get(timeout=SUBSCRIPTION_POLL_SECONDS)
+                frame = [] if message is None else [message]
+            ended = bool(frame) and frame[-1] is END
+            if ended:
+                frame.pop()
+            if frame:
+                ws.send(render(frame))
+                subscription.sent(len(frame))
+            if ended:
+                break
+        if subscription.overflowed:
+            hub.count("disconnected")
+            ws.close(message="Too far behind, reconnect to catch up")
+    except ConnectionClosed:
+        pass
+    finally:
+        hub.unsubscribe(subscription)
+
 
 @sock.route("/ws/logstream")
 @datadog.statsd.timed(metric="dinghy_ping_events_web_socket_duration.timer")
 def log_stream_websocket(ws):
-    k8s_client = client.CoreV1Api()
-
     name = request.args["name"]
     namespace = request.args["namespace"]
     container = request.args["container"]
+    tail_lines = int(current_app.config["TAIL_LINES_DEFAULT"])
 
+    cursor = request.args.get("cursor")
     try:
-        resp = k8s_client.read_namespaced_pod_log(
-            name,
-            namespace,
-            container=container,
-            tail_lines=current_app.config["TAIL_LINES_DEFAULT"],
-            follow=True,
-            _preload_content=False,
-        )
-    except ApiException as e:
-        if e.status == 404:
-            ws.send("Pod not found")
-            ws.close()
-
-    while True:
-        try:
-            line = resp.readline()
-        except Exception as e:
-            logging.error(
-                f"""
-                issue reading pod logs: {e}
-            """
-            )
-            break
-        if not line:
-            break
-        ws.send(line.decode("utf-8"))
+        log_filter = LogFilter.from_args(request.args)
+        cursor_filter = CursorFilter(cursor) if cursor else None
+    except ValueError as e:
+        ws.close(message=str(e))
+        return
+
+    def accept(line):
+        if cursor_filter is not None and not cursor_filter(line):
+            return False
+        return log_filter(split_timestamp(line)[1])
+
+    # frames carry the lines without timestamps and the cursor to resume from
+    tracker = CursorTracker(cursor)
+
+    def render(frame):
+        lines = "".join(tracker.strip(frame))
+        return json.dumps({"lines": lines, "cursor": tracker.cursor})
+
+    hub = get_hub("logs", follow_pod_log, replay_size=tail_lines)
+    send_subscription(
+        ws,
+        hub,
+        log_stream_key(namespace, name, container, tail_lines, cursor),
+        accept,
+        coalesce=True,
+        render=render,
+    )
 
     ws.close()
 
@@ -66,16 +129,14 @@ def event_stream_websocket(ws):
         logging.info("event-stream filter is defaulting to all events")
         field_selector = ""
 
-    v1 = client.CoreV1Api()
-    w = watch.Watch()
-
-    for event in w.stream(
-        v1.list_namespaced_event, namespace, field_selector=field_selector
-    ):
-        obj = event["object"]
-        event_resp = dict(Name=obj.metadata.name, Message=obj.message)
-
-        event_resp_json_dump = json.dumps(event_resp, default=default)
-        ws.send(event_resp_json_dump)
+    # viewers joining a running watch are replayed the most recent events
+    hub = get_hub(
+        "events",
+        watch_namespace_events,
+        replay_size=int(current_app.config["EVENT_REPLAY_SIZE"]),
+    )
+    send_subscription(
+        ws, hub, (namespace, field_selector), EventFilter.from_args(request.args)
+    )
 
     ws.close()
@@ -1,12 +1,109 @@
-import json
+import itertools
+import math
+import threading
+import time
 
 import redis
 
+from app.models.ping_codec import CODECS, get_codec
+from app.utils.cache import TTLCache
+from app.utils.stats import summarize_samples
+
+# Bounded per process pool settings, see configure_redis
+_pool_settings = {
+    "max_connections": 20,
+    "timeout": 5,
+    "socket_timeout": 5,
+    "socket_connect_timeout": 5,
+    "health_check_interval": 30,
+}
+_pools = {}
+_pools_lock = threading.Lock()
+
+# Number of keys fetched per pipelined round-trip when reading many records
+READ_BATCH_SIZE = 500
+
+# Sorted set of pinged urls scored by their last check time
+INDEX_KEY = "ping:index"
+# Set once the url:* keys written before the index existed have been indexed
+INDEX_MIGRATED_KEY = "ping:index:migrated"
+
+# Per url stream of check samples, capped at max_samples entries
+SAMPLES_KEY_PREFIX = "ping:samples:"
+
+# Pings not checked again within the retention window are evicted, 0 keeps
+# them forever
+_history_settings = {
+    "retention_seconds": 7 * 24 * 60 * 60,
+    "max_samples": 1000,
+    "codec": get_codec("json"),
+}
+
+# Per process cache of history pages, cleared whenever this process saves pings
+history_cache = TTLCache("history")
+
+
+def configure_redis(
+    max_connections,
+    timeout,
+    socket_timeout,
+    socket_connect_timeout,
+    health_check_interval,
+):
+    """Set the limits used when a process builds its shared Redis pool"""
+    _pool_settings.update(
+        max_connections=max_connections,
+        timeout=timeout,
+        socket_timeout=socket_timeout,
+        socket_connect_timeout=socket_connect_timeout,
+        health_check_interval=health_check_interval,
+    )
+    _pools.clear()
+
+
+def configure_history(retention_seconds, max_samples, codec):
+    """
+    Set how long pinged urls are kept, how many samples each keeps and the
+    storage codec of their latest result, see app.models.ping_codec
+    """
+    _history_settings.update(
+        retention_seconds=retention_seconds,
+        max_samples=max_samples,
+        codec=get_codec(codec),
+    )
+
+
+def _format_ping(value):
+    if value["response_code"] and value["response_time_ms"]:
+        return f'code: {value["response_code"]} response time: {value["response_time_ms"]}ms'  # noqa
+    return ""
+
+
+def get_redis_client(redis_host):
+    """
+    Redis client backed by one bounded connection pool per host, shared by every
+    caller in the process. Callers wait up to "timeout" seconds for a free
+    connection once max_connections are in use. redis-py resets the pool after
+    a fork so gunicorn workers do not share sockets with the master
+    """
+    pool = _pools.get(redis_host)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(redis_host)
+            if pool is None:
+                pool = redis.BlockingConnectionPool(host=redis_host, **_pool_settings)
+                _pools[redis_host] = pool
+    return redis.StrictRedis(connection_pool=pool)
+
 
 class DinghyData:
     """
-    The Dinghy Ping Redis data interface,
-    requires https://oss.redislabs.com/rejson/ ReJSON Redis module
+    The Dinghy Ping Redis data interface. The latest result per url is stored
+    with the configured codec, the default json codec requires
+    https://oss.redislabs.com/rejson/ ReJSON Redis module, hash runs on stock
+    Redis. Besides the latest result per url, every check is appended to a capped
+    per url sample stream used for latency percentiles and error rates,
+    error marks failed checks and http responses with a 4xx/5xx status
     """
 
     def __init__(
@@ -15,60 +112,283 @@ class DinghyData:
         domain_response_code=None,
         domain_response_time_ms=None,
         request_url=None,
+        timings=None,
+        error=False,
     ):
         self.redis_host = redis_host
         self.domain_response_code = domain_response_code
         self.domain_response_time_ms = domain_response_time_ms
         self.request_url = request_url
+        self.timings = timings
+        self.error = error
+        self.checked_at = time.time()
+        self.redis = get_redis_client(redis_host)
+
+    def _write(self, pipe):
+        key = f"url:{self.request_url}"
+        _history_settings["codec"].write(
+            pipe,
+            key,
+            {
+                "response_time_ms": self.domain_response_time_ms,
+                "response_code": self.domain_response_code,
+                "timings": self.timings,
+            },
+        )
+        pipe.zadd(INDEX_KEY, {self.request_url: self.checked_at})
+
+        samples_key = f"{SAMPLES_KEY_PREFIX}{self.request_url}"
+        response_time_ms = self.domain_response_time_ms
+        if not isinstance(response_time_ms, (int, float)):
+            # tcp and dns checks, and failed http checks, have no response time
+            response_time_ms = ""
+        pipe.xadd(
+            samples_key,
+            {"t": response_time_ms, "e": int(self.error)},
+            maxlen=_history_settings["max_samples"],
+            approximate=True,
+        )
+
+        if _history_settings["retention_seconds"]:
+            pipe.expire(key, _history_settings["retention_seconds"])
+            pipe.expire(samples_key, _history_settings["retention_seconds"])
 
     def save_ping(self):
-        """Save ping time (ms) and code to request_url object"""
-        r = redis.StrictRedis(host=self.redis_host)
+        """Save ping time (ms), code and phase timings to request_url object"""
+        return self.save_pings(self.redis_host, [self])
+
+    @staticmethod
+    def save_pings(redis_host, pings):
+        """
+        Save several DinghyData pings in one pipelined round-trip, returns False
+        if Redis could not be reached or rejected the writes
+        """
+        r = get_redis_client(redis_host)
         try:
-            r.execute_command(
-                "JSON.SET",
-                f"url:{self.request_url}",
-                ".",
-                json.dumps(
-                    {
-                        "response_time_ms": self.domain_response_time_ms,
-                        "response_code": self.domain_response_code,
-                    }
-                ),
-            )
+            with r.pipeline(transaction=False) as pipe:
+                for ping in pings:
+                    ping._write(pipe)
+                if _history_settings["retention_seconds"]:
+                    # url keys expire on their own, drop their index entries too
+                    pipe.zremrangebyscore(
+                        INDEX_KEY, "-inf", f"({_oldest_retained_score()}"
+                    )
+                pipe.execute()
         except redis.exceptions.ConnectionError as err:
             print(f"Connection Error to Redis: {err}")
-        except redis.exceptions.ResponseError as err:
-            print(f"Redis ResponseError: {err}")
+            return False
+        except redis.exceptions.RedisError as err:
+            print(f"Redis error: {err!r}")
+            return False
+
+        # record_ping clears it too, this drops pages cached while the pings
+        # sat in the write-behind queue
+        history_cache.clear()
+        return True
 
     def get_ping(self):
         """Get ping results for request_url object"""
-        r = redis.StrictRedis(host=self.redis_host)
+        results = None
         try:
-            results = json.loads(r.execute_command("JSON.GET", self.request_url))
-        except results.ResponseError as err:
-            print(f"ResponseError: {err}")
+            results = _history_settings["codec"].read(
+                self.redis, f"url:{self.request_url}"
+            )
+        except redis.exceptions.ConnectionError as err:
+            print(f"Connection Error to Redis: {err}")
+        except redis.exceptions.RedisError as err:
+            print(f"Redis error: {err!r}")
 
         return results
 
+    def get_ping_stats(self, window_seconds):
+        """
+        Summarize the request_url samples checked within the last window_seconds:
+        count, error rate and min/avg/p50/p95/p99/max response time (ms)
+        """
+        samples = []
+        since_ms = int((time.time() - window_seconds) * 1000)
+
+        try:
+            entries = self.redis.xrange(
+                f"{SAMPLES_KEY_PREFIX}{self.request_url}", min=since_ms, max="+"
+            )
+            for _, fields in entries:
+                response_time_ms = fields.get(b"t")
+                samples.append(
+                    (
+                        float(response_time_ms) if response_time_ms else None,
+                        fields.get(b"e") == b"1",
+                    )
+                )
+        except redis.exceptions.ConnectionError as err:
+            print(f"Connection Error to Redis: {err}")
+        except redis.exceptions.RedisError as err:
+            print(f"Redis error: {err!r}")
+
+        stats = summarize_samples(samples)
+        stats.update(url=self.request_url, window_seconds=window_seconds)
+        return stats
+
+    def get_pinged_urls(self, limit, cursor=None):
+        """
+        Get up to limit ping results, most recently checked first, starting
+        after cursor. Returns the results and the cursor of the next page,
+        None when there are no more results. Pages are served from the
+        history_cache for up to its ttl, reads that hit a Redis error are not
+        cached
+        """
+        try:
+            return history_cache.get_or_load(
+                (self.redis_host, limit, cursor),
+                lambda: self._get_pinged_urls(limit, cursor),
+            )
+        except redis.exceptions.ConnectionError as err:
+            print(f"Connection Error to Redis: {err}")
+        except redis.exceptions.RedisError as err:
+            print(f"Redis error: {err!r}")
+
+        # not cached, the next read tries Redis again
+        return {}, None
+
+    def _get_pinged_urls(self, limit, cursor):
+        """get_pinged_urls without the cache, Redis errors are raised"""
+        results = {}
+        next_cursor = None
+        score, member = parse_history_cursor(cursor) if cursor else (None, None)
+
+        self._migrate_index()
+        start, skip = 0, None
+        if score is not None:
+            with self.redis.pipeline() as pipe:
+                pipe.zcount(INDEX_KEY, f"({score}", "+inf")
+                pipe.zscore(INDEX_KEY, member or "")
+                pipe.zrevrank(INDEX_KEY, member or "")
+                above, member_score, member_rank = pipe.execute()
+            if member is not None and member_score == score:
+                start = member_rank + 1
+            else:
+                # checked again or evicted since, carry on below its score
+                # past the urls tied with it that were already returned
+                start, skip = above, member or ""
+        entries = self.redis.zrevrange(
+            INDEX_KEY, start, start + limit - 1, withscores=True
+        )
+        if len(entries) == limit:
+            url, last_score = entries[-1]
+            next_cursor = f"{last_score!r}:{url.decode('utf-8')}"
+
+        oldest = float(_oldest_retained_score())
+        if entries and entries[-1][1] < oldest:
+            entries = [(url, s) for url, s in entries if s >= oldest]
+            next_cursor = None
+        urls = [
+            url.decode("utf-8")
+            for url, s in entries
+            if skip is None or s != score or url.decode("utf-8") < skip
+        ]
+        if urls:
+            values = _history_settings["codec"].read_many(
+                self.redis, [f"url:{url}" for url in urls]
+            )
+            for url, value in zip(urls, values):
+                # the key can expire before its index entry is trimmed
+                if value is not None:
+                    results[url] = _format_ping(value)
+
+        return results, next_cursor
+
     def get_all_pinged_urls(self):
         """Get all ping results and return in JSON"""
         results = {}
-        r = redis.StrictRedis(host=self.redis_host)
+        cursor = None
 
         try:
-            for key in r.scan_iter("url:*"):
-                value = json.loads(r.execute_command("JSON.GET", key))
-                if value["response_code"] and value["response_time_ms"]:
-                    results[
-                        key.decode("utf-8").strip("url:")
-                    ] = f'code: {value["response_code"]} response time: {value["response_time_ms"]}ms'  # noqa
-                else:
-                    results[key.decode("utf-8").strip("url:")] = ""
-
+            while True:
+                page, cursor = self._get_pinged_urls(READ_BATCH_SIZE, cursor)
+                results.update(page)
+                if cursor is None:
+                    break
         except redis.exceptions.ConnectionError as err:
             print(f"Connection Error to Redis: {err}")
-        except redis.exceptions.ResponseError as err:
-            print(f"Redis ResponseError: {err}")
+        except redis.exceptions.RedisError as err:
+            print(f"Redis error: {err!r}")
 
         return results
+
+    def _migrate_index(self):
+        """
+        Index url:* keys saved before the history index existed, they get
+        indexed as checked now and picked up by the retention window from there
+        """
+        if self.redis.exists(INDEX_MIGRATED_KEY):
+            return
+
+        now = time.time()
+        with self.redis.pipeline(transaction=False) as pipe:
+            for count, key in enumerate(
+                self.redis.scan_iter("url:*", count=READ_BATCH_SIZE), start=1
+            ):
+                url = key.decode("utf-8").removeprefix("url:")
+                # a microsecond apart, pages are cut between distinct scores
+                pipe.zadd(INDEX_KEY, {url: now - count * 1e-6}, nx=True)
+                if _history_settings["retention_seconds"]:
+                    pipe.expire(key, _history_settings["retention_seconds"])
+                if count % READ_BATCH_SIZE == 0:
+                    pipe.execute()
+            pipe.set(INDEX_MIGRATED_KEY, 1)
+            pipe.execute()
+
+
+def parse_history_cursor(cursor):
+    """
+    (score, url) of a next_cursor returned by get_pinged_urls, url is None for
+    a bare score. Raises ValueError on anything else
+    """
+    score, _, url = cursor.partition(":")
+    score = float(score)
+    if not math.isfinite(score):
+        raise ValueError(f"bad history cursor {cursor}")
+    return score, url or None
+
+
+def _oldest_retained_score():
+    if not _history_settings["retention_seconds"]:
+        return "-inf"
+    return time.time() - _history_settings["retention_seconds"]
+
+
+def migrate_pings(redis_host, target, batch_size=READ_BATCH_SIZE):
+    """
+    Rewrite url:* ping records stored by any other codec with the target codec,
+    keeping their expiry. Returns the number of records migrated
+    """
+    r = get_redis_client(redis_host)
+    target = get_codec(target)
+    codecs_by_type = {codec.redis_type: codec for codec in CODECS.values()}
+    migrated = 0
+
+    keys = r.scan_iter("url:*", count=batch_size)
+    while True:
+        batch = list(itertools.islice(keys, batch_size))
+        if not batch:
+            return migrated
+
+        with r.pipeline(transaction=False) as pipe:
+            for key in batch:
+                pipe.type(key)
+                pipe.pttl(key)
+            replies = pipe.execute()
+
+        with r.pipeline(transaction=False) as pipe:
+            for key, key_type, ttl in zip(batch, replies[::2], replies[1::2]):
+                source = codecs_by_type.get(key_type)
+                if source is None or source is target:
+                    continue
+                record = source.read(r, key)
+                if record is None:
+                    continue
+                target.write(pipe, key, record)
+                if ttl > 0:
+                    pipe.pexpire(key, ttl)
+                migrated += 1
+            pipe.execute()
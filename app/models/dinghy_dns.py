@@ -1,8 +1,30 @@
+import ipaddress
+import time
+
+import dns.exception
+import dns.flags
 import dns.message
 import dns.query
 import dns.rdataclass
 import dns.rdatatype
 import dns.resolver
+import dns.reversename
+
+# seconds to wait for an answer
+DNS_TIMEOUT = 2.0
+DNS_RECORD_TYPES = ("A", "AAAA", "CNAME", "NS", "MX", "TXT", "SRV", "PTR")
+# looked up for a hostname when no record types are asked for
+DEFAULT_DNS_RECORD_TYPES = DNS_RECORD_TYPES[:-1]
+# stands for the system resolver in a list of nameservers
+SYSTEM_RESOLVER = "system"
+
+
+def is_address(domain):
+    try:
+        ipaddress.ip_address(domain)
+        return True
+    except ValueError:
+        return False
 
 
 class DinghyDNS:
@@ -10,21 +32,53 @@ class DinghyDNS:
     The Dinghy Ping DNS info interface. Will query the localhost at 127.0.0.1
     """
 
-    def __init__(self, domain=None, rdata_type=dns.rdatatype.A, nameserver=None):
+    def __init__(
+        self,
+        domain=None,
+        rdata_type=dns.rdatatype.A,
+        nameserver=None,
+        timeout=DNS_TIMEOUT,
+    ):
         self.domain = domain
         self.rdata_type = rdata_type
         self.nameserver = nameserver
+        self.timeout = timeout
+        self.used_tcp = False
+
+    def qname(self):
+        """The name to query, the reverse name for PTR lookups of an address"""
+        if self.rdata_type == dns.rdatatype.PTR and is_address(self.domain):
+            return dns.reversename.from_address(self.domain)
+        return dns.name.from_text(self.domain)
 
     def dns_query(self):
-        qname = dns.name.from_text(self.domain)
+        qname = self.qname()
 
         if self.nameserver:
-            # Make query to specific nameserver
+            # Make query to specific nameserver, over TCP if the UDP answer
+            # is truncated. Both share the timeout, the TCP retry gets what
+            # the UDP query left of it
+            deadline = time.monotonic() + self.timeout
             q = dns.message.make_query(qname, self.rdata_type)
-            response = dns.query.udp(q, str(self.nameserver))
+            response = dns.query.udp(q, str(self.nameserver), timeout=self.timeout)
+            if response.flags & dns.flags.TC:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise dns.exception.Timeout(timeout=self.timeout)
+                self.used_tcp = True
+                response = dns.query.tcp(q, str(self.nameserver), timeout=remaining)
         else:
-            # Use system level default resolver
-            answer = dns.resolver.query(qname, self.rdata_type)
+            # Use system level default resolver, it retries truncated answers
+            # over TCP itself
+            resolver = dns.resolver.Resolver()
+            resolver.lifetime = self.timeout
+            try:
+                answer = resolver.resolve(
+                    qname, self.rdata_type, raise_on_no_answer=False
+                )
+            except dns.resolver.NXDOMAIN as e:
+                # an answer like any other, the same as from a nameserver
+                return next(iter(e.responses().values()))
             response = answer.response
 
         return response
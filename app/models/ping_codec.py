@@ -0,0 +1,94 @@
+import json
+
+
+class JSONCodec:
+    """
+    Ping records as ReJSON documents, the original layout,
+    requires https://oss.redislabs.com/rejson/ ReJSON Redis module
+    """
+
+    name = "json"
+    redis_type = b"ReJSON-RL"
+
+    def write(self, pipe, key, record):
+        # a key left in another codec's layout would fail with WRONGTYPE
+        pipe.delete(key)
+        pipe.execute_command("JSON.SET", key, ".", json.dumps(record))
+
+    def read(self, client, key):
+        value = client.execute_command("JSON.GET", key, ".")
+        return self._decode(value)
+
+    def read_many(self, client, keys):
+        values = client.execute_command("JSON.MGET", *keys, ".")
+        return [self._decode(value) for value in values]
+
+    @staticmethod
+    def _decode(value):
+        value = json.loads(value) if value else None
+        return value if isinstance(value, dict) else None
+
+
+class HashCodec:
+    """
+    Ping records as plain Redis hashes with one letter fields, runs on stock
+    Redis and small hashes stay in Redis' compact listpack encoding
+    """
+
+    name = "hash"
+    redis_type = b"hash"
+
+    def write(self, pipe, key, record):
+        fields = {
+            "c": _field(record["response_code"]),
+            "t": _field(record["response_time_ms"]),
+        }
+        if record.get("timings"):
+            fields["p"] = json.dumps(record["timings"], separators=(",", ":"))
+        # a key left in another codec's layout would fail with WRONGTYPE
+        pipe.delete(key)
+        pipe.hset(key, mapping=fields)
+
+    def read(self, client, key):
+        return self._decode(client.hgetall(key))
+
+    def read_many(self, client, keys):
+        with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+            return [self._decode(fields) for fields in pipe.execute()]
+
+    @staticmethod
+    def _decode(fields):
+        if not fields:
+            return None
+        timings = fields.get(b"p")
+        return {
+            "response_code": _number(fields.get(b"c", b"").decode("utf-8")),
+            "response_time_ms": _number(fields.get(b"t", b"").decode("utf-8")),
+            "timings": json.loads(timings) if timings else None,
+        }
+
+
+def _field(value):
+    return "" if value is None else value
+
+
+def _number(value):
+    """Hash fields come back as strings, restore http codes and timings"""
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec(), HashCodec())}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(f"ping storage codec must be one of {', '.join(CODECS)}")
@@ -0,0 +1,59 @@
+import threading
+import time
+from collections import OrderedDict
+
+import datadog
+
+
+class TTLCache:
+    """
+    Small thread safe per process LRU cache whose entries expire after ttl
+    seconds. Hits and misses are counted in datadog as
+    dinghy_ping_<name>_cache_hit/miss
+    """
+
+    def __init__(self, name, maxsize=128, ttl=5.0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # bumped by clear() so a load that raced an invalidation is not cached
+        self._generation = 0
+
+    def configure(self, maxsize, ttl):
+        with self._lock:
+            self.maxsize = maxsize
+            self.ttl = ttl
+            self._entries.clear()
+            self._generation += 1
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                datadog.statsd.increment(f"dinghy_ping_{self.name}_cache_hit.increment")
+                return entry[1]
+            generation = self._generation
+
+        datadog.statsd.increment(f"dinghy_ping_{self.name}_cache_miss.increment")
+        value = loader()
+        if self.ttl <= 0:
+            return value
+
+        with self._lock:
+            if generation != self._generation:
+                return value
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
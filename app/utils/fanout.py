@@ -0,0 +1,70 @@
+import collections
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class DeadlineExceeded(Exception):
+    """Raised for items that did not finish before the fan-out deadline"""
+
+
+def fan_out(func, items, max_workers=10, deadline=None):
+    """
+    Run func over items in a bounded thread pool and yield (item, result, error)
+    tuples in completion order. At most max_workers items are in flight at once,
+    items left over when the deadline (seconds) passes are yielded with a
+    DeadlineExceeded error instead of a result
+    """
+    items = iter(items)
+    expires_at = time.monotonic() + deadline if deadline is not None else None
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight = {}
+
+    def expired():
+        return expires_at is not None and time.monotonic() >= expires_at
+
+    def submit(count):
+        for item in itertools.islice(items, count):
+            in_flight[executor.submit(func, item)] = item
+
+    try:
+        submit(max_workers)
+        while in_flight and not expired():
+            timeout = None if expires_at is None else expires_at - time.monotonic()
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                error = future.exception()
+                yield item, None if error else future.result(), error
+            if not expired():
+                submit(len(done))
+
+        for item in itertools.chain(list(in_flight.values()), items):
+            yield item, None, DeadlineExceeded(f"deadline of {deadline}s exceeded")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fan_out_ordered(func, items, max_workers=10):
+    """
+    Like fan_out without a deadline, but yields (item, result, error) tuples in
+    the order of items. Up to max_workers items run ahead of the one being
+    yielded
+    """
+    items = iter(items)
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    in_flight = collections.deque()
+
+    def submit(count):
+        for item in itertools.islice(items, count):
+            in_flight.append((item, executor.submit(func, item)))
+
+    try:
+        submit(max_workers)
+        while in_flight:
+            item, future = in_flight.popleft()
+            error = future.exception()
+            submit(1)
+            yield item, None if error else future.result(), error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,205 @@
+import http.cookiejar
+import os
+import socket
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+# Number of per host connection pools kept per worker, and the number of
+# keep-alive connections kept in each of them
+_pool_settings = {"pool_connections": 50, "pool_maxsize": 10}
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_trace = threading.local()
+
+TIMING_PHASES = ("dns_ms", "connect_ms", "tls_ms", "ttfb_ms", "transfer_ms")
+
+
+def configure_http_pool(pool_connections, pool_maxsize):
+    """Set the pool limits used when a worker builds its shared session"""
+    global _session
+    _pool_settings.update(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    _session = None
+
+
+def _elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def _add_timing(phase, ms):
+    trace = getattr(_trace, "current", None)
+    if trace is not None:
+        trace[phase] = round(trace.get(phase, 0.0) + ms, 3)
+
+
+class _TracedConnectionMixin:
+    """
+    Records connection phases into the current thread's trace. urllib3 only
+    calls connect() when it has to open a new socket, a request that never gets
+    here was served over a pooled keep-alive connection. Phases are summed over
+    every hop when a check follows redirects
+    """
+
+    _ttfb_started = None
+
+    def _new_conn(self):
+        # Resolve up front so DNS time is split from the TCP connect, then let
+        # urllib3 connect to each resolved address in turn like it would itself
+        dns_host = self._dns_host
+        started = time.perf_counter()
+        try:
+            addresses = socket.getaddrinfo(
+                dns_host, self.port, allowed_gai_family(), socket.SOCK_STREAM
+            )
+        except socket.gaierror:
+            # urllib3 raises its own NameResolutionError for this host
+            return super()._new_conn()
+        _add_timing("dns_ms", _elapsed_ms(started))
+
+        error = None
+        started = time.perf_counter()
+        try:
+            for address in dict.fromkeys(info[4][0] for info in addresses):
+                self._dns_host = address
+                try:
+                    sock = super()._new_conn()
+                    break
+                except NewConnectionError as e:
+                    error = e
+            else:
+                raise error
+        finally:
+            self._dns_host = dns_host
+            _add_timing("connect_ms", _elapsed_ms(started))
+        return sock
+
+    def connect(self):
+        trace = getattr(_trace, "current", None)
+        if trace is not None:
+            trace["connection_reused"] = False
+            dns_ms, connect_ms = trace.get("dns_ms", 0.0), trace.get("connect_ms", 0.0)
+        started = time.perf_counter()
+        super().connect()
+        if trace is not None and isinstance(self, HTTPSConnection):
+            # Whatever connect() spent beyond resolving and connecting the
+            # socket went into the TLS handshake
+            handshake_ms = _elapsed_ms(started) - (
+                trace["dns_ms"] - dns_ms + trace["connect_ms"] - connect_ms
+            )
+            _add_timing("tls_ms", max(handshake_ms, 0.0))
+        # Plain http connects lazily inside request(), time to first byte
+        # counts from whichever of request() and connect() finished last
+        self._ttfb_started = time.perf_counter()
+
+    def request(self, *args, **kwargs):
+        self._ttfb_started = time.perf_counter()
+        return super().request(*args, **kwargs)
+
+    def getresponse(self, *args, **kwargs):
+        response = super().getresponse(*args, **kwargs)
+        if self._ttfb_started is not None:
+            _add_timing("ttfb_ms", _elapsed_ms(self._ttfb_started))
+            self._ttfb_started = None
+        return response
+
+
+class TracedHTTPConnection(_TracedConnectionMixin, HTTPConnection):
+    pass
+
+
+class TracedHTTPSConnection(_TracedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class TracedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TracedHTTPConnection
+
+
+class TracedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TracedHTTPSConnection
+
+
+TRACED_POOL_CLASSES = {
+    "http": TracedHTTPConnectionPool,
+    "https": TracedHTTPSConnectionPool,
+}
+
+
+class TracedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose connection pools report new connections to the trace"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = TRACED_POOL_CLASSES
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        manager = super().proxy_manager_for(proxy, **proxy_kwargs)
+        # SOCKS managers bring their own connection classes
+        if not proxy.lower().startswith("socks"):
+            manager.pool_classes_by_scheme = TRACED_POOL_CLASSES
+        return manager
+
+
+def _build_session(pool_connections, pool_maxsize):
+    session = requests.Session()
+    # every check must stand on its own, never send one target's cookies on
+    # a later check of the same site by someone else
+    session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    # block rather than open connections beyond pool_maxsize per host
+    adapter = TracedHTTPAdapter(
+        pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=True
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Shared keep-alive session for this worker process, rebuilt after a fork
+    since gunicorn --preload imports the app before forking workers
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session(**_pool_settings)
+                _session_pid = pid
+    return _session
+
+
+def _timed_get(session, url, trace, **kwargs):
+    response = session.get(url, stream=True, **kwargs)
+    started = time.perf_counter()
+    response.content
+    _add_timing("transfer_ms", _elapsed_ms(started))
+    return response
+
+
+def traced_get(url, trace, **kwargs):
+    """
+    GET url over the shared pooled session, or over a throwaway session when
+    trace["cold_connection"] is set so the check pays for a fresh TCP connection
+    and TLS handshake. Records in trace whether the connection was reused and
+    the time spent in each of the TIMING_PHASES plus the total_ms
+    """
+    trace["connection_reused"] = True
+    trace.update(dict.fromkeys(TIMING_PHASES, 0.0))
+    _trace.current = trace
+    started = time.perf_counter()
+    try:
+        if trace.get("cold_connection"):
+            with _build_session(pool_connections=1, pool_maxsize=1) as session:
+                return _timed_get(session, url, trace, **kwargs)
+        return _timed_get(get_session(), url, trace, **kwargs)
+    finally:
+        trace["total_ms"] = round(_elapsed_ms(started), 3)
+        _trace.current = None
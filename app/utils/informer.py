@@ -0,0 +1,251 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+import datadog
+from kubernetes import client, watch
+from kubernetes.client.rest import ApiException
+
+HTTP_GONE = 410
+RETRY_SECONDS = 5
+
+# name -> (api class, cluster wide list method)
+RESOURCES = {
+    "namespaces": (client.CoreV1Api, "list_namespace"),
+    "pods": (client.CoreV1Api, "list_pod_for_all_namespaces"),
+    "deployments": (client.AppsV1Api, "list_deployment_for_all_namespaces"),
+}
+
+_informer_settings = {
+    "enabled": True,
+    "resync_seconds": 300,
+    "max_staleness": 600,
+    "sync_timeout": 5,
+}
+_informers = {}
+_informers_lock = threading.Lock()
+
+
+def configure_informers(enabled, resync_seconds, max_staleness, sync_timeout):
+    """Set the settings used by the shared Kubernetes informers"""
+    _informer_settings.update(
+        enabled=enabled,
+        resync_seconds=resync_seconds,
+        max_staleness=max_staleness,
+        sync_timeout=sync_timeout,
+    )
+    with _informers_lock:
+        for informer in _informers.values():
+            informer.stop()
+        _informers.clear()
+
+
+class Informer:
+    """
+    In-memory cache of one Kubernetes resource kind, shared by every request in
+    the process. A background thread LISTs the resource once, then WATCHes from
+    the list's resourceVersion and applies the events to the store. It relists
+    every resync_seconds to correct any drift, and straight away when the API
+    server answers 410 Gone because the resourceVersion expired. The store is
+    indexed by namespace, then name
+    """
+
+    def __init__(
+        self, name, api_class, method, resync_seconds, max_staleness, sync_timeout
+    ):
+        self.name = name
+        self.api_class = api_class
+        self.method = method
+        self.resync_seconds = resync_seconds
+        self.max_staleness = max_staleness
+        self.sync_timeout = sync_timeout
+        self.resource_version = None
+        self.relists = 0
+        self.last_list = None
+        self.last_error = None
+        self._store = {}
+        self._last_contact = None
+        self._sync_waited = False
+        self._lock = threading.Lock()
+        self._synced = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _ensure_started(self):
+        # same as the ping writer, the watch thread has to run in each
+        # gunicorn worker, not in the --preload master
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._store = {}
+            self._sync_waited = False
+            self._synced.clear()
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=f"dinghy-ping-informer-{self.name}", daemon=True
+            )
+            self._thread.start()
+            self._pid = pid
+
+    def _list(self, list_func):
+        ret = list_func(watch=False)
+        store = {}
+        for i in ret.items:
+            store.setdefault(i.metadata.namespace, {})[i.metadata.name] = i
+        with self._lock:
+            self._store = store
+            self.resource_version = ret.metadata.resource_version
+            self.relists += 1
+            self.last_list = datetime.datetime.now(datetime.timezone.utc)
+            self._last_contact = time.monotonic()
+        self._synced.set()
+        datadog.statsd.increment(f"dinghy_ping_informer_{self.name}_relist.increment")
+
+    def _apply(self, event):
+        if event["type"] == "BOOKMARK":
+            resource_version = event["raw_object"]["metadata"]["resourceVersion"]
+            with self._lock:
+                self.resource_version = resource_version
+                self._last_contact = time.monotonic()
+            return
+
+        obj = event["object"]
+        namespace, name = obj.metadata.namespace, obj.metadata.name
+        with self._lock:
+            if event["type"] == "DELETED":
+                objs = self._store.get(namespace, {})
+                objs.pop(name, None)
+                if not objs:
+                    self._store.pop(namespace, None)
+            else:
+                self._store.setdefault(namespace, {})[name] = obj
+            self.resource_version = obj.metadata.resource_version
+            self._last_contact = time.monotonic()
+
+    def _watch(self, list_func, deadline):
+        w = watch.Watch()
+        for event in w.stream(
+            list_func,
+            resource_version=self.resource_version,
+            timeout_seconds=max(1, int(deadline - time.monotonic())),
+            allow_watch_bookmarks=True,
+        ):
+            if self._stop.is_set():
+                w.stop()
+                break
+            self._apply(event)
+        # the server closed the watch at timeout_seconds, we are still in touch
+        with self._lock:
+            self._last_contact = time.monotonic()
+
+    def _run(self):
+        list_func = getattr(self.api_class(), self.method)
+        while not self._stop.is_set():
+            try:
+                self._list(list_func)
+                deadline = time.monotonic() + self.resync_seconds
+                while not self._stop.is_set() and time.monotonic() < deadline:
+                    self._watch(list_func, deadline)
+                self.last_error = None
+            except ApiException as e:
+                if e.status == HTTP_GONE:
+                    logging.info(f"{self.name} informer watch expired, relisting")
+                    continue
+                logging.error(f"{self.name} informer error: {e}")
+                self.last_error = f"{e.status} {e.reason}"
+                self._stop.wait(RETRY_SECONDS)
+            except Exception as e:
+                logging.exception(f"{self.name} informer error")
+                self.last_error = str(e)
+                self._stop.wait(RETRY_SECONDS)
+
+    def age(self):
+        """Seconds since the cache last heard from the API server"""
+        if self._last_contact is None:
+            return None
+        return time.monotonic() - self._last_contact
+
+    def list(self, namespace=None):
+        """
+        Cached objects sorted by namespace and name, optionally of one
+        namespace. None when the cache has not synced or has been out of touch
+        with the API server for more than max_staleness seconds, callers then
+        fall back to a direct API call. Only the first call waits, up to
+        sync_timeout, for the first list, and none once it failed
+        """
+        self._ensure_started()
+        synced = self._synced.is_set()
+        if not synced and not self._sync_waited and self.last_error is None:
+            synced = self._synced.wait(self.sync_timeout)
+            self._sync_waited = True
+        if not synced or self.age() > self.max_staleness:
+            datadog.statsd.increment(f"dinghy_ping_informer_{self.name}_miss.increment")
+            return None
+
+        with self._lock:
+            if namespace is None:
+                items = [
+                    ((ns, name), obj)
+                    for ns, objs in self._store.items()
+                    for name, obj in objs.items()
+                ]
+            else:
+                items = [
+                    ((namespace, name), obj)
+                    for name, obj in self._store.get(namespace, {}).items()
+                ]
+        datadog.statsd.increment(f"dinghy_ping_informer_{self.name}_hit.increment")
+        # cluster scoped objects have no namespace, sort them as ""
+        items.sort(key=lambda item: (item[0][0] or "", item[0][1]))
+        return [obj for _, obj in items]
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        age = self.age()
+        with self._lock:
+            return {
+                "synced": self._synced.is_set(),
+                "objects": sum(len(objs) for objs in self._store.values()),
+                "resource_version": self.resource_version,
+                "age_seconds": None if age is None else round(age, 3),
+                "last_list": self.last_list.isoformat() if self.last_list else None,
+                "relists": self.relists,
+                "last_error": self.last_error,
+            }
+
+
+def get_informer(name):
+    """The process wide informer for one of RESOURCES"""
+    informer = _informers.get(name)
+    if informer is None:
+        with _informers_lock:
+            informer = _informers.get(name)
+            if informer is None:
+                settings = dict(_informer_settings)
+                settings.pop("enabled")
+                informer = Informer(name, *RESOURCES[name], **settings)
+                _informers[name] = informer
+    return informer
+
+
+def cached_list(name, namespace=None):
+    """
+    Objects of resource name from the informer cache, None when informers are
+    disabled or the cache can not be used
+    """
+    if not _informer_settings["enabled"]:
+        return None
+    return get_informer(name).list(namespace)
+
+
+def informer_stats():
+    """Cache age and size of the informers this process has started"""
+    return {name: informer.stats() for name, informer in list(_informers.items())}
@@ -1,61 +1,405 @@
+import codecs
+import collections
+import functools
+import heapq
+import json
 import logging
+import socket
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
-from kubernetes import client
+from kubernetes import client, watch
 from kubernetes.client.rest import ApiException
 
+from app.utils.fanout import fan_out_ordered
+from app.utils.informer import cached_list
+from app.utils.log_cursor import iter_lines, split_timestamp, timestamp_key
 
-def get_deployment_logs(namespace, name, tail_lines):
+DEPLOYMENT_LIST_CHUNK_SIZE = 500
+# times a chunked deployment list starts over after its continue token expired
+DEPLOYMENT_LIST_RESTARTS = 3
+LOG_CHUNK_SIZE = 64 * 1024
+LOG_WINDOWS = ("head", "tail")
+EVENT_WATCH_TIMEOUT_SECONDS = 300
+# uids of recently published events, to skip them when a watch restarts
+EVENT_SEEN_SIZE = 5000
+DEPLOYMENT_SORT_KEYS = ("name", "namespace", "revision", "date", "ready")
+
+
+def _deployment_pod_names(namespace, name):
     """Gather pod names via K8s label selector"""
     pods = []
-    k8s_client = client.CoreV1Api()
-
     try:
-        api_response = k8s_client.list_namespaced_pod(
+        api_response = client.CoreV1Api().list_namespaced_pod(
             namespace, label_selector="release={}".format(name)
         )
         for api_items in api_response.items:
             pods.append(api_items.metadata.name)
     except ApiException as e:
         logging.error(f"Exception when calling CoreV1Api->list_namespaced_pod: {e}")
+    return pods
+
+
+def _keyed_lines(pod, logs):
+    """
+    (sort key, line) pairs of a pod's timestamped log. Lines without a whole
+    timestamp, like the partial lines a cut log starts or ends with, sort
+    with the line before them, or the first timestamped line at the start
+    """
+    lines = logs.splitlines()
+    keys = []
+    for line in lines:
+        timestamp, _ = split_timestamp(line)
+        keys.append(timestamp_key(timestamp) if timestamp else None)
+    key = next((key for key in keys if key is not None), ("", ""))
+    keyed = []
+    for line, line_key in zip(lines, keys):
+        key = line_key or key
+        keyed.append((key, f"{pod} {line}\n"))
+    return keyed
+
+
+def truncated_marker(pod, limit_bytes, window):
+    """Line appended to logs that were cut to their byte budget"""
+    return f"[{pod} log cut to the {window} {limit_bytes} bytes]\n"
+
+
+def iter_deployment_logs(
+    namespace,
+    name,
+    tail_lines,
+    limit_bytes,
+    window="tail",
+    max_workers=10,
+    merge=False,
+    truncated=None,
+):
+    """
+    Yield the logs of a deployment's pods chunk by chunk, read concurrently by
+    up to max_workers threads. limit_bytes is shared evenly between the pods,
+    each pod keeps the head or tail window of its share and the names of the
+    pods that were cut are appended to the truncated list. Pod by pod blocks in
+    pod order by default, with merge every line is prefixed with its pod and
+    timestamp and the lines of all pods are interleaved in timestamp order
+    """
+    pods = _deployment_pod_names(namespace, name)
+    pod_limit_bytes = max(limit_bytes // max(len(pods), 1), 1)
+    if truncated is None:
+        truncated = []
+
+    def read_log(pod):
+        logs = PodLogWindow(
+            pod, namespace, None, tail_lines, pod_limit_bytes, window, timestamps=merge
+        )
+        return "".join(logs), logs.truncated
+
+    def read_logs():
+        for pod, result, error in fan_out_ordered(read_log, pods, max_workers):
+            if error is not None:
+                logging.error(
+                    f"Exception when calling CoreV1Api->read_namespaced_pod_log: {error}"
+                )
+                continue
+            logs, cut = result
+            if cut:
+                truncated.append(pod)
+            yield pod, logs
+
+    if not merge:
+        for pod, logs in read_logs():
+            yield pod + "\n"
+            yield logs
+            if pod in truncated:
+                yield truncated_marker(pod, pod_limit_bytes, window)
+        return
+
+    # a k-way merge needs the head of every pod's log, read them all first
+    per_pod = [_keyed_lines(pod, logs) for pod, logs in read_logs()]
+    for _, line in heapq.merge(*per_pod, key=itemgetter(0)):
+        yield line
+    for pod in truncated:
+        yield truncated_marker(pod, pod_limit_bytes, window)
+
+
+def label_selector(selector):
+    """Render a deployment's spec.selector as a label selector string"""
+    terms = [f"{k}={v}" for k, v in sorted((selector.match_labels or {}).items())]
+    for expression in selector.match_expressions or []:
+        key, operator = expression.key, expression.operator
+        if operator == "In":
+            terms.append(f"{key} in ({','.join(expression.values)})")
+        elif operator == "NotIn":
+            terms.append(f"{key} notin ({','.join(expression.values)})")
+        elif operator == "Exists":
+            terms.append(key)
+        elif operator == "DoesNotExist":
+            terms.append(f"!{key}")
+    return ",".join(terms)
+
+
+def match_deployment_pods(deployment_uid, replica_sets, pods):
+    """
+    Pods owned by the deployment's ready ReplicaSets, matched through an
+    index of ReplicaSet owner reference UIDs
+    """
+    ready_replica_sets = set()
+    for rs in replica_sets:
+        if not bool(rs.status.replicas):
+            continue
+        if rs.status.available_replicas != rs.status.ready_replicas:
+            continue
+        for reference in rs.metadata.owner_references or []:
+            if reference.uid == deployment_uid:
+                ready_replica_sets.add(rs.metadata.uid)
+
+    all_pods = {}
+    for pod in pods:
+        for reference in pod.metadata.owner_references or []:
+            if reference.uid in ready_replica_sets:
+                all_pods[pod.metadata.name] = pod
+                break
+    return all_pods
+
+
+def get_deployment_pods(deployment):
+    """
+    Pods of a deployment, its ReplicaSets and pods are listed concurrently
+    with the deployment's label selector
+    """
+    namespace = deployment.metadata.namespace
+    selector = label_selector(deployment.spec.selector)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        replica_sets = executor.submit(
+            client.AppsV1Api().list_namespaced_replica_set,
+            namespace,
+            label_selector=selector,
+        )
+        pods = executor.submit(
+            client.CoreV1Api().list_namespaced_pod,
+            namespace,
+            label_selector=selector,
+        )
+        return match_deployment_pods(
+            deployment.metadata.uid,
+            replica_sets.result().items,
+            pods.result().items,
+        )
+
+
+class PodLogWindow:
+    """
+    A pod's log as an iterable of text chunks of about chunk_size bytes, read
+    from the API server as they are consumed and cut to limit_bytes. The head
+    window keeps the first limit_bytes of the tail_lines asked for and is cut
+    by the API server through limitBytes, the tail window keeps the last
+    limit_bytes in a ring buffer of chunks. since_seconds starts the log
+    that many seconds ago instead of tail_lines back. With accept only the
+    lines it accepts are kept, filtered as they are read and before the
+    window is cut. truncated is set once iterated.
+    Raises ApiException straight away if the log can not be read
+    """
+
+    def __init__(
+        self,
+        pod,
+        namespace,
+        container,
+        tail_lines,
+        limit_bytes,
+        window="tail",
+        timestamps=False,
+        since_seconds=None,
+        accept=None,
+        chunk_size=LOG_CHUNK_SIZE,
+    ):
+        if window not in LOG_WINDOWS:
+            raise ValueError(f"window must be one of {', '.join(LOG_WINDOWS)}")
+        self.limit_bytes = limit_bytes
+        self.window = window
+        self.chunk_size = chunk_size
+        self.accept = accept
+        self.truncated = False
+
+        kwargs = dict(timestamps=timestamps)
+        if tail_lines is not None:
+            kwargs["tail_lines"] = tail_lines
+        if since_seconds is not None:
+            kwargs["since_seconds"] = since_seconds
+        if container:
+            kwargs["container"] = container
+        if window == "head" and accept is None:
+            # one byte over the budget tells a cut log from one that fits
+            kwargs["limit_bytes"] = limit_bytes + 1
+        self._resp = client.CoreV1Api().read_namespaced_pod_log(
+            pod, namespace, _preload_content=False, **kwargs
+        )
+
+    def _head(self, chunks):
+        remaining = self.limit_bytes
+        for chunk in chunks:
+            if len(chunk) > remaining:
+                self.truncated = True
+                chunk = chunk[:remaining]
+            remaining -= len(chunk)
+            yield chunk
+            if self.truncated:
+                break
+
+    def _tail(self, chunks):
+        buffered = collections.deque()
+        size = 0
+        for chunk in chunks:
+            buffered.append(chunk)
+            size += len(chunk)
+            while size - len(buffered[0]) >= self.limit_bytes:
+                size -= len(buffered.popleft())
+                self.truncated = True
+        excess = size - self.limit_bytes
+        if excess > 0:
+            buffered[0] = buffered[0][excess:]
+            self.truncated = True
+        yield from buffered
+
+    def _accepted(self, chunks):
+        """The accepted lines of chunks, as utf-8"""
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        def text():
+            for chunk in chunks:
+                yield decoder.decode(chunk)
+            yield decoder.decode(b"", final=True)
+
+        for line in iter_lines(text()):
+            if self.accept(line):
+                yield line.encode("utf-8")
+
+    def __iter__(self):
+        # a multi byte character can straddle two chunks, decode incrementally
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        chunks = self._resp.stream(self.chunk_size, decode_content=True)
+        if self.accept is not None:
+            chunks = self._accepted(chunks)
+        cut = self._head if self.window == "head" else self._tail
+        drained = False
+        try:
+            for chunk in cut(chunks):
+                text = decoder.decode(chunk)
+                if text:
+                    yield text
+            text = decoder.decode(b"", final=True)
+            if text:
+                yield text
+            drained = not self.truncated or self.window == "tail"
+        finally:
+            if not drained:
+                # unread body left on the connection, it can not be reused
+                self._resp.close()
+            self._resp.release_conn()
 
-    # Iterate over list of pods and concatenate logs
-    logs = ""
+
+def _shutdown(resp):
+    # close() alone does not wake a thread blocked reading the socket
+    connection = getattr(resp, "connection", None)
+    if connection is not None and connection.sock is not None:
+        connection.sock.shutdown(socket.SHUT_RDWR)
+    resp.close()
+
+
+def follow_pod_log(key, topic):
+    """
+    Stream hub upstream, follows the log of key (namespace, pod, container,
+    tail_lines, since_seconds, viewer) and publishes it line by line with
+    timestamps. With since_seconds it starts that many seconds back instead of
+    tail_lines, viewer only keeps resumed streams apart
+    """
+    namespace, pod, container, tail_lines, since, _ = key
+    kwargs = dict(tail_lines=tail_lines)
+    if since:
+        kwargs = dict(since_seconds=since)
     try:
-        for pod in pods:
-            logs += pod + "\n"
-            logs += k8s_client.read_namespaced_pod_log(
-                pod, namespace, tail_lines=tail_lines
-            )
+        resp = client.CoreV1Api().read_namespaced_pod_log(
+            pod,
+            namespace,
+            container=container,
+            follow=True,
+            timestamps=True,
+            _preload_content=False,
+            **kwargs,
+        )
     except ApiException as e:
-        logging.error(f"Exception when calling CoreV1Api->read_namespaced_pod_log: {e}")
+        if e.status == 404:
+            topic.publish("Pod not found")
+            return
+        raise
 
-    return logs
+    topic.on_stop(lambda: _shutdown(resp))
+    try:
+        while not topic.stopped:
+            line = resp.readline()
+            if not line:
+                break
+            topic.publish(line.decode("utf-8", errors="replace"))
+    finally:
+        resp.release_conn()
 
 
-def get_pod_logs(pod, namespace, container, tail_lines):
-    """Read pod logs"""
-    k8s_client = client.CoreV1Api()
-    ret = []
-    if container:
-        try:
-            ret = k8s_client.read_namespaced_pod_log(
-                pod, namespace, container=container, tail_lines=tail_lines
-            )
-        except ApiException as e:
-            logging.error(
-                f"Exception when calling CoreV1Api->read_namespaced_pod_log: {e}"
-            )
-    else:
+def watch_namespace_events(key, topic):
+    """
+    Stream hub upstream, watches the events of key (namespace, field_selector)
+    and publishes them as json. An expired watch is resumed from the last
+    resourceVersion, only a 410 Gone restarts it from scratch and then events
+    that were already published are skipped
+    """
+    namespace, field_selector = key
+    v1 = client.CoreV1Api()
+    current = {}
+    seen = collections.OrderedDict()
+    resource_version = None
+
+    @functools.wraps(v1.list_namespaced_event)
+    def list_namespaced_event(*args, **kwargs):
+        # keep hold of the watch response so on_stop can unblock it
+        current["resp"] = v1.list_namespaced_event(*args, **kwargs)
+        return current["resp"]
+
+    topic.on_stop(lambda: current.get("resp") and _shutdown(current["resp"]))
+
+    while not topic.stopped:
+        w = watch.Watch()
+        kwargs = dict(
+            field_selector=field_selector,
+            timeout_seconds=EVENT_WATCH_TIMEOUT_SECONDS,
+            allow_watch_bookmarks=True,
+        )
+        if resource_version:
+            kwargs["resource_version"] = resource_version
         try:
-            ret = k8s_client.read_namespaced_pod_log(
-                pod, namespace, tail_lines=tail_lines
-            )
+            for event in w.stream(list_namespaced_event, namespace, **kwargs):
+                if event["type"] == "BOOKMARK":
+                    metadata = event["raw_object"]["metadata"]
+                    resource_version = metadata["resourceVersion"]
+                    continue
+                obj = event["object"]
+                resource_version = obj.metadata.resource_version
+                if seen.get(obj.metadata.uid) == resource_version:
+                    continue
+                seen[obj.metadata.uid] = resource_version
+                seen.move_to_end(obj.metadata.uid)
+                if len(seen) > EVENT_SEEN_SIZE:
+                    seen.popitem(last=False)
+                event_resp = dict(
+                    Name=obj.metadata.name,
+                    Type=obj.type,
+                    Reason=obj.reason,
+                    Message=obj.message,
+                )
+                topic.publish(json.dumps(event_resp))
         except ApiException as e:
-            logging.error(
-                f"Exception when calling CoreV1Api->read_namespaced_pod_log: {e}"
-            )
-
-    return ret
+            if e.status != 410 or topic.stopped:
+                raise
+            logging.info(f"event watch {key} expired, restarting")
+            resource_version = None
 
 
 def describe_pod(pod, namespace):
@@ -96,28 +440,27 @@ def get_pod_events(pod, namespace):
 
 
 def get_all_namespaces():
-    """Get all namespaces"""
-    k8s_client = client.CoreV1Api()
-    namespaces = []
+    """Get all namespaces, from the informer cache when it is available"""
+    namespaces = cached_list("namespaces")
+    if namespaces is None:
+        namespaces = client.CoreV1Api().list_namespace(watch=False).items
 
-    ret = k8s_client.list_namespace(watch=False)
-    for i in ret.items:
-        namespaces.append(i.metadata.name)
-
-    return namespaces
+    return [i.metadata.name for i in namespaces]
 
 
 def get_all_pods(namespace=None):
     """Get all pods and return dict of pods with their containers and their namespaces"""
     pods = {}
-    k8s_client = client.CoreV1Api()
 
-    if namespace:
-        ret = k8s_client.list_namespaced_pod(namespace, watch=False)
-    else:
-        ret = k8s_client.list_pod_for_all_namespaces(watch=False)
+    ret = cached_list("pods", namespace)
+    if ret is None:
+        k8s_client = client.CoreV1Api()
+        if namespace:
+            ret = k8s_client.list_namespaced_pod(namespace, watch=False).items
+        else:
+            ret = k8s_client.list_pod_for_all_namespaces(watch=False).items
 
-    for i in ret.items:
+    for i in ret:
         pod = i.metadata.name
         namespace = i.metadata.namespace
         containers = []
@@ -126,3 +469,120 @@ def get_all_pods(namespace=None):
         pods[pod] = dict(namespace=namespace, containers=containers)
 
     return pods
+
+
+def _include_deployment(namespace, name, workloads_only, name_filter):
+    if name_filter is not None and name_filter not in name:
+        return False
+    if workloads_only and namespace.startswith(("kube", "docker")):
+        return False
+    return True
+
+
+def _iter_raw_deployments(namespace):
+    """
+    Deployments as plain dicts, listed limit DEPLOYMENT_LIST_CHUNK_SIZE at a
+    time. Skips model deserialization so callers can filter on the raw items.
+    When the continue token expires (410 Gone) the list starts over, skipping
+    the deployments already yielded
+    """
+    k8s_client = client.AppsV1Api()
+    _continue = None
+    seen = set()
+    restarts = 0
+    while True:
+        kwargs = dict(limit=DEPLOYMENT_LIST_CHUNK_SIZE, _preload_content=False)
+        if _continue:
+            kwargs["_continue"] = _continue
+        try:
+            if namespace:
+                resp = k8s_client.list_namespaced_deployment(namespace, **kwargs)
+            else:
+                resp = k8s_client.list_deployment_for_all_namespaces(**kwargs)
+        except ApiException as e:
+            if e.status != 410 or not _continue or restarts >= DEPLOYMENT_LIST_RESTARTS:
+                raise
+            logging.info("deployment list continue token expired, restarting")
+            restarts += 1
+            _continue = None
+            continue
+        ret = json.loads(resp.data)
+        for item in ret.get("items") or []:
+            key = (item["metadata"]["namespace"], item["metadata"]["name"])
+            if key not in seen:
+                seen.add(key)
+                yield item
+        _continue = ret["metadata"].get("continue")
+        if not _continue:
+            break
+
+
+def list_deployments(namespace=None, workloads_only=False, name_filter=None):
+    """
+    Summaries of the deployments in namespace, or in the whole cluster, from
+    the informer cache or else a single chunked cluster wide list. Filtered
+    before anything else is read from each deployment
+    """
+    deployments = []
+
+    cached = cached_list("deployments", namespace)
+    if cached is not None:
+        for i in cached:
+            meta = i.metadata
+            if not _include_deployment(
+                meta.namespace, meta.name, workloads_only, name_filter
+            ):
+                continue
+            deployments.append(
+                {
+                    "name": meta.name,
+                    "namespace": meta.namespace,
+                    "revision": meta.generation,
+                    "date": meta.creation_timestamp.isoformat()
+                    if meta.creation_timestamp
+                    else None,
+                    "available_replicas": i.status.available_replicas,
+                    "ready_replicas": i.status.ready_replicas,
+                }
+            )
+        return deployments
+
+    for i in _iter_raw_deployments(namespace):
+        meta = i["metadata"]
+        if not _include_deployment(
+            meta["namespace"], meta["name"], workloads_only, name_filter
+        ):
+            continue
+        status = i.get("status") or {}
+        created = meta.get("creationTimestamp")
+        deployments.append(
+            {
+                "name": meta["name"],
+                "namespace": meta["namespace"],
+                "revision": meta.get("generation"),
+                "date": created.replace("Z", "+00:00") if created else None,
+                "available_replicas": status.get("availableReplicas"),
+                "ready_replicas": status.get("readyReplicas"),
+            }
+        )
+
+    return deployments
+
+
+def sort_deployments(deployments, sort="namespace", order="asc"):
+    """Sort deployment summaries by one of DEPLOYMENT_SORT_KEYS"""
+    if sort not in DEPLOYMENT_SORT_KEYS:
+        raise ValueError(f"sort must be one of {', '.join(DEPLOYMENT_SORT_KEYS)}")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+
+    def value(deployment):
+        if sort == "ready":
+            return deployment["ready_replicas"] or 0
+        return deployment[sort]
+
+    # ties keep namespace/name order and missing values go last, either order
+    deployments = sorted(deployments, key=itemgetter("namespace", "name"))
+    present = [d for d in deployments if value(d) is not None]
+    missing = [d for d in deployments if value(d) is None]
+    return sorted(present, key=value, reverse=order == "desc") + missing
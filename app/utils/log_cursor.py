@@ -0,0 +1,106 @@
+import calendar
+import datetime
+import hashlib
+import math
+import time
+
+# <RFC3339 timestamp of the last line sent>|<hash of that line>
+CURSOR_SEPARATOR = "|"
+
+
+def timestamp_key(timestamp):
+    """
+    Sortable form of the RFC3339 timestamp the kubelet prefixes log lines
+    with, it trims trailing zeros from the fraction so pad it back
+    """
+    seconds, _, fraction = timestamp.rstrip("Z").partition(".")
+    return seconds, fraction.ljust(9, "0")
+
+
+def split_timestamp(line):
+    """(timestamp, rest of the line) of a timestamped log line, (None, line) if not"""
+    timestamp, _, text = line.partition(" ")
+    if len(timestamp) < 20 or timestamp[4] != "-" or not timestamp.endswith("Z"):
+        return None, line
+    return timestamp, text
+
+
+def line_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=6).hexdigest()
+
+
+def make_cursor(timestamp, text):
+    return f"{timestamp}{CURSOR_SEPARATOR}{line_hash(text)}"
+
+
+def parse_cursor(cursor):
+    """(timestamp, line hash) of a cursor, raises ValueError on a bad one"""
+    timestamp, _, digest = cursor.partition(CURSOR_SEPARATOR)
+    if split_timestamp(timestamp + " ")[0] is None or not digest:
+        raise ValueError("cursor must be a cursor returned by a previous request")
+    datetime.datetime.strptime(timestamp_key(timestamp)[0], "%Y-%m-%dT%H:%M:%S")
+    return timestamp, digest
+
+
+def since_seconds(timestamp):
+    """
+    sinceSeconds covering everything after timestamp, the API has whole
+    second resolution so round up and let CursorFilter drop the overlap
+    """
+    seconds = timestamp_key(timestamp)[0]
+    parsed = time.strptime(seconds, "%Y-%m-%dT%H:%M:%S")
+    return max(math.ceil(time.time() - calendar.timegm(parsed)) + 1, 1)
+
+
+def iter_lines(chunks):
+    """Whole lines, newline included, from an iterable of text chunks"""
+    pending = ""
+    for chunk in chunks:
+        pending += chunk
+        lines = pending.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if pending:
+        yield pending
+
+
+class CursorFilter:
+    """
+    Accepts the timestamped log lines after a cursor: lines stamped later
+    than it, and lines stamped the same after the line it hashes
+    """
+
+    def __init__(self, cursor):
+        timestamp, self.digest = parse_cursor(cursor)
+        self.key = timestamp_key(timestamp)
+        self.passed = False
+
+    def __call__(self, line):
+        if self.passed:
+            return True
+        timestamp, text = split_timestamp(line)
+        if timestamp is None:
+            return True
+        key = timestamp_key(timestamp)
+        if key > self.key:
+            self.passed = True
+            return True
+        if key == self.key and line_hash(text) == self.digest:
+            # the last line the client saw, everything after it is new
+            self.passed = True
+        return False
+
+
+class CursorTracker:
+    """Strips timestamps from log lines and keeps the cursor of the last one"""
+
+    def __init__(self, cursor=None):
+        self.cursor = cursor
+
+    def strip(self, lines):
+        for line in lines:
+            timestamp, text = split_timestamp(line)
+            if timestamp is not None:
+                self.cursor = make_cursor(timestamp, text)
+            yield text
@@ -1,24 +1,43 @@
+import asyncio
+import collections
+import contextlib
+import itertools
 import json
 import logging
+import queue
 import socket
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 import datadog
+import dns.rcode
 import dns.rdatatype
 import requests
 from ddtrace import patch
 
 from app.models.dinghy_data import DinghyData
-from app.models.dinghy_dns import DinghyDNS
+from app.models.dinghy_dns import (
+    DEFAULT_DNS_RECORD_TYPES,
+    DNS_RECORD_TYPES,
+    DNS_TIMEOUT,
+    SYSTEM_RESOLVER,
+    DinghyDNS,
+    is_address,
+)
+from app.utils.fanout import fan_out, fan_out_ordered
+from app.utils.http_client import TIMING_PHASES, traced_get
+from app.utils.ping_writer import record_ping
 
 patch(requests=True)
 import requests  # noqa
 
 
-def http_check(url, headers, redis_host):
+def http_check(url, headers, redis_host, cold=False):
     """
-    Send a request to a url and return response code, body text and response_time_ms
+    Send a request to a url and return response code, body text, response_time_ms,
+    headers, the request url and the connection trace
     """
     url = urlparse(url)
     if headers:
@@ -30,8 +49,14 @@ def http_check(url, headers, redis_host):
     else:
         headers = {}
 
-    response_code, response_text, response_time_ms, response_headers = process_request(
-        url.scheme, url.netloc + url.path, url.query, headers, redis_host
+    (
+        response_code,
+        response_text,
+        response_time_ms,
+        response_headers,
+        response_trace,
+    ) = process_request(
+        url.scheme, url.netloc + url.path, url.query, headers, redis_host, cold=cold
     )
 
     request_url = f"{url.scheme}://{url.netloc}{url.path}"
@@ -42,6 +67,7 @@ def http_check(url, headers, redis_host):
         response_time_ms,
         response_headers,
         request_url,
+        response_trace,
     )
 
 
@@ -62,7 +88,7 @@ def tcp_check(tcp_endpoint, tcp_port, redis_host):
             domain_response_time_ms="N/A",
             request_url=f"{tcp_endpoint}:{tcp_port}",
         )
-        d.save_ping()
+        record_ping(d)
     except Exception as e:
         conn_info = f"Failed to connect to {tcp_endpoint} on port {tcp_port}: {e}"
         d = DinghyData(
@@ -70,35 +96,398 @@ def tcp_check(tcp_endpoint, tcp_port, redis_host):
             domain_response_code=f"tcp handshake failed: {e}",
             domain_response_time_ms="N/A",
             request_url=f"{tcp_endpoint}:{tcp_port}",
+            error=True,
         )
-        d.save_ping()
+        record_ping(d)
 
     return conn_info
 
 
-def dns_check(domain, nameserver, redis_host):
+def tcp_targets(targets):
     """
-    Check dns resolution results for a given nameserver and domain
+    (host, port) pairs from a list of {"host": ..., "port": ...} targets,
+    raises ValueError on malformed ones
     """
+    pairs = []
+    for target in targets:
+        host = target.get("host") if isinstance(target, dict) else None
+        port = target.get("port") if isinstance(target, dict) else None
+        if not isinstance(host, str) or not host:
+            raise ValueError("targets must have a host")
+        if isinstance(port, bool) or not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError(f"{host} needs a port from 1 to 65535")
+        pairs.append((host, port))
+    return pairs
+
+
+async def _open_any(addresses):
+    """Connect to the first of getaddrinfo's addresses that accepts"""
+    error = None
+    for family, _, proto, _, address in addresses:
+        try:
+            return await asyncio.open_connection(
+                address[0], address[1], family=family, proto=proto
+            )
+        except OSError as e:
+            error = e
+    raise error
 
-    dns_info_A = _gather_dns_A_info(domain, nameserver)
-    dns_info_NS = _gather_dns_NS_info(domain, nameserver)
-    dns_info_MX = _gather_dns_MX_info(domain, nameserver)
+
+async def _tcp_connect(host, port, timeout):
+    """
+    (resolve ms, connect latency ms, error) of one TCP handshake with
+    host:port. The name is resolved first, each step within timeout, so only
+    the handshake is timed. The connect latency is None when resolving failed
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    try:
+        addresses = await asyncio.wait_for(
+            loop.getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout
+        )
+    except (asyncio.TimeoutError, OSError) as e:
+        return (time.perf_counter() - started) * 1000, None, e
+    resolve_ms = (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(_open_any(addresses), timeout)
+    except (asyncio.TimeoutError, OSError) as e:
+        return resolve_ms, (time.perf_counter() - started) * 1000, e
+    latency_ms = (time.perf_counter() - started) * 1000
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return resolve_ms, latency_ms, None
+
+
+async def _scan_tcp(targets, max_in_flight, timeout, results):
+    """Put (position, result) on results as each handshake of targets finishes"""
+    targets = iter(enumerate(targets))
+    loop = asyncio.get_running_loop()
+    in_flight = {}
+
+    def submit(count):
+        for position, (host, port) in itertools.islice(targets, count):
+            task = loop.create_task(_tcp_connect(host, port, timeout))
+            in_flight[task] = (position, host, port)
+
+    try:
+        submit(max_in_flight)
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                position, host, port = in_flight.pop(task)
+                resolve_ms, latency_ms, error = task.result()
+                result = {
+                    "host": host,
+                    "port": port,
+                    "reachable": error is None,
+                    "resolve_ms": round(resolve_ms, 3),
+                    "latency_ms": None if latency_ms is None else round(latency_ms, 3),
+                    "error_class": None if error is None else type(error).__name__,
+                    "error": None if error is None else str(error) or "timed out",
+                }
+                results.put((position, result))
+            submit(len(done))
+    finally:
+        for task in in_flight:
+            task.cancel()
+        if in_flight:
+            await asyncio.wait(in_flight)
+
+
+def scan_tcp(targets, max_in_flight, timeout):
+    """
+    Check TCP handshakes with a batch of (host, port) pairs on an asyncio
+    event loop, at most max_in_flight at once and each within timeout
+    seconds. Names are resolved on a pool of max_in_flight threads, so no
+    lookup waits for a thread. Yields (position, result) tuples as each
+    finishes so callers can stream results or restore the request order.
+    The loop runs in a thread of its own, results queue up for a slow
+    reader instead of holding back the handshakes in flight
+    """
+    results = queue.Queue()
+    loop = asyncio.new_event_loop()
+    resolvers = ThreadPoolExecutor(max_workers=max_in_flight)
+    loop.set_default_executor(resolvers)
+    scan = loop.create_task(_scan_tcp(targets, max_in_flight, timeout, results))
+
+    def run():
+        try:
+            loop.run_until_complete(scan)
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            results.put(e)
+        finally:
+            # lookups that timed out can not be interrupted, leave them to finish
+            resolvers.shutdown(wait=False, cancel_futures=True)
+            loop.close()
+            results.put(None)
+
+    thread = threading.Thread(target=run, name="dinghy-ping-tcp-scan", daemon=True)
+    thread.start()
+    try:
+        while (item := results.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # the client went away mid stream
+        if thread.is_alive():
+            with contextlib.suppress(RuntimeError):
+                loop.call_soon_threadsafe(scan.cancel)
+        thread.join()
+
+
+def dns_record_types(domain, record_types=None):
+    """
+    The record types to look up, all but PTR for a hostname and PTR for an
+    address unless record_types are given. Raises ValueError on unknown types
+    """
+    if not record_types:
+        return ("PTR",) if is_address(domain) else DEFAULT_DNS_RECORD_TYPES
+    unknown = [t for t in record_types if t not in DNS_RECORD_TYPES]
+    if unknown:
+        raise ValueError(
+            f"record types must be some of {', '.join(DNS_RECORD_TYPES)}, "
+            f"not {', '.join(unknown)}"
+        )
+    return tuple(record_types)
+
+
+def dns_lookup(domain, record_type, nameserver=None, timeout=DNS_TIMEOUT):
+    """
+    Look up one record type of domain. Returns the record type, the dns
+    response (None on error), its rcode, query latency, whether it fell back
+    to TCP and the error, lookups do not raise
+    """
+    query = DinghyDNS(
+        domain,
+        rdata_type=dns.rdatatype.from_text(record_type),
+        nameserver=nameserver,
+        timeout=timeout,
+    )
+    started = time.perf_counter()
+    try:
+        response = query.dns_query()
+        error = None
+    except Exception as e:
+        response = None
+        error = str(e) or e.__class__.__name__
+    latency_ms = (time.perf_counter() - started) * 1000
+    return {
+        "record_type": record_type,
+        "response": response,
+        "rcode": None if response is None else dns.rcode.to_text(response.rcode()),
+        "latency_ms": round(latency_ms, 3),
+        "tcp": query.used_tcp,
+        "error": error,
+    }
+
+
+def dns_check(domain, nameserver, redis_host, record_types=None, timeout=DNS_TIMEOUT):
+    """
+    Check dns resolution results for a given nameserver and domain, all
+    record types are looked up concurrently. Returns a dns_lookup result per
+    record type, in record type order
+    """
+    record_types = dns_record_types(domain, record_types)
+    lookups = fan_out_ordered(
+        lambda record_type: dns_lookup(domain, record_type, nameserver, timeout),
+        record_types,
+        max_workers=len(record_types),
+    )
+    results = [result for _, result, _ in lookups]
 
     d = DinghyData(
         redis_host,
         domain_response_code=f"dns lookup for {domain} on {nameserver}",
-        domain_response_time_ms="N/A",
+        domain_response_time_ms=max(r["latency_ms"] for r in results),
+        request_url=domain,
+        error=any(r["error"] for r in results),
+    )
+    record_ping(d)
+
+    return results
+
+
+def dns_answers(response):
+    """(sorted answer rdata, lowest answer TTL) of a dns response"""
+    if response is None:
+        return [], None
+    answers = sorted(rdata.to_text() for rrset in response.answer for rdata in rrset)
+    ttls = [rrset.ttl for rrset in response.answer]
+    return answers, min(ttls) if ttls else None
+
+
+def dns_compare(domain, nameservers, redis_host, record_type="A", timeout=DNS_TIMEOUT):
+    """
+    Send the same lookup to every nameserver concurrently, "system" is the
+    system resolver. Returns a result per nameserver, in order, with its
+    answers, TTL, rcode and latency, and the consensus: the rcode and answers
+    more than half of the nameservers that answered agree on, None when there
+    is no such majority. Lookups that failed have no say in it. Results that
+    differ from the consensus are marked divergent, all of them when there is
+    none
+    """
+    record_type = dns_record_types(domain, [record_type])[0]
+
+    def lookup(nameserver):
+        resolver = None if nameserver == SYSTEM_RESOLVER else nameserver
+        return dns_lookup(domain, record_type, resolver, timeout)
+
+    results = []
+    for nameserver, result, _ in fan_out_ordered(
+        lookup, nameservers, max_workers=len(nameservers)
+    ):
+        answers, ttl = dns_answers(result.pop("response"))
+        result.update(nameserver=nameserver, answers=answers, ttl=ttl)
+        results.append(result)
+
+    answered = [r for r in results if r["error"] is None]
+    outcomes = collections.Counter((r["rcode"], tuple(r["answers"])) for r in answered)
+    consensus = None
+    if outcomes:
+        outcome, count = outcomes.most_common(1)[0]
+        if count * 2 > len(answered):
+            consensus = dict(rcode=outcome[0], answers=list(outcome[1]))
+    for result in results:
+        outcome = (result["rcode"], tuple(result["answers"]))
+        result["divergent"] = consensus is None or outcome != (
+            consensus["rcode"],
+            tuple(consensus["answers"]),
+        )
+
+    d = DinghyData(
+        redis_host,
+        domain_response_code=f"dns compare for {domain} on {', '.join(nameservers)}",
+        domain_response_time_ms=max(r["latency_ms"] for r in results),
         request_url=domain,
+        error=any(r["error"] or r["divergent"] for r in results),
     )
-    d.save_ping()
+    record_ping(d)
 
-    return dns_info_A, dns_info_NS, dns_info_MX
+    return results, consensus
 
 
-def process_request(protocol, domain, params, headers, redis_host):
+def bulk_dns_lookups(names, record_types=None):
+    """
+    The (name, record type) pairs to look up for a batch of names, A (PTR for
+    an address) when no record types are given. Raises ValueError on names
+    that are not strings and on unknown record types
+    """
+    if not all(isinstance(name, str) and name for name in names):
+        raise ValueError("names must be a list of hostnames or addresses")
+    if record_types is not None and not isinstance(record_types, list):
+        raise ValueError("record_types must be a list")
+    if record_types:
+        record_types = dns_record_types("", record_types)
+    return [
+        (name, record_type)
+        for name in names
+        for record_type in record_types or ["PTR" if is_address(name) else "A"]
+    ]
+
+
+def resolve_names(lookups, nameserver, max_workers, timeout, deadline):
+    """
+    Run dns_lookup for a batch of (name, record type) pairs concurrently,
+    yields (position, result) tuples as each lookup finishes so callers can
+    stream results or restore the request order
+    """
+
+    def lookup(entry):
+        _, (name, record_type) = entry
+        return dns_lookup(name, record_type, nameserver, timeout)
+
+    for (position, (name, record_type)), result, error in fan_out(
+        lookup, enumerate(lookups), max_workers=max_workers, deadline=deadline
+    ):
+        if error:
+            result = {
+                "record_type": record_type,
+                "response": None,
+                "rcode": None,
+                "latency_ms": None,
+                "tcp": False,
+                "error": f"{type(error).__name__}: {error}",
+            }
+        answers, ttl = dns_answers(result.pop("response"))
+        yield position, {"name": name, **result, "answers": answers, "ttl": ttl}
+
+
+def ping_domain_entries(domains):
+    """
+    The domains of a /ping/domains batch, checked up front. Raises ValueError
+    unless each is an object with a domain and optional protocol and headers
+    """
+    for entry in domains:
+        if not isinstance(entry, dict) or not entry.get("domain"):
+            raise ValueError("domains must be objects with a domain")
+        if not isinstance(entry["domain"], str):
+            raise ValueError("domain must be a string")
+        if entry.get("protocol") not in (None, "", "http", "https"):
+            raise ValueError(f"{entry['domain']} protocol must be http or https")
+        if not isinstance(entry.get("headers") or {}, dict):
+            raise ValueError(f"{entry['domain']} headers must be an object")
+    return domains
+
+
+def ping_domains(
+    domains, params, redis_host, max_workers, timeout, deadline, cold=False
+):
     """
-    Internal method to run request process, takes protocol and domain for input
+    Run process_request for a batch of domains concurrently, yields
+    (position, result) tuples as each domain finishes so callers can
+    stream results or restore the request order
+    """
+
+    def check(entry):
+        _, domain = entry
+        return process_request(
+            domain.get("protocol", ""),
+            domain["domain"],
+            params,
+            domain.get("headers") or {},
+            redis_host,
+            timeout=timeout,
+            cold=cold,
+        )
+
+    for (position, domain), response, error in fan_out(
+        check, enumerate(domains), max_workers=max_workers, deadline=deadline
+    ):
+        if error:
+            response = ("", f"{type(error).__name__}: {error}", "", {}, {})
+        (
+            response_code,
+            response_text,
+            response_time_ms,
+            response_headers,
+            response_trace,
+        ) = response
+        yield position, {
+            "protocol": domain.get("protocol", ""),
+            "domain": domain["domain"],
+            "domain_response_code": response_code,
+            "domain_response_headers": response_headers,
+            "domain_response_time_ms": response_time_ms,
+            "domain_response_trace": response_trace,
+            # process_request only leaves the code empty when the check failed
+            "error": response_text if response_code == "" else None,
+        }
+
+
+def process_request(
+    protocol, domain, params, headers, redis_host, timeout=5, cold=False
+):
+    """
+    Internal method to run request process, takes protocol and domain for input.
+    Requests go over the worker's pooled keep-alive session unless cold is set
     """
 
     if protocol == "":
@@ -108,15 +497,21 @@ def process_request(protocol, domain, params, headers, redis_host):
     domain_response_text = ""
     domain_response_time_ms = ""
     domain_response_headers = {}
+    domain_response_trace = {"cold_connection": cold}
+    url = check_url(protocol, domain, params)
 
     try:
         # Count how many times a user requests an HTTP check
         datadog.statsd.increment("dinghy_ping_http_connection_check.increment")
-        r = requests.get(
-            f"{protocol}://{domain}", params=params, timeout=5, headers=headers
+        r = traced_get(
+            url,
+            domain_response_trace,
+            timeout=timeout,
+            headers=headers,
         )
     except requests.exceptions.Timeout as err:
         domain_response_text = f"Timeout: {err}"
+        _save_failed_request(redis_host, url, "Timeout")
         # Count how many times a user requests a TCP check
         datadog.statsd.increment(
             "dinghy_ping_event_http_connection_check_fail_timeout.increment"
@@ -126,9 +521,11 @@ def process_request(protocol, domain, params, headers, redis_host):
             domain_response_text,
             domain_response_time_ms,
             domain_response_headers,
+            domain_response_trace,
         )
     except requests.exceptions.TooManyRedirects as err:
         domain_response_text = f"TooManyRedirects: {err}"
+        _save_failed_request(redis_host, url, "TooManyRedirects")
         # Count how many times a user gets TooManyRedirect response
         datadog.statsd.increment(
             "dinghy_ping_event_http_connection_check_fail_redirects.increment"
@@ -138,9 +535,11 @@ def process_request(protocol, domain, params, headers, redis_host):
             domain_response_text,
             domain_response_time_ms,
             domain_response_headers,
+            domain_response_trace,
         )
     except requests.exceptions.RequestException as err:
         domain_response_text = f"RequestException: {err}"
+        _save_failed_request(redis_host, url, "RequestException")
         # Count how many times a user get a request exception with their check
         datadog.statsd.increment(
             "dinghy_ping_event_http_connection_check_fail_exception.increment"
@@ -150,40 +549,65 @@ def process_request(protocol, domain, params, headers, redis_host):
             domain_response_text,
             domain_response_time_ms,
             domain_response_headers,
+            domain_response_trace,
         )
 
     domain_response_code = r.status_code
     domain_response_text = r.text
     domain_response_headers = dict(r.headers)
-    domain_response_time_ms = r.elapsed.microseconds / 1000
+    # elapsed covers the time until the response headers were parsed
+    domain_response_time_ms = round(r.elapsed.total_seconds() * 1000, 3)
+
+    if domain_response_trace["connection_reused"]:
+        datadog.statsd.increment("dinghy_ping_http_connection_reused.increment")
+    else:
+        datadog.statsd.increment("dinghy_ping_http_connection_new.increment")
 
-    d = DinghyData(redis_host, domain_response_code, domain_response_time_ms, r.url)
-    d.save_ping()
+    d = DinghyData(
+        redis_host,
+        domain_response_code,
+        domain_response_time_ms,
+        url,
+        timings={phase: domain_response_trace[phase] for phase in TIMING_PHASES},
+        error=domain_response_code >= 400,
+    )
+    record_ping(d)
 
     return (
         domain_response_code,
         domain_response_text,
         domain_response_time_ms,
         domain_response_headers,
+        domain_response_trace,
     )
 
 
-def get_all_pinged_urls(redis_host):
-    """Get pinged URLs from Dinghy-ping data module"""
-    p = DinghyData(redis_host)
-    return p.get_all_pinged_urls()
+def check_url(protocol, domain, params):
+    """
+    The url an http check requests and is saved under, whether it succeeds or
+    fails, so every check of the same url lands in the same history
+    """
+    url = f"{protocol}://{domain}"
+    try:
+        return requests.Request("GET", url, params=params).prepare().url
+    except requests.exceptions.RequestException:
+        # the check fails on it too, and is saved under the url as given
+        return url
 
 
-def _gather_dns_A_info(domain, nameserver):
-    dns_info_A = DinghyDNS(domain, rdata_type=dns.rdatatype.A, nameserver=nameserver)
-    return dns_info_A.dns_query()
+def _save_failed_request(redis_host, url, reason):
+    """Record a failed http check so it counts towards the url's error rate"""
+    d = DinghyData(redis_host, reason, "N/A", url, error=True)
+    record_ping(d)
 
 
-def _gather_dns_NS_info(domain, nameserver):
-    dns_info_NS = DinghyDNS(domain, rdata_type=dns.rdatatype.NS, nameserver=nameserver)
-    return dns_info_NS.dns_query()
+def get_ping_stats(redis_host, url, window_seconds):
+    """Get latency percentiles and error rate for a pinged URL"""
+    p = DinghyData(redis_host, request_url=url)
+    return p.get_ping_stats(window_seconds)
 
 
-def _gather_dns_MX_info(domain, nameserver):
-    dns_info_MX = DinghyDNS(domain, rdata_type=dns.rdatatype.MX, nameserver=nameserver)
-    return dns_info_MX.dns_query()
+def get_pinged_urls(redis_host, limit, cursor=None):
+    """Get a page of the most recently pinged URLs and the next page cursor"""
+    p = DinghyData(redis_host)
+    return p.get_pinged_urls(limit, cursor)
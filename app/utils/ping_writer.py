@@ -0,0 +1,207 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+
+import datadog
+
+from app.models.dinghy_data import DinghyData, history_cache
+
+POLICIES = ("drop_newest", "drop_oldest", "block")
+
+_writer_settings = {
+    "enabled": True,
+    "queue_size": 10000,
+    "batch_size": 100,
+    "flush_interval": 0.5,
+    "policy": "drop_newest",
+    "block_timeout": 0.1,
+}
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def configure_ping_writer(
+    enabled, queue_size, batch_size, flush_interval, policy, block_timeout
+):
+    """Set the write-behind queue settings used by record_ping"""
+    if policy not in POLICIES:
+        raise ValueError(f"write-behind policy must be one of {', '.join(POLICIES)}")
+    _writer_settings.update(
+        enabled=enabled,
+        queue_size=queue_size,
+        batch_size=batch_size,
+        flush_interval=flush_interval,
+        policy=policy,
+        block_timeout=block_timeout,
+    )
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
+
+
+class PingWriter:
+    """
+    Bounded in-process write-behind queue for DinghyData pings. A background
+    thread flushes queued pings to Redis in pipelined batches of up to
+    batch_size, at least every flush_interval seconds. When the queue is full
+    the policy decides what gives: drop_newest rejects the new ping,
+    drop_oldest evicts the oldest queued ping and block waits up to
+    block_timeout seconds for room before dropping the new one
+    """
+
+    def __init__(
+        self,
+        redis_host,
+        queue_size,
+        batch_size,
+        flush_interval,
+        policy,
+        block_timeout,
+    ):
+        self.redis_host = redis_host
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.counters = {"queued": 0, "flushed": 0, "dropped": 0, "failed": 0}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+        datadog.statsd.increment(
+            f"dinghy_ping_write_behind_{counter}.increment", value=value
+        )
+
+    def _ensure_started(self):
+        # gunicorn --preload forks workers after import, a thread started in
+        # the master does not exist in the worker, start one per process
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                self.queue = queue.Queue(maxsize=self.queue.maxsize)
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._run, name="dinghy-ping-writer", daemon=True
+            )
+            self._thread.start()
+            self._pid = pid
+
+    def put(self, ping):
+        """Queue a ping for writing, returns False if it was dropped"""
+        self._ensure_started()
+        try:
+            if self.policy == "block":
+                self.queue.put(ping, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(ping)
+        except queue.Full:
+            if self.policy != "drop_oldest":
+                self._count("dropped")
+                return False
+            try:
+                self.queue.get_nowait()
+                self._count("dropped")
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(ping)
+            except queue.Full:
+                self._count("dropped")
+                return False
+
+        self._count("queued")
+        return True
+
+    def _drain(self, first):
+        batch = [first]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        try:
+            saved = DinghyData.save_pings(self.redis_host, batch)
+        except Exception:
+            logging.exception("write-behind flush failed")
+            saved = False
+        if saved:
+            self._count("flushed", len(batch))
+        else:
+            self._count("failed", len(batch))
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            self._flush(self._drain(first))
+
+        # Flush whatever is left on the way out
+        while True:
+            try:
+                first = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self._flush(self._drain(first))
+
+    def close(self, timeout=5):
+        """Stop the flush thread after it has written the queued pings"""
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats.update(pending=self.queue.qsize(), policy=self.policy)
+        return stats
+
+
+def get_ping_writer(redis_host):
+    """The process wide write-behind queue for redis_host"""
+    writer = _writers.get(redis_host)
+    if writer is None:
+        with _writers_lock:
+            writer = _writers.get(redis_host)
+            if writer is None:
+                settings = dict(_writer_settings)
+                settings.pop("enabled")
+                writer = PingWriter(redis_host, **settings)
+                _writers[redis_host] = writer
+    return writer
+
+
+def record_ping(ping):
+    """
+    Persist a DinghyData ping off the caller's critical path, through the
+    write-behind queue when it is enabled and synchronously otherwise. Cached
+    history pages are dropped now, and again once the ping is in Redis, a page
+    read in between can miss the ping for up to the flush interval
+    """
+    history_cache.clear()
+    if _writer_settings["enabled"]:
+        get_ping_writer(ping.redis_host).put(ping)
+    else:
+        ping.save_ping()
+
+
+@atexit.register
+def _close_writers():
+    for writer in list(_writers.values()):
+        writer.close()
@@ -0,0 +1,39 @@
+def percentile(sorted_values, q):
+    """
+    q-th percentile (0-100) of an already sorted list, linearly interpolated
+    between the closest ranks
+    """
+    if not sorted_values:
+        return None
+    rank = (len(sorted_values) - 1) * q / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = rank - lower
+    return (
+        sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * fraction
+    )
+
+
+def summarize_samples(samples):
+    """
+    Summarize (response_time_ms, is_error) samples into count, error rate and
+    min/avg/p50/p95/p99 latency. Samples without a response time (tcp, dns and
+    failed checks) only count towards the error rate
+    """
+    times = sorted(t for t, _ in samples if t is not None)
+    errors = sum(1 for _, is_error in samples if is_error)
+
+    def rounded(value):
+        return None if value is None else round(value, 3)
+
+    return {
+        "count": len(samples),
+        "errors": errors,
+        "error_rate": rounded(errors / len(samples)) if samples else None,
+        "min": rounded(times[0]) if times else None,
+        "avg": rounded(sum(times) / len(times)) if times else None,
+        "p50": rounded(percentile(times, 50)),
+        "p95": rounded(percentile(times, 95)),
+        "p99": rounded(percentile(times, 99)),
+        "max": rounded(times[-1]) if times else None,
+    }
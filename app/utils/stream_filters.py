@@ -0,0 +1,131 @@
+import json
+import re
+from urllib.parse import urlencode
+
+# log levels, lowest first
+LEVELS = {
+    "trace": 0,
+    "debug": 1,
+    "info": 2,
+    "warn": 3,
+    "warning": 3,
+    "error": 4,
+    "fatal": 5,
+    "critical": 5,
+}
+_LEVEL_NAMES = "trace|debug|info|warn(?:ing)?|error|fatal|critical"
+# an upper case level word or a level=/"level": field, lower case words like
+# "stack trace" in the message are not levels
+LEVEL_PATTERN = re.compile(
+    rf'\b(?:({_LEVEL_NAMES.upper()})|level"?\s*[=:]\s*"?((?i:{_LEVEL_NAMES})))\b'
+)
+
+LOG_FILTER_ARGS = ("include", "exclude", "regex", "level", "sample")
+MAX_FILTER_PATTERNS = 20
+MAX_FILTER_PATTERN_LENGTH = 200
+# a repeated group that repeats inside, like (a+)+, backtracks exponentially
+NESTED_QUANTIFIER = re.compile(r"[*+?}]\)[*+{]")
+EVENT_FILTER_ARGS = ("type", "reason")
+
+
+def filter_query(args, names):
+    """The filter query params in args, to pass on to a websocket url"""
+    return urlencode([(name, value) for name in names for value in args.getlist(name)])
+
+
+def _compile(patterns, regex):
+    """One compiled alternation of patterns, None when there are none"""
+    if not patterns:
+        return None
+    if len(patterns) > MAX_FILTER_PATTERNS:
+        raise ValueError(f"at most {MAX_FILTER_PATTERNS} filter patterns")
+    for pattern in patterns:
+        if len(pattern) > MAX_FILTER_PATTERN_LENGTH:
+            raise ValueError(
+                f"filter patterns must be at most {MAX_FILTER_PATTERN_LENGTH} long"
+            )
+        if regex and NESTED_QUANTIFIER.search(pattern):
+            raise ValueError(f"bad filter pattern: nested repeat in {pattern}")
+    if not regex:
+        patterns = [re.escape(pattern) for pattern in patterns]
+    try:
+        return re.compile("|".join(f"(?:{pattern})" for pattern in patterns))
+    except re.error as e:
+        raise ValueError(f"bad filter pattern: {e}")
+
+
+class LogFilter:
+    """
+    Decides per subscriber which log lines are sent. Lines must match one of
+    include and none of exclude, substrings or with regex regular
+    expressions. With level, lines with a lower log level are dropped, lines
+    without one are kept. With sample n only every nth line
+    that passes is kept. Compiled once per stream, called once per line.
+    Patterns are capped in number and length and regular expressions with
+    nested repeats are refused
+    """
+
+    def __init__(self, include=(), exclude=(), regex=False, level=None, sample=1):
+        self.include = _compile(include, regex)
+        self.exclude = _compile(exclude, regex)
+        if level is not None and level.lower() not in LEVELS:
+            raise ValueError(f"level must be one of {', '.join(LEVELS)}")
+        self.min_level = LEVELS[level.lower()] if level else None
+        if sample < 1:
+            raise ValueError("sample must be 1 or more")
+        self.sample = sample
+        self._passed = 0
+
+    @classmethod
+    def from_args(cls, args):
+        """From include, exclude, regex, level and sample query params"""
+        try:
+            sample = int(args.get("sample", 1))
+        except ValueError:
+            raise ValueError("sample must be an integer")
+        return cls(
+            include=args.getlist("include"),
+            exclude=args.getlist("exclude"),
+            regex="regex" in args,
+            level=args.get("level"),
+            sample=sample,
+        )
+
+    def __call__(self, line):
+        if self.include is not None and not self.include.search(line):
+            return False
+        if self.exclude is not None and self.exclude.search(line):
+            return False
+        if self.min_level is not None:
+            match = LEVEL_PATTERN.search(line)
+            level = match and (match.group(1) or match.group(2)).lower()
+            if level and LEVELS[level] < self.min_level:
+                return False
+        if self.sample > 1:
+            self._passed += 1
+            return self._passed % self.sample == 1
+        return True
+
+
+class EventFilter:
+    """
+    Decides per subscriber which events are sent, by event type (Normal,
+    Warning) and reason. Empty means any
+    """
+
+    def __init__(self, types=(), reasons=()):
+        self.types = {t.lower() for t in types}
+        self.reasons = {r.lower() for r in reasons}
+
+    @classmethod
+    def from_args(cls, args):
+        """From type and reason query params"""
+        return cls(types=args.getlist("type"), reasons=args.getlist("reason"))
+
+    def __call__(self, message):
+        event = json.loads(message)
+        if self.types and (event.get("Type") or "").lower() not in self.types:
+            return False
+        if self.reasons and (event.get("Reason") or "").lower() not in self.reasons:
+            return False
+        return True
@@ -0,0 +1,314 @@
+import collections
+import logging
+import queue
+import threading
+import time
+
+import datadog
+
+# Sent to subscribers when the upstream ends, no more messages follow
+END = object()
+
+OVERFLOW_POLICIES = ("drop_oldest", "disconnect")
+
+_hub_settings = {"subscriber_queue_size": 1000, "overflow_policy": "drop_oldest"}
+_hubs = {}
+_hubs_lock = threading.Lock()
+
+
+def configure_stream_hubs(subscriber_queue_size, overflow_policy):
+    """
+    Set the per subscriber buffer size of the streaming hubs and what happens
+    to a subscriber that fills it
+    """
+    if overflow_policy not in OVERFLOW_POLICIES:
+        raise ValueError(
+            f"stream overflow policy must be one of {', '.join(OVERFLOW_POLICIES)}"
+        )
+    _hub_settings.update(
+        subscriber_queue_size=subscriber_queue_size, overflow_policy=overflow_policy
+    )
+    with _hubs_lock:
+        for hub in _hubs.values():
+            hub.close()
+        _hubs.clear()
+
+
+class Subscription:
+    """
+    One viewer of a topic, a bounded send queue of the topic's messages. Its
+    accept filter runs as the viewer reads them, in the viewer's thread, so a
+    slow filter holds up no one else. When the viewer falls queue_size
+    messages behind, the drop_oldest policy drops the oldest queued message
+    and the disconnect policy marks the subscription overflowed so the viewer
+    can be disconnected
+    """
+
+    def __init__(self, topic, queue_size, overflow_policy, accept=None):
+        self.topic = topic
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflow_policy = overflow_policy
+        self.accept = accept
+        self.overflowed = False
+
+    def put(self, message):
+        while not self.overflowed:
+            try:
+                self.queue.put_nowait(message)
+                return
+            except queue.Full:
+                if self.overflow_policy == "disconnect":
+                    self.overflowed = True
+                try:
+                    self.queue.get_nowait()
+                    self.topic.hub.count("lines_dropped")
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        Next message the accept filter lets through, END once the upstream is
+        gone, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            try:
+                message = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return None
+            if message is END or self._accepts(message):
+                return message
+            self.topic.hub.count("lines_filtered")
+
+    def _accepts(self, message):
+        if self.accept is None:
+            return True
+        try:
+            return self.accept(message)
+        except Exception:
+            logging.exception(f"{self.topic.hub.name} filter failed on {message!r}")
+            return False
+
+    def get_frame(self, max_bytes, window, timeout=None):
+        """
+        Coalesce queued messages into one frame. Waits up to timeout for a
+        first message, then collects more until their utf-8 encoding adds up to
+        max_bytes or window seconds have passed. Empty on timeout, END is the last message
+        once the upstream is gone
+        """
+        message = self.get(timeout)
+        if message is None:
+            return []
+        frame = [message]
+        size = 0 if message is END else len(message.encode("utf-8"))
+        deadline = time.monotonic() + window
+        while message is not END and size < max_bytes:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            message = self.get(remaining)
+            if message is None:
+                break
+            frame.append(message)
+            if message is not END:
+                size += len(message.encode("utf-8"))
+        return frame
+
+    def sent(self, messages, frames=1):
+        """Count messages sent to the viewer in frames"""
+        self.topic.hub.count("lines_sent", messages)
+        self.topic.hub.count("frames_sent", frames)
+
+
+class Topic:
+    """
+    One upstream stream and its subscribers. The upstream runs in its own
+    thread and publishes messages, the last replay_size of which are kept for
+    subscribers that join later
+    """
+
+    def __init__(self, hub, key, replay_size):
+        self.hub = hub
+        self.key = key
+        self.subscribers = set()
+        self.replay = collections.deque(maxlen=replay_size)
+        self.published = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._closers = []
+        self._ended = False
+
+    @property
+    def stopped(self):
+        return self._stopped.is_set()
+
+    def on_stop(self, closer):
+        """Call closer when the last subscriber leaves, to unblock the upstream"""
+        with self._lock:
+            self._closers.append(closer)
+            if not self.stopped:
+                return
+        closer()
+
+    def publish(self, message):
+        with self._lock:
+            self.replay.append(message)
+            self.published += 1
+            for subscription in self.subscribers:
+                subscription.put(message)
+
+    def _subscribe(self, queue_size, overflow_policy, accept):
+        subscription = Subscription(self, queue_size, overflow_policy, accept)
+        with self._lock:
+            for message in self.replay:
+                subscription.put(message)
+            if self._ended:
+                subscription.put(END)
+            self.subscribers.add(subscription)
+        return subscription
+
+    def _end(self):
+        with self._lock:
+            self._ended = True
+            for subscription in self.subscribers:
+                subscription.put(END)
+
+    def stop(self):
+        with self._lock:
+            self._stopped.set()
+            closers = list(self._closers)
+        for closer in closers:
+            try:
+                closer()
+            except Exception:
+                logging.exception(f"closing {self.hub.name} upstream {self.key}")
+
+    def run(self, upstream):
+        try:
+            upstream(self.key, self)
+        except Exception:
+            if not self.stopped:
+                logging.exception(f"{self.hub.name} upstream {self.key} failed")
+        finally:
+            self._end()
+            self.hub._forget(self)
+
+
+class StreamHub:
+    """
+    Shares one upstream stream per key between every subscriber in the
+    process. upstream(key, topic) runs in a background thread for as long as
+    the key has subscribers, publishing messages with topic.publish and
+    registering with topic.on_stop how to unblock it. The topic's
+    subscribers are reference counted, the upstream is stopped when the last
+    one unsubscribes
+    """
+
+    def __init__(
+        self, name, upstream, replay_size, subscriber_queue_size, overflow_policy
+    ):
+        self.name = name
+        self.upstream = upstream
+        self.replay_size = replay_size
+        self.subscriber_queue_size = subscriber_queue_size
+        self.overflow_policy = overflow_policy
+        self.topics = {}
+        self.counters = {
+            "upstreams_started": 0,
+            "lines_sent": 0,
+            "lines_dropped": 0,
+            "lines_filtered": 0,
+            "frames_sent": 0,
+            "disconnected": 0,
+        }
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()
+
+    def count(self, counter, value=1):
+        with self._counters_lock:
+            self.counters[counter] += value
+        datadog.statsd.increment(
+            f"dinghy_ping_{self.name}_hub_{counter}.increment", value=value
+        )
+
+    def subscribe(self, key, accept=None):
+        """
+        Subscribe to key, starting its upstream if needed. accept(message),
+        called in the thread reading the subscription, filters what the
+        subscriber is sent
+        """
+        with self._lock:
+            topic = self.topics.get(key)
+            if topic is not None:
+                return topic._subscribe(
+                    self.subscriber_queue_size, self.overflow_policy, accept
+                )
+
+            topic = Topic(self, key, self.replay_size)
+            self.topics[key] = topic
+            # subscribe before the upstream starts publishing
+            subscription = topic._subscribe(
+                self.subscriber_queue_size, self.overflow_policy, accept
+            )
+            threading.Thread(
+                target=topic.run,
+                args=(self.upstream,),
+                name=f"dinghy-ping-{self.name}-hub",
+                daemon=True,
+            ).start()
+        self.count("upstreams_started")
+        return subscription
+
+    def unsubscribe(self, subscription):
+        topic = subscription.topic
+        with self._lock:
+            with topic._lock:
+                topic.subscribers.discard(subscription)
+                if topic.subscribers:
+                    return
+            if self.topics.get(topic.key) is topic:
+                del self.topics[topic.key]
+        topic.stop()
+
+    def _forget(self, topic):
+        # the upstream ended on its own, the next subscriber starts a new one
+        with self._lock:
+            if self.topics.get(topic.key) is topic:
+                del self.topics[topic.key]
+
+    def close(self):
+        with self._lock:
+            topics = list(self.topics.values())
+            self.topics.clear()
+        for topic in topics:
+            topic.stop()
+
+    def stats(self):
+        with self._lock:
+            topics = list(self.topics.values())
+        with self._counters_lock:
+            stats = dict(self.counters)
+        stats.update(upstreams=len(topics), subscribers=0)
+        for topic in topics:
+            with topic._lock:
+                stats["subscribers"] += len(topic.subscribers)
+        return stats
+
+
+def get_hub(name, upstream, replay_size):
+    """The process wide hub called name"""
+    hub = _hubs.get(name)
+    if hub is None:
+        with _hubs_lock:
+            hub = _hubs.get(name)
+            if hub is None:
+                hub = StreamHub(name, upstream, replay_size, **_hub_settings)
+                _hubs[name] = hub
+    return hub
+
+
+def hub_stats():
+    """Upstream and subscriber counts of the hubs this process has started"""
+    return {name: hub.stats() for name, hub in list(_hubs.items())}
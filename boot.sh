@@ -1,2 +1,5 @@
 #!/bin/bash
-exec ddtrace-run gunicorn --worker-tmp-dir /dev/shm --preload -w 3 --timeout 200 -b 0.0.0.0:80 -b 0.0.0.0:8080 --access-logfile - --error-logfile - --log-level info dinghyping:app
+# gthread workers serve each request and websocket in its own thread, so open
+# log and event streams do not hold a whole worker. GUNICORN_WORKERS x
+# GUNICORN_THREADS is how many streams and requests a pod serves at once
+exec ddtrace-run gunicorn --worker-tmp-dir /dev/shm --preload -k gthread -w "${GUNICORN_WORKERS:-3}" --threads "${GUNICORN_THREADS:-500}" --worker-connections "${GUNICORN_THREADS:-500}" --timeout 200 -b 0.0.0.0:80 -b 0.0.0.0:8080 --access-logfile - --error-logfile - --log-level info dinghyping:app
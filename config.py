@@ -12,8 +12,57 @@ class Config(object):
     REDIS_HOST = (
         os.environ.get("REDIS_HOST") or "dinghy-ping-redis.default.svc.cluster.local"
     )
+    REDIS_MAX_CONNECTIONS = os.environ.get("REDIS_MAX_CONNECTIONS") or "20"
+    REDIS_POOL_TIMEOUT = os.environ.get("REDIS_POOL_TIMEOUT") or "5"
+    REDIS_SOCKET_TIMEOUT = os.environ.get("REDIS_SOCKET_TIMEOUT") or "5"
+    REDIS_HEALTH_CHECK_INTERVAL = os.environ.get("REDIS_HEALTH_CHECK_INTERVAL") or "30"
+    WRITE_BEHIND_ENABLED = os.environ.get("WRITE_BEHIND_ENABLED") or "True"
+    WRITE_BEHIND_QUEUE_SIZE = os.environ.get("WRITE_BEHIND_QUEUE_SIZE") or "10000"
+    WRITE_BEHIND_BATCH_SIZE = os.environ.get("WRITE_BEHIND_BATCH_SIZE") or "100"
+    WRITE_BEHIND_FLUSH_INTERVAL = os.environ.get("WRITE_BEHIND_FLUSH_INTERVAL") or "0.5"
+    # drop_newest, drop_oldest or block
+    WRITE_BEHIND_POLICY = os.environ.get("WRITE_BEHIND_POLICY") or "drop_newest"
+    WRITE_BEHIND_BLOCK_TIMEOUT = os.environ.get("WRITE_BEHIND_BLOCK_TIMEOUT") or "0.1"
+    # json (ReJSON module) or hash (stock Redis), see app.models.ping_codec
+    PING_STORAGE_CODEC = os.environ.get("PING_STORAGE_CODEC") or "json"
+    HISTORY_RETENTION_SECONDS = os.environ.get("HISTORY_RETENTION_SECONDS") or "604800"
+    HISTORY_MAX_SAMPLES = os.environ.get("HISTORY_MAX_SAMPLES") or "1000"
+    HISTORY_CACHE_TTL = os.environ.get("HISTORY_CACHE_TTL") or "5"
+    HISTORY_CACHE_SIZE = os.environ.get("HISTORY_CACHE_SIZE") or "128"
+    HISTORY_PAGE_SIZE = os.environ.get("HISTORY_PAGE_SIZE") or "100"
+    HISTORY_MAX_PAGE_SIZE = os.environ.get("HISTORY_MAX_PAGE_SIZE") or "1000"
+    STREAM_SUBSCRIBER_QUEUE_SIZE = (
+        os.environ.get("STREAM_SUBSCRIBER_QUEUE_SIZE") or "1000"
+    )
+    # drop_oldest or disconnect a viewer that falls a full queue behind
+    STREAM_OVERFLOW_POLICY = os.environ.get("STREAM_OVERFLOW_POLICY") or "drop_oldest"
+    STREAM_FRAME_MAX_BYTES = os.environ.get("STREAM_FRAME_MAX_BYTES") or "16384"
+    STREAM_FRAME_WINDOW_MS = os.environ.get("STREAM_FRAME_WINDOW_MS") or "50"
+    EVENT_REPLAY_SIZE = os.environ.get("EVENT_REPLAY_SIZE") or "200"
+    LOGS_MAX_BYTES = os.environ.get("LOGS_MAX_BYTES") or "1048576"
+    DEPLOYMENT_LOGS_CONCURRENCY = os.environ.get("DEPLOYMENT_LOGS_CONCURRENCY") or "10"
+    DEPLOYMENTS_PAGE_SIZE = os.environ.get("DEPLOYMENTS_PAGE_SIZE") or "100"
+    DEPLOYMENTS_MAX_PAGE_SIZE = os.environ.get("DEPLOYMENTS_MAX_PAGE_SIZE") or "1000"
+    INFORMER_ENABLED = os.environ.get("INFORMER_ENABLED") or "True"
+    INFORMER_RESYNC_SECONDS = os.environ.get("INFORMER_RESYNC_SECONDS") or "300"
+    INFORMER_MAX_STALENESS = os.environ.get("INFORMER_MAX_STALENESS") or "600"
+    INFORMER_SYNC_TIMEOUT = os.environ.get("INFORMER_SYNC_TIMEOUT") or "5"
     ENVIRONMENT = os.environ.get("ENVIRONMENT") or "none"
     TAIL_LINES_DEFAULT = os.environ.get("TAIL_LINES_DEFAULT") or "100"
+    DNS_TIMEOUT = os.environ.get("DNS_TIMEOUT") or "2"
+    DNS_BULK_CONCURRENCY = os.environ.get("DNS_BULK_CONCURRENCY") or "50"
+    DNS_BULK_DEADLINE = os.environ.get("DNS_BULK_DEADLINE") or "30"
+    DNS_BULK_MAX_LOOKUPS = os.environ.get("DNS_BULK_MAX_LOOKUPS") or "5000"
+    DNS_COMPARE_MAX_NAMESERVERS = os.environ.get("DNS_COMPARE_MAX_NAMESERVERS") or "20"
+    TCP_BULK_CONCURRENCY = os.environ.get("TCP_BULK_CONCURRENCY") or "200"
+    TCP_BULK_TIMEOUT = os.environ.get("TCP_BULK_TIMEOUT") or "5"
+    TCP_BULK_MAX_TARGETS = os.environ.get("TCP_BULK_MAX_TARGETS") or "5000"
+    PING_DOMAINS_CONCURRENCY = os.environ.get("PING_DOMAINS_CONCURRENCY") or "10"
+    PING_DOMAINS_TIMEOUT = os.environ.get("PING_DOMAINS_TIMEOUT") or "5"
+    PING_DOMAINS_DEADLINE = os.environ.get("PING_DOMAINS_DEADLINE") or "30"
+    PING_DOMAINS_MAX = os.environ.get("PING_DOMAINS_MAX") or "500"
+    HTTP_POOL_CONNECTIONS = os.environ.get("HTTP_POOL_CONNECTIONS") or "50"
+    HTTP_POOL_MAXSIZE = os.environ.get("HTTP_POOL_MAXSIZE") or "10"
     LOGS_PREVIEW_LENGTH = os.environ.get("LOGS_PREVIEW_LENGTH") or "1000"
     DD_TRACE_ENABLED = os.environ.get("DD_TRACE_ENABLED") or "False"
     DD_DOGSTATSD_DISABLE = os.environ.get("DD_DOGSTATSD_DISABLE") or None
@@ -1,8 +1,9 @@
-from app import create_app
+from app import cli, create_app
 from app.models.dinghy_data import DinghyData
 from app.models.dinghy_dns import DinghyDNS
 
 app = create_app()
+cli.register(app)
 
 
 @app.shell_context_processor
@@ -0,0 +1,106 @@
+"""
+Compare the old name prefix matching of deployment pods to ReplicaSets with
+the owner reference UID index used by /get/deployment-details, on a synthetic
+namespace. No cluster needed.
+
+    python local_development_scripts/benchmark_deployment_pods.py --pods 5000 --deployments 250
+"""
+import argparse
+import os
+import sys
+import time
+
+from kubernetes import client
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.utils.k8s import match_deployment_pods  # noqa: E402
+
+
+def owner(uid):
+    return [client.V1OwnerReference(api_version="v1", kind="x", name="x", uid=uid)]
+
+
+def synthetic_namespace(pod_count, deployment_count):
+    """Deployments with two ReplicaSets each, pods spread over the ready ones"""
+    replica_sets = []
+    pods = []
+    for d in range(deployment_count):
+        for revision in range(2):
+            replicas = pod_count // deployment_count if revision else 0
+            replica_sets.append(
+                client.V1ReplicaSet(
+                    metadata=client.V1ObjectMeta(
+                        name=f"service-{d}-{revision}abc",
+                        uid=f"rs-{d}-{revision}",
+                        owner_references=owner(f"deployment-{d}"),
+                    ),
+                    status=client.V1ReplicaSetStatus(
+                        replicas=replicas,
+                        available_replicas=replicas,
+                        ready_replicas=replicas,
+                    ),
+                )
+            )
+    for p in range(pod_count):
+        d = p % deployment_count
+        pods.append(
+            client.V1Pod(
+                metadata=client.V1ObjectMeta(
+                    name=f"service-{d}-1abc-{p}",
+                    owner_references=owner(f"rs-{d}-1"),
+                ),
+                spec=client.V1PodSpec(containers=[client.V1Container(name="app")]),
+            )
+        )
+    return replica_sets, pods
+
+
+def prefix_match(name, deployment_uid, replica_sets, pods):
+    """The matching /get/deployment-details did before the UID index"""
+    ready = []
+    for rs in replica_sets:
+        if not bool(rs.status.replicas):
+            continue
+        owned = any(ref.uid == deployment_uid for ref in rs.metadata.owner_references)
+        if owned and rs.status.available_replicas == rs.status.ready_replicas:
+            ready.append(rs)
+    all_pods = {}
+    for pod in pods:
+        if pod.metadata.name.startswith(name):
+            for rs in ready:
+                if pod.metadata.name.startswith(rs.metadata.name):
+                    all_pods[pod.metadata.name] = pod.to_dict()
+    return all_pods
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--pods", type=int, default=5000)
+    parser.add_argument("--deployments", type=int, default=250)
+    args = parser.parse_args()
+
+    replica_sets, pods = synthetic_namespace(args.pods, args.deployments)
+    # the old page listed the whole namespace, the new one lists by selector
+    selected = [p for p in pods if p.metadata.name.startswith("service-7-")]
+    selected_rs = [
+        rs for rs in replica_sets if rs.metadata.name.startswith("service-7-")
+    ]
+
+    old, old_ms = timed(prefix_match, "service-7", "deployment-7", replica_sets, pods)
+    new, new_ms = timed(match_deployment_pods, "deployment-7", selected_rs, selected)
+    assert set(old) == set(new)
+
+    print(f"{args.pods} pods, {args.deployments} deployments, {len(new)} matched")
+    print(f"prefix loops + to_dict: {old_ms:.1f} ms")
+    print(f"selector + uid index:   {new_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Compare the ping record storage codecs: memory per record and pipelined
+read/write throughput. Point it at a scratch Redis, it writes and then deletes
+bench:<codec>:* keys. The json codec is skipped if the ReJSON module is missing.
+
+    REDIS_HOST=localhost python local_development_scripts/benchmark_ping_codecs.py --records 100000
+"""
+import argparse
+import os
+import sys
+import time
+
+import redis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.models.ping_codec import CODECS  # noqa: E402
+
+BATCH_SIZE = 1000
+
+
+def sample_record(i):
+    return {
+        "response_time_ms": round(20 + i % 500 * 0.731, 3),
+        "response_code": 200 if i % 10 else 503,
+        "timings": {
+            "dns_ms": 1.204,
+            "connect_ms": 10.51,
+            "tls_ms": 31.877,
+            "ttfb_ms": 45.012,
+            "transfer_ms": 2.3,
+        },
+    }
+
+
+def used_memory(r):
+    return r.info("memory")["used_memory"]
+
+
+def delete_keys(r, pattern):
+    for key in r.scan_iter(pattern, count=BATCH_SIZE):
+        r.unlink(key)
+
+
+def benchmark(r, codec, records):
+    keys = [
+        f"bench:{codec.name}:https://service-{i}.example.com/health"
+        for i in range(records)
+    ]
+    delete_keys(r, f"bench:{codec.name}:*")
+    memory_before = used_memory(r)
+
+    started = time.perf_counter()
+    for start in range(0, records, BATCH_SIZE):
+        with r.pipeline(transaction=False) as pipe:
+            for i in range(start, min(start + BATCH_SIZE, records)):
+                codec.write(pipe, keys[i], sample_record(i))
+            pipe.execute()
+    write_seconds = time.perf_counter() - started
+
+    memory_after = used_memory(r)
+
+    started = time.perf_counter()
+    for start in range(0, records, BATCH_SIZE):
+        end = start + BATCH_SIZE
+        codec.read_many(r, keys[start:end])
+    read_seconds = time.perf_counter() - started
+
+    delete_keys(r, f"bench:{codec.name}:*")
+
+    bytes_per_record = (memory_after - memory_before) / records
+    return {
+        "codec": codec.name,
+        "bytes_per_record": bytes_per_record,
+        "memory_mb_per_100k": bytes_per_record * 100000 / 2**20,
+        "writes_per_second": records / write_seconds,
+        "reads_per_second": records / read_seconds,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--records", type=int, default=100000)
+    parser.add_argument("--host", default=os.environ.get("REDIS_HOST", "localhost"))
+    args = parser.parse_args()
+
+    r = redis.StrictRedis(host=args.host)
+    for codec in CODECS.values():
+        try:
+            result = benchmark(r, codec, args.records)
+        except redis.exceptions.ResponseError as err:
+            print(f"{codec.name}: skipped ({err})")
+            continue
+        print(
+            "{codec}: {bytes_per_record:.0f} bytes/record, "
+            "{memory_mb_per_100k:.1f} MB per 100k records, "
+            "{writes_per_second:.0f} writes/s, {reads_per_second:.0f} reads/s".format(
+                **result
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
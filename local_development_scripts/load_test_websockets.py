@@ -0,0 +1,136 @@
+"""
+Open many idle websocket streams against one running dinghy-ping and measure
+the latency normal HTTP routes see while they are held, compared to a baseline
+taken before any stream is open. Point it at a single pod, e.g. through
+kubectl port-forward, and raise ulimit -n for more than ~1000 streams.
+
+    kubectl port-forward deploy/dinghy-ping 8080:80
+    python local_development_scripts/load_test_websockets.py --streams 2000
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import simple_websocket
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from app.utils.stats import summarize_samples  # noqa: E402
+
+
+def open_stream(url):
+    """(websocket or None, connect time ms)"""
+    started = time.perf_counter()
+    try:
+        ws = simple_websocket.Client(url)
+    except Exception:
+        return None, None
+    return ws, (time.perf_counter() - started) * 1000
+
+
+def drain(ws, stop):
+    """Read and discard what the server sends, like an idle browser tab"""
+    while not stop.is_set() and ws.connected:
+        try:
+            ws.receive(timeout=1)
+        except Exception:
+            return
+
+
+def http_sample(url, timeout):
+    """(response time ms, is_error) of one GET"""
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            resp.read()
+            error = resp.status >= 400
+    except Exception:
+        error = True
+    return (time.perf_counter() - started) * 1000, error
+
+
+def http_load(urls, requests, concurrency, timeout):
+    with ThreadPoolExecutor(concurrency) as pool:
+        jobs = [urls[i % len(urls)] for i in range(requests)]
+        return list(pool.map(lambda url: http_sample(url, timeout), jobs))
+
+
+def report(label, summary):
+    print(
+        f"{label:<24} n={summary['count']} errors={summary['errors']} "
+        f"p50={summary['p50']}ms p95={summary['p95']}ms p99={summary['p99']}ms "
+        f"max={summary['max']}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--base-url", default="http://127.0.0.1:8080")
+    parser.add_argument(
+        "--ws-path", default="/ws/event-stream?namespace=default&filter=all"
+    )
+    parser.add_argument("--streams", type=int, default=1000)
+    parser.add_argument("--connect-concurrency", type=int, default=50)
+    parser.add_argument(
+        "--http-path",
+        action="append",
+        help="route to time while the streams are open, repeatable "
+        "(default /health and /)",
+    )
+    parser.add_argument("--http-requests", type=int, default=500)
+    parser.add_argument("--http-concurrency", type=int, default=10)
+    parser.add_argument("--http-timeout", type=float, default=10)
+    parser.add_argument(
+        "--hold", type=float, default=10, help="seconds to hold the streams open"
+    )
+    args = parser.parse_args()
+
+    base_url = args.base_url.rstrip("/")
+    ws_url = base_url.replace("http", "ws", 1) + args.ws_path
+    http_urls = [base_url + path for path in args.http_path or ["/health", "/"]]
+
+    baseline = http_load(
+        http_urls, args.http_requests, args.http_concurrency, args.http_timeout
+    )
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.connect_concurrency) as pool:
+        opened = list(pool.map(open_stream, [ws_url] * args.streams))
+    connect_seconds = time.perf_counter() - started
+    streams = [ws for ws, _ in opened if ws is not None]
+    connects = [(ms, ms is None) for _, ms in opened]
+
+    stop = threading.Event()
+    for ws in streams:
+        threading.Thread(target=drain, args=(ws, stop), daemon=True).start()
+
+    deadline = time.monotonic() + args.hold
+    loaded = http_load(
+        http_urls, args.http_requests, args.http_concurrency, args.http_timeout
+    )
+    time.sleep(max(0, deadline - time.monotonic()))
+    held = sum(1 for ws in streams if ws.connected)
+
+    stop.set()
+    for ws in streams:
+        try:
+            ws.close()
+        except Exception:
+            pass
+
+    print(f"{ws_url}")
+    print(
+        f"streams opened {len(streams)}/{args.streams} in {connect_seconds:.1f}s, "
+        f"still open after {args.hold:.0f}s: {held}"
+    )
+    report("websocket connect", summarize_samples(connects))
+    report("http, no streams", summarize_samples(baseline))
+    report(f"http, {held} streams", summarize_samples(loaded))
+
+
+if __name__ == "__main__":
+    main()
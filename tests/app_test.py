@@ -1,8 +1,44 @@
+import contextlib
+import heapq
 import json
+import queue
+import socket
+import ssl
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from operator import itemgetter
+from types import SimpleNamespace
+from urllib.parse import quote
 
+import dns.flags
+import dns.message
+import fakeredis
 import pytest
+import redis
+from kubernetes.client import V1LabelSelector, V1LabelSelectorRequirement
+from kubernetes.client.rest import ApiException
 
 from app import create_app
+from app.main import routes, ws
+from app.models import dinghy_data, dinghy_dns
+from app.models.dinghy_data import DinghyData, history_cache
+from app.models.ping_codec import CODECS, get_codec
+from app.utils import informer, k8s, network, ping_writer
+from app.utils.fanout import DeadlineExceeded, fan_out
+from app.utils.http_client import TIMING_PHASES, get_session, traced_get
+from app.utils.k8s import label_selector, sort_deployments
+from app.utils.log_cursor import CursorFilter, CursorTracker, make_cursor
+from app.utils.network import (
+    bulk_dns_lookups,
+    dns_record_types,
+    scan_tcp,
+    tcp_targets,
+)
+from app.utils.ping_writer import PingWriter
+from app.utils.stats import summarize_samples
+from app.utils.stream_filters import LogFilter
+from app.utils.stream_hub import END, StreamHub, Topic
 from config import Config
 
 
@@ -14,6 +50,50 @@ with open("tests/multiple_domains.json") as f:
     multiple_domains = json.load(f)
 
 
+class EchoCookieHandler(BaseHTTPRequestHandler):
+    """Keep-alive handler that sets a cookie and echoes the cookies it got"""
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = (self.headers.get("Cookie") or "").encode()
+        self.send_response(200)
+        self.send_header("Set-Cookie", "session=abc; Path=/")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LargeBodyHandler(EchoCookieHandler):
+    def do_GET(self):
+        body = b"x" * 65536
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextlib.contextmanager
+def local_http_server(handler=EchoCookieHandler, tls=False):
+    """A local server, over TLS with the self-signed tests/localhost.pem"""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    scheme = "http"
+    if tls:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain("tests/localhost.pem")
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = "https"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"{scheme}://localhost:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
 @pytest.fixture
 def app():
     app = create_app(TestConfig)
@@ -50,3 +130,1105 @@ def test_dinghy_ping_google_https_and_query_params(client):
         "/ping/https/www.google.com/search?source=hp&ei=aIHTW9mLNuOJ0gK8g624Ag&q=dinghy&btnK=Google+Search&oq=dinghy&gs_l=psy-ab.3..35i39l2j0i131j0i20i264j0j0i20i264j0l4.4754.5606..6143...1.0..0.585.957.6j5-1......0....1..gws-wiz.....6..0i67j0i131i20i264.oe0qJ9brs-8"  # noqa
     )
     assert r.status_code == 200
+
+
+def test_dinghy_ping_multiple_domains(client):
+    r = client.post("/ping/domains", json=multiple_domains)
+    assert r.status_code == 200
+    results = r.get_json()["domains_response_results"]
+    assert [result["domain"] for result in results] == [
+        domain["domain"] for domain in multiple_domains["domains"]
+    ]
+
+
+def test_dinghy_ping_multiple_domains_ndjson_stream(client):
+    r = client.post("/ping/domains", json=dict(multiple_domains, stream=True))
+    assert r.status_code == 200
+    assert r.mimetype == "application/x-ndjson"
+    results = [json.loads(line) for line in r.get_data(as_text=True).splitlines()]
+    assert len(results) == len(multiple_domains["domains"])
+
+
+def test_dinghy_ping_multiple_domains_bad_request(client):
+    r = client.post("/ping/domains", json={"domains": "github.com"})
+    assert r.status_code == 400
+    for domains in (["github.com"], [{"protocol": "https"}], [{"domain": 1}]):
+        r = client.post("/ping/domains", json={"domains": domains})
+        assert r.status_code == 400
+    for limits in (
+        {"deadline": 0},
+        {"timeout": -1},
+        {"concurrency": "x"},
+        {"cold": "false"},
+    ):
+        r = client.post("/ping/domains", json=dict(multiple_domains, **limits))
+        assert r.status_code == 400
+
+
+def test_fan_out_deadline_fails_unfinished_items():
+    started = time.monotonic()
+    results = list(fan_out(time.sleep, [0, 5, 5], max_workers=3, deadline=0.2))
+    assert time.monotonic() - started < 1
+    assert [error is None for _, _, error in results] == [True, False, False]
+    assert all(isinstance(e, DeadlineExceeded) for _, _, e in results[1:])
+
+
+def test_dinghy_history_pagination_params(client):
+    r = client.get("/history?limit=10")
+    assert r.status_code == 200
+    assert "next_cursor" in r.get_json()
+    assert client.get("/history?cursor=abc").status_code == 400
+
+
+def test_dinghy_ping_stats_params(client):
+    for query in ("window=60", "url=https://example.com/&window=x"):
+        assert client.get(f"/api/ping-stats?{query}").status_code == 400
+    for window in (0, -60):
+        url = f"/api/ping-stats?url=https://example.com/&window={window}"
+        assert client.get(url).status_code == 400
+
+
+def test_summarize_samples_percentiles_and_error_rate():
+    samples = [(float(ms), False) for ms in range(1, 101)] + [(None, True)] * 4
+    stats = summarize_samples(samples)
+    assert stats["count"] == 104
+    assert stats["error_rate"] == round(4 / 104, 3)
+    assert (stats["min"], stats["max"], stats["avg"]) == (1.0, 100.0, 50.5)
+    assert (stats["p50"], stats["p95"], stats["p99"]) == (50.5, 95.05, 99.01)
+    assert summarize_samples([])["p99"] is None
+
+
+def test_sort_deployments_by_readiness():
+    deployments = [
+        {"name": "web", "namespace": "b", "ready_replicas": 3},
+        {"name": "api", "namespace": "a", "ready_replicas": None},
+        {"name": "db", "namespace": "a", "ready_replicas": 3},
+    ]
+    ordered = sort_deployments(deployments, sort="ready", order="desc")
+    assert [d["name"] for d in ordered] == ["db", "web", "api"]
+    for deployment, date in zip(deployments, ["2022-01-02", None, "2022-01-01"]):
+        deployment["date"] = date
+    for order in ("asc", "desc"):
+        ordered = sort_deployments(deployments, sort="date", order=order)
+        assert ordered[-1]["name"] == "api"
+    with pytest.raises(ValueError):
+        sort_deployments(deployments, sort="bogus")
+
+
+class ExpiringDeploymentsApi:
+    """AppsV1Api listing two chunks whose first continue token has expired"""
+
+    def __init__(self):
+        self.calls = []
+
+    def list_deployment_for_all_namespaces(self, limit, _preload_content, **kwargs):
+        self.calls.append(kwargs.get("_continue"))
+        if kwargs.get("_continue") == "expired":
+            raise ApiException(status=410, reason="Gone")
+        items = [{"metadata": {"namespace": "a", "name": "web"}}]
+        if len(self.calls) == 1:
+            return FakeResponse(items, "expired")
+        items.append({"metadata": {"namespace": "b", "name": "db"}})
+        return FakeResponse(items, None)
+
+
+class FakeResponse:
+    def __init__(self, items, _continue):
+        self.data = json.dumps({"items": items, "metadata": {"continue": _continue}})
+
+
+def test_deployment_list_restarts_when_its_continue_token_expires(monkeypatch):
+    api = ExpiringDeploymentsApi()
+    monkeypatch.setattr(k8s.client, "AppsV1Api", lambda: api)
+    names = [i["metadata"]["name"] for i in k8s._iter_raw_deployments(None)]
+    assert names == ["web", "db"]
+    assert api.calls == [None, "expired", None]
+
+
+def test_label_selector_from_deployment_selector():
+    selector = V1LabelSelector(
+        match_labels={"release": "web", "app": "dinghy"},
+        match_expressions=[
+            V1LabelSelectorRequirement(key="tier", operator="In", values=["a", "b"]),
+            V1LabelSelectorRequirement(key="canary", operator="DoesNotExist"),
+        ],
+    )
+    assert label_selector(selector) == "app=dinghy,release=web,tier in (a,b),!canary"
+
+
+class FakeLogResponse:
+    """urllib3 response of read_namespaced_pod_log(_preload_content=False)"""
+
+    def __init__(self, body):
+        self.body = body
+        self.closed = self.released = False
+
+    def stream(self, amt, decode_content=True):
+        for i in range(0, len(self.body), amt):
+            yield self.body[i : i + amt]  # noqa: E203
+
+    def close(self):
+        self.closed = True
+
+    def release_conn(self):
+        self.released = True
+
+
+class FakeCoreV1Api:
+    def __init__(self, body):
+        self.resp = FakeLogResponse(body)
+
+    def read_namespaced_pod_log(self, pod, namespace, **kwargs):
+        return self.resp
+
+
+@pytest.mark.parametrize(
+    "window, limit_bytes, closed",
+    [("head", 8, True), ("head", 100, False), ("tail", 8, False)],
+)
+def test_pod_log_window_closes_connections_it_did_not_drain(
+    monkeypatch, window, limit_bytes, closed
+):
+    api = FakeCoreV1Api(b"line one\nline two\n")
+    monkeypatch.setattr(k8s.client, "CoreV1Api", lambda: api)
+    logs = k8s.PodLogWindow(
+        "web", "default", None, 10, limit_bytes, window, chunk_size=4
+    )
+    text = "".join(logs)
+    assert len(text) == min(limit_bytes, 18)
+    assert (api.resp.closed, api.resp.released) == (closed, True)
+
+
+def test_plain_log_read_resumes_from_its_cursor_line(client, monkeypatch):
+    log = "".join(f"2022-05-01T10:00:0{i}Z line {i}\n" for i in range(4))
+    monkeypatch.setattr(
+        k8s.client, "CoreV1Api", lambda: FakeCoreV1Api(log.encode("utf-8"))
+    )
+    url = "/input-pod-logs?namespace=default&pod=web-1&plain"
+    first = client.get(f"{url}&cursor=").get_data(as_text=True).splitlines()
+    assert first[:-1] == [f"line {i}" for i in range(4)]
+    cursor = first[-1].removeprefix("X-Log-Cursor: ")
+    assert cursor != first[-1]
+
+    # resume after line 1, the head window budget of two lines counts only
+    # the lines after it
+    cursor = make_cursor("2022-05-01T10:00:01Z", "line 1\n")
+    resumed = client.get(
+        f"{url}&window=head&limit_bytes=56&cursor={quote(cursor)}"
+    ).get_data(as_text=True)
+    assert resumed.startswith("line 2\nline 3\nX-Log-Cursor: 2022-05-01T10:00:03Z")
+
+
+def test_merged_log_lines_without_a_timestamp_keep_their_place():
+    web = "ne cut\n2022-01-01T00:00:02Z web 2\n2022-01-01T00:00:04Z web 4\n2022-01-0"
+    api = "2022-01-01T00:00:01Z api 1\n2022-01-01T00:00:03Z api 3\n"
+    keyed = [k8s._keyed_lines("web", web), k8s._keyed_lines("api", api)]
+    merged = [line for _, line in heapq.merge(*keyed, key=itemgetter(0))]
+    assert merged == [
+        "api 2022-01-01T00:00:01Z api 1\n",
+        "web ne cut\n",
+        "web 2022-01-01T00:00:02Z web 2\n",
+        "api 2022-01-01T00:00:03Z api 3\n",
+        "web 2022-01-01T00:00:04Z web 4\n",
+        "web 2022-01-0\n",
+    ]
+
+
+def test_log_filter_include_exclude_level_and_sample():
+    accept = LogFilter(include=["api"], exclude=["healthz"], level="warn")
+    assert accept("ERROR api timeout")
+    assert not accept("INFO api started")
+    assert not accept("WARN api GET /healthz slow")
+    assert accept("api stack trace continuation")
+    assert not accept("ERROR worker crashed")
+
+    sampled = LogFilter(include=[r"req \d+"], regex=True, sample=3)
+    assert [sampled(f"req {i}") for i in range(6)] == [True, False, False] * 2
+
+
+def test_log_filter_refuses_runaway_patterns():
+    for pattern in ("(a+)+$", r"(\w+\s?)*x", "a" * 201):
+        with pytest.raises(ValueError):
+            LogFilter(include=[pattern], regex=True)
+    with pytest.raises(ValueError):
+        LogFilter(exclude=["a"] * 21)
+    assert LogFilter(include=["(a+)+"])("(a+)+ as a substring")
+
+
+def test_subscription_filters_in_the_viewer_thread():
+    def accept(line):
+        if line == "boom":
+            raise RuntimeError("filter bug")
+        # the upstream thread is not held up by the viewer's filter
+        assert threading.current_thread() is threading.main_thread()
+        return "api" in line
+
+    hub = StreamHub("test", None, 0, 10, "drop_oldest")
+    topic = Topic(hub, "pod", 0)
+    subscription = topic._subscribe(10, "drop_oldest", accept)
+    publisher = threading.Thread(
+        target=lambda: [topic.publish(line) for line in ("web", "boom", "api 1")]
+    )
+    publisher.start()
+    publisher.join()
+    assert subscription.get(1) == "api 1"
+    assert subscription.get(0.01) is None
+    assert hub.stats()["lines_filtered"] == 2
+
+
+def test_log_cursor_resumes_after_the_last_line_seen():
+    lines = [
+        "2022-05-01T10:00:00.5Z a\n",
+        "2022-05-01T10:00:01Z b\n",
+        "2022-05-01T10:00:01Z c\n",
+        "2022-05-01T10:00:02.25Z d\n",
+    ]
+    tracker = CursorTracker()
+    assert list(tracker.strip(lines[:2])) == ["a\n", "b\n"]
+    assert tracker.cursor == make_cursor("2022-05-01T10:00:01Z", "b\n")
+
+    accept = CursorFilter(tracker.cursor)
+    assert [line for line in lines if accept(line)] == lines[2:]
+    with pytest.raises(ValueError):
+        CursorFilter("not a cursor")
+
+
+def test_dns_record_types_default_to_ptr_for_addresses():
+    assert "PTR" not in dns_record_types("example.com")
+    assert "AAAA" in dns_record_types("example.com")
+    assert dns_record_types("10.96.0.10") == ("PTR",)
+    assert dns_record_types("example.com", ["TXT", "SRV"]) == ("TXT", "SRV")
+    with pytest.raises(ValueError):
+        dns_record_types("example.com", ["BOGUS"])
+
+
+def test_dns_compare_requires_nameservers(client):
+    r = client.get("/api/dns/compare?domain=example.com")
+    assert r.status_code == 400
+    nameservers = ",".join(f"10.0.0.{i}" for i in range(21))
+    r = client.get(f"/api/dns/compare?domain=example.com&nameserver={nameservers}")
+    assert r.status_code == 400
+
+
+@pytest.mark.parametrize(
+    "answers, consensus, divergent",
+    [
+        ({"a": "1.1.1.1", "b": "1.1.1.1", "c": "2.2.2.2"}, ["1.1.1.1"], [0, 0, 1]),
+        ({"a": "1.1.1.1", "b": "2.2.2.2"}, None, [1, 1]),
+        ({"a": "1.1.1.1", "b": "2.2.2.2", "c": "3.3.3.3"}, None, [1, 1, 1]),
+        # failed lookups have no say, however many there are
+        ({"a": None, "b": None, "c": "1.1.1.1"}, ["1.1.1.1"], [1, 1, 0]),
+        ({"a": None, "b": "1.1.1.1", "c": "2.2.2.2"}, None, [1, 1, 1]),
+        ({"a": None, "b": None}, None, [1, 1]),
+    ],
+)
+def test_dns_compare_marks_results_that_differ_from_the_majority(
+    client, monkeypatch, answers, consensus, divergent
+):
+    def dns_lookup(domain, record_type, nameserver, timeout):
+        answer = answers[nameserver]
+        return {
+            "record_type": record_type,
+            "response": None if answer is None else [answer],
+            "rcode": None if answer is None else "NOERROR",
+            "latency_ms": 1.0,
+            "tcp": False,
+            "error": "The DNS operation timed out" if answer is None else None,
+        }
+
+    monkeypatch.setattr(network, "dns_lookup", dns_lookup)
+    monkeypatch.setattr(network, "dns_answers", lambda response: (response or [], 30))
+    monkeypatch.setattr(network, "record_ping", lambda ping: None)
+    nameservers = ",".join(answers)
+    body = client.get(
+        f"/api/dns/compare?domain=example.com&nameserver={nameservers}"
+    ).get_json()
+    if consensus is not None:
+        consensus = {"rcode": "NOERROR", "answers": consensus}
+    assert body["consensus"] == consensus
+    assert [r["divergent"] for r in body["results"]] == [bool(d) for d in divergent]
+
+
+def test_dns_compare_form_shows_bad_nameservers_on_the_form(client, app):
+    app.config["WTF_CSRF_ENABLED"] = False
+    nameservers = " ".join(f"10.0.0.{i}" for i in range(21))
+    r = client.post(
+        "/", data={"compare-domain": "example.com", "compare-nameservers": nameservers}
+    )
+    assert r.status_code == 200
+    assert b"compare 1 to 20 nameservers" in r.data
+    assert b"Dinghy Ping - dns compare" in r.data
+
+
+def test_bulk_dns_lookups_default_record_types():
+    lookups = bulk_dns_lookups(["web.example.com", "10.96.0.10"])
+    assert lookups == [("web.example.com", "A"), ("10.96.0.10", "PTR")]
+    lookups = bulk_dns_lookups(["web.example.com"], ["A", "AAAA"])
+    assert lookups == [("web.example.com", "A"), ("web.example.com", "AAAA")]
+    with pytest.raises(ValueError):
+        bulk_dns_lookups(["web.example.com", None])
+
+
+def test_dns_bulk_streams_lookups_as_they_finish_within_the_deadline(
+    client, monkeypatch
+):
+    timeouts = []
+
+    def dns_lookup(name, record_type, nameserver, timeout):
+        timeouts.append(timeout)
+        time.sleep(1 if name == "slow.example.com" else 0)
+        return {
+            "record_type": record_type,
+            "response": None,
+            "rcode": "NOERROR",
+            "latency_ms": 1.0,
+            "tcp": False,
+            "error": None,
+        }
+
+    monkeypatch.setattr(network, "dns_lookup", dns_lookup)
+    names = ["slow.example.com", "fast.example.com"]
+    resp = client.post(
+        "/api/dns/bulk", json={"names": names, "timeout": 60, "deadline": 0.3}
+    )
+    assert resp.mimetype == "application/x-ndjson"
+    results = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert [r["name"] for r in results] == ["fast.example.com", "slow.example.com"]
+    assert results[0]["error"] is None
+    assert results[1]["error"].startswith("DeadlineExceeded")
+    # capped by the deadline, no lookup outlives the batch
+    assert timeouts == [0.3, 0.3]
+
+    for limits in ({"deadline": 0}, {"timeout": -1}, {"concurrency": 0}):
+        resp = client.post("/api/dns/bulk", json={"names": names, **limits})
+        assert resp.status_code == 400
+
+
+def test_scan_tcp_reports_reachable_and_refused_ports():
+    with socket.socket() as listener, socket.socket() as unused:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        unused.bind(("127.0.0.1", 0))
+        targets = [listener.getsockname(), unused.getsockname()]
+        results = dict(scan_tcp(targets, max_in_flight=2, timeout=2))
+    assert results[0]["reachable"] and results[0]["error_class"] is None
+    assert not results[1]["reachable"]
+    assert results[1]["error_class"] == "ConnectionRefusedError"
+    with pytest.raises(ValueError):
+        tcp_targets([{"host": "db", "port": 70000}])
+
+
+def test_scan_tcp_keeps_timing_while_the_reader_is_slow(monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+
+    def staggered_getaddrinfo(host, *args, **kwargs):
+        # db0 resolves straight away, db1 after 0.1s and so on
+        time.sleep(int(host[2:-12]) / 10)
+        return getaddrinfo("127.0.0.1", *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", staggered_getaddrinfo)
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        port = listener.getsockname()[1]
+        targets = [(f"db{i}.example.com", port) for i in range(4)]
+        results = []
+        for position, result in scan_tcp(targets, max_in_flight=4, timeout=1):
+            results.append((position, result))
+            # a client reading the stream slower than the results come in
+            time.sleep(0.4)
+    assert [position for position, _ in results] == [0, 1, 2, 3]
+    for position, result in results:
+        assert result["reachable"]
+        assert result["resolve_ms"] < position * 100 + 150
+        assert result["latency_ms"] < 150
+
+
+def test_scan_tcp_stops_when_the_reader_goes_away():
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen()
+        results = scan_tcp([listener.getsockname()] * 4, max_in_flight=1, timeout=1)
+        next(results)
+        results.close()
+    assert "dinghy-ping-tcp-scan" not in [t.name for t in threading.enumerate()]
+
+
+def test_scan_tcp_resolves_names_before_timing_the_handshake(monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+
+    def slow_getaddrinfo(host, *args, **kwargs):
+        time.sleep(0.2)
+        return getaddrinfo("127.0.0.1", *args, **kwargs)
+
+    monkeypatch.setattr(socket, "getaddrinfo", slow_getaddrinfo)
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(128)
+        port = listener.getsockname()[1]
+        # more lookups than the default executor has threads, all in flight
+        targets = [("db.example.com", port)] * 128
+        results = [r for _, r in scan_tcp(targets, max_in_flight=128, timeout=0.5)]
+    assert all(r["reachable"] for r in results)
+    assert all(r["resolve_ms"] >= 200 > r["latency_ms"] for r in results)
+
+
+def test_tcp_bulk_caps_the_timeout(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        routes, "scan_tcp", lambda *args, **kwargs: calls.append(kwargs) or []
+    )
+    targets = [{"host": "db", "port": 5432}]
+    resp = client.post("/api/tcp/bulk", json={"targets": targets, "timeout": 600})
+    assert resp.status_code == 200 and resp.get_data() == b""
+    assert calls == [{"max_in_flight": 200, "timeout": 5.0}]
+    for limits in ({"timeout": 0}, {"concurrency": 0}):
+        resp = client.post("/api/tcp/bulk", json={"targets": targets, **limits})
+        assert resp.status_code == 400
+
+
+def test_http_checks_are_saved_under_one_url_whether_they_fail_or_not(monkeypatch):
+    saved = []
+    monkeypatch.setattr(network, "record_ping", saved.append)
+    with local_http_server() as url:
+        domain = url.removeprefix("http://") + "/status"
+        network.process_request("http", domain, {"q": "a b"}, {}, "redis")
+    # cold, the pooled keep-alive connection outlives the server
+    failed = network.process_request(
+        "http", domain, {"q": "a b"}, {}, "redis", cold=True
+    )
+    assert failed[0] == ""
+    assert [ping.error for ping in saved] == [False, True]
+    assert saved[0].request_url == saved[1].request_url == f"{url}/status?q=a+b"
+
+
+def test_traced_get_reuses_connections_and_drops_cookies():
+    with local_http_server() as url:
+        first, second = {}, {}
+        assert traced_get(f"{url}/a", first, timeout=5).text == ""
+        assert traced_get(f"{url}/b", second, timeout=5).text == ""
+    assert first["connection_reused"] is False
+    assert second["connection_reused"] is True
+    assert not get_session().cookies
+
+
+def test_traced_get_fills_every_timing_phase():
+    trace = {"cold_connection": True}
+    with local_http_server(LargeBodyHandler, tls=True) as url:
+        r = traced_get(url, trace, timeout=5, verify="tests/localhost.pem")
+    assert len(r.content) == 65536
+    assert trace["connection_reused"] is False
+    for phase in TIMING_PHASES:
+        assert trace[phase] > 0, phase
+    assert trace["total_ms"] >= sum(trace[phase] for phase in TIMING_PHASES)
+
+
+class TimingOutRedis:
+    """A Redis client whose every command times out"""
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            raise redis.exceptions.TimeoutError("Timeout reading from socket")
+
+        return command
+
+
+def test_redis_timeouts_do_not_fail_reads_or_writes(monkeypatch):
+    monkeypatch.setattr(dinghy_data, "get_redis_client", lambda host: TimingOutRedis())
+    ping = DinghyData("redis", request_url="https://example.com/")
+    assert ping.get_ping() is None
+    assert ping.get_ping_stats(60)["count"] == 0
+    assert ping.get_pinged_urls(10) == ({}, None)
+    assert ping.get_all_pinged_urls() == {}
+
+    writer = PingWriter("redis", 10, 10, 0.1, "drop_newest", 0.1)
+    writer._flush([ping, ping])
+    assert writer.counters["failed"] == 2
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    fake = fakeredis.FakeRedis()
+    monkeypatch.setattr(dinghy_data, "get_redis_client", lambda host: fake)
+    monkeypatch.setitem(dinghy_data._history_settings, "codec", get_codec("hash"))
+    history_cache.clear()
+    yield fake
+    history_cache.clear()
+
+
+def test_history_pages_return_urls_tied_on_score_once(fake_redis):
+    pings = [DinghyData("redis", 200, 10, f"https://example.com/{i}") for i in range(5)]
+    for ping in pings:
+        ping.checked_at = 1656633600.0
+    DinghyData.save_pings("redis", pings)
+    # saved before the history index existed, migrated on the first read
+    legacy = {"response_code": 200, "response_time_ms": 10, "timings": None}
+    for url in ("https://legacy.example.com/1", "https://legacy.example.com/2"):
+        get_codec("hash").write(fake_redis, f"url:{url}", legacy)
+
+    reader = DinghyData("redis")
+    seen, cursor = [], None
+    while True:
+        page, cursor = reader.get_pinged_urls(2, cursor)
+        seen.extend(page)
+        if cursor is None:
+            break
+
+    assert sorted(seen) == sorted(reader.get_all_pinged_urls())
+    assert len(seen) == len(set(seen)) == 7
+    legacy = fake_redis.zmscore(
+        dinghy_data.INDEX_KEY,
+        ["https://legacy.example.com/1", "https://legacy.example.com/2"],
+    )
+    assert legacy[0] != legacy[1]
+
+
+def blocking_save_pings(monkeypatch):
+    """
+    Stub DinghyData.save_pings, flushes wait for release and record the
+    batches they were given, flushing is set once the first one started
+    """
+    flushing, release, batches = threading.Event(), threading.Event(), []
+
+    def save_pings(redis_host, pings):
+        flushing.set()
+        release.wait(5)
+        batches.append([ping.request_url for ping in pings])
+        return True
+
+    monkeypatch.setattr(DinghyData, "save_pings", staticmethod(save_pings))
+    return flushing, release, batches
+
+
+@pytest.mark.parametrize(
+    "policy, accepted, saved",
+    [
+        ("drop_newest", [True, True, False, False], ["0", "1", "2"]),
+        ("drop_oldest", [True, True, True, True], ["0", "3", "4"]),
+        ("block", [True, True, False, False], ["0", "1", "2"]),
+    ],
+)
+def test_ping_writer_overflow_policies(monkeypatch, policy, accepted, saved):
+    flushing, release, batches = blocking_save_pings(monkeypatch)
+    writer = PingWriter("redis", 2, 10, 0.05, policy, 0.05)
+    assert writer.put(DinghyData("redis", request_url="0"))
+    # the flush thread holds ping 0, the queue has room for two more
+    assert flushing.wait(5)
+    assert [
+        writer.put(DinghyData("redis", request_url=str(i))) for i in range(1, 5)
+    ] == accepted
+    release.set()
+    writer.close()
+    assert [url for batch in batches for url in batch] == saved
+    stats = writer.stats()
+    assert (stats["dropped"], stats["flushed"], stats["pending"]) == (2, 3, 0)
+
+
+def test_ping_writer_flushes_in_batches_and_on_close(fake_redis):
+    writer = PingWriter("redis", 100, 2, 0.05, "drop_newest", 0.1)
+    for i in range(5):
+        writer.put(DinghyData("redis", 200, 10, f"https://example.com/{i}"))
+    writer.close()
+    assert writer.stats()["flushed"] == 5
+    assert len(DinghyData("redis").get_all_pinged_urls()) == 5
+
+
+def test_ping_writer_batch_size(monkeypatch):
+    flushing, release, batches = blocking_save_pings(monkeypatch)
+    writer = PingWriter("redis", 100, 2, 0.05, "drop_newest", 0.1)
+    writer.put(DinghyData("redis", request_url="0"))
+    assert flushing.wait(5)
+    for i in range(1, 6):
+        writer.put(DinghyData("redis", request_url=str(i)))
+    release.set()
+    writer.close()
+    assert batches == [["0"], ["1", "2"], ["3", "4"], ["5"]]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_ping_codecs_round_trip(fake_redis, codec):
+    codec = get_codec(codec)
+    record = {
+        "response_code": 200,
+        "response_time_ms": 12.5,
+        "timings": {"dns_ms": 1.0, "connect_ms": 2.5},
+    }
+    failed = {"response_code": "Timeout", "response_time_ms": "N/A", "timings": None}
+    codec.write(fake_redis, "url:a", record)
+    codec.write(fake_redis, "url:b", failed)
+    assert codec.read(fake_redis, "url:a") == record
+    assert codec.read_many(fake_redis, ["url:b", "url:missing"]) == [failed, None]
+
+
+def test_migrate_pings_rewrites_records_and_keeps_their_expiry(fake_redis):
+    record = {"response_code": 200, "response_time_ms": 12.5, "timings": None}
+    get_codec("hash").write(fake_redis, "url:a", record)
+    get_codec("hash").write(fake_redis, "url:b", record)
+    fake_redis.expire("url:a", 3600)
+    assert dinghy_data.migrate_pings("redis", "json", batch_size=1) == 2
+    assert get_codec("json").read_many(fake_redis, ["url:a", "url:b"]) == [
+        record,
+        record,
+    ]
+    assert 0 < fake_redis.ttl("url:a") <= 3600
+    assert fake_redis.ttl("url:b") == -1
+
+
+def test_history_reads_that_fail_are_not_cached(monkeypatch, fake_redis):
+    monkeypatch.setattr(history_cache, "ttl", 60)
+    DinghyData("redis", 200, 10, "https://example.com/").save_ping()
+    monkeypatch.setattr(dinghy_data, "get_redis_client", lambda host: TimingOutRedis())
+    assert DinghyData("redis").get_pinged_urls(10) == ({}, None)
+    monkeypatch.setattr(dinghy_data, "get_redis_client", lambda host: fake_redis)
+    assert list(DinghyData("redis").get_pinged_urls(10)[0]) == ["https://example.com/"]
+
+
+def test_history_pages_are_cached_until_a_ping_is_recorded_and_flushed(
+    monkeypatch, fake_redis
+):
+    monkeypatch.setattr(history_cache, "ttl", 60)
+    loads = []
+    load = DinghyData._get_pinged_urls
+
+    def counted_load(self, limit, cursor):
+        loads.append(limit)
+        return load(self, limit, cursor)
+
+    monkeypatch.setattr(DinghyData, "_get_pinged_urls", counted_load)
+    DinghyData("redis", 200, 10, "https://example.com/a").save_ping()
+    reader = DinghyData("redis")
+    assert reader.get_pinged_urls(10) == reader.get_pinged_urls(10)
+    assert len(loads) == 1
+
+    # recorded but held back from Redis, like a ping in the write-behind queue
+    queued = []
+    monkeypatch.setitem(ping_writer._writer_settings, "enabled", False)
+    monkeypatch.setattr(DinghyData, "save_ping", lambda self: queued.append(self))
+    ping_writer.record_ping(DinghyData("redis", 200, 10, "https://example.com/b"))
+    assert list(reader.get_pinged_urls(10)[0]) == ["https://example.com/a"]
+    assert len(loads) == 2
+
+    PingWriter("redis", 10, 10, 0.1, "drop_newest", 0.1)._flush(queued)
+    assert len(reader.get_pinged_urls(10)[0]) == 2
+    assert len(loads) == 3
+
+
+def test_stream_hub_shares_one_upstream_and_stops_it_with_the_last_viewer():
+    started, stopped, publish = [], threading.Event(), queue.Queue()
+
+    def upstream(key, topic):
+        started.append(key)
+        topic.on_stop(lambda: publish.put(None))
+        while (message := publish.get()) is not None:
+            topic.publish(message)
+        stopped.set()
+
+    hub = StreamHub("test", upstream, 2, 10, "drop_oldest")
+    first = hub.subscribe("pod")
+    second = hub.subscribe("pod")
+    for message in ("a", "b", "c"):
+        publish.put(message)
+    assert [first.get(5) for _ in range(3)] == ["a", "b", "c"]
+    assert [second.get(5) for _ in range(3)] == ["a", "b", "c"]
+    # a late viewer is sent the replay of the last two
+    late = hub.subscribe("pod")
+    assert [late.get(5), late.get(5)] == ["b", "c"]
+    assert started == ["pod"]
+    assert hub.stats()["subscribers"] == 3
+
+    hub.unsubscribe(first)
+    hub.unsubscribe(late)
+    assert not stopped.wait(0.1)
+    hub.unsubscribe(second)
+    assert stopped.wait(5)
+    assert hub.stats()["upstreams"] == 0
+
+    hub.subscribe("pod")
+    assert started == ["pod", "pod"]
+    assert hub.stats()["upstreams_started"] == 2
+    hub.close()
+
+
+def test_stream_hub_sends_end_when_the_upstream_finishes():
+    hub = StreamHub(
+        "test", lambda key, topic: topic.publish("done"), 10, 10, "drop_oldest"
+    )
+    subscription = hub.subscribe("pod")
+    assert [subscription.get(5), subscription.get(5)] == ["done", END]
+
+
+def k8s_event(uid, resource_version):
+    metadata = SimpleNamespace(name=uid, uid=uid, resource_version=resource_version)
+    obj = SimpleNamespace(metadata=metadata, type="Normal", reason="Pulled", message="")
+    return {"type": "ADDED", "object": obj}
+
+
+class ScriptedWatch:
+    """watch.Watch whose streams play back scripts, one per watch"""
+
+    def __init__(self, scripts, calls, topic):
+        self.scripts, self.calls, self.topic = scripts, calls, topic
+
+    def __call__(self):
+        return self
+
+    def stream(self, func, namespace, **kwargs):
+        self.calls.append(kwargs.get("resource_version"))
+        script = self.scripts.pop(0)
+        if not self.scripts:
+            self.topic.stop()
+        if isinstance(script, Exception):
+            raise script
+        yield from script
+
+
+def test_event_watch_resumes_and_skips_events_replayed_after_a_410(monkeypatch):
+    topic = Topic(None, ("default", None), 10)
+    calls = []
+    bookmark = {
+        "type": "BOOKMARK",
+        "raw_object": {"metadata": {"resourceVersion": "3"}},
+    }
+    scripts = [
+        [k8s_event("a", "1"), k8s_event("b", "2"), bookmark],
+        ApiException(status=410, reason="Gone"),
+        [k8s_event("a", "1"), k8s_event("b", "4"), k8s_event("c", "5")],
+    ]
+    monkeypatch.setattr(k8s.watch, "Watch", ScriptedWatch(scripts, calls, topic))
+    monkeypatch.setattr(
+        k8s.client,
+        "CoreV1Api",
+        lambda: SimpleNamespace(list_namespaced_event=lambda *args, **kwargs: None),
+    )
+    k8s.watch_namespace_events(topic.key, topic)
+    assert calls == [None, "3", None]
+    assert [json.loads(event)["Name"] for event in topic.replay] == ["a", "b", "b", "c"]
+
+
+def test_frames_coalesce_messages_up_to_max_bytes_of_utf8():
+    topic = Topic(StreamHub("test", None, 0, 100, "drop_oldest"), "pod", 0)
+    subscription = topic._subscribe(100, "drop_oldest", None)
+    for message in ("é" * 4, "é" * 4, "ab", "cd"):
+        topic.publish(message)
+    # 8 bytes each, the second fills a 16 byte frame
+    assert subscription.get_frame(16, 5, timeout=1) == ["é" * 4, "é" * 4]
+    assert subscription.get_frame(16, 0.05, timeout=1) == ["ab", "cd"]
+    assert subscription.get_frame(16, 0.05, timeout=0.01) == []
+    topic._end()
+    assert subscription.get_frame(16, 5, timeout=1) == [END]
+
+
+@pytest.mark.parametrize(
+    "policy, overflowed, queued, dropped",
+    [("drop_oldest", False, ["c", "d", "e"], 2), ("disconnect", True, ["b", "c"], 1)],
+)
+def test_subscription_overflow_policies(policy, overflowed, queued, dropped):
+    hub = StreamHub("test", None, 0, 3, policy)
+    topic = Topic(hub, "pod", 0)
+    subscription = topic._subscribe(3, policy, None)
+    for message in "abcde":
+        topic.publish(message)
+    assert subscription.overflowed is overflowed
+    assert subscription.get_frame(100, 0.05, timeout=1) == queued
+    assert hub.stats()["lines_dropped"] == dropped
+
+
+def k8s_object(namespace, name, resource_version="1"):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            namespace=namespace, name=name, resource_version=resource_version
+        )
+    )
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+class FakeListApi:
+    """API class of an informer, lists return lists.pop(0) or raise it"""
+
+    lists = []
+
+    def list_pod_for_all_namespaces(self, watch):
+        result = self.lists.pop(0) if len(self.lists) > 1 else self.lists[0]
+        if isinstance(result, Exception):
+            raise result
+        items, resource_version = result
+        return SimpleNamespace(
+            items=items, metadata=SimpleNamespace(resource_version=resource_version)
+        )
+
+
+class FakeInformerWatch:
+    """watch.Watch playing back streams, then idling until the test ends"""
+
+    streams = []
+    idle = threading.Event()
+
+    def stop(self):
+        pass
+
+    def stream(self, list_func, resource_version, **kwargs):
+        if not self.streams:
+            self.idle.wait()
+            return
+        events = self.streams.pop(0)
+        if isinstance(events, Exception):
+            raise events
+        yield from events
+
+
+@pytest.fixture
+def fake_informer(monkeypatch):
+    monkeypatch.setattr(FakeListApi, "lists", [])
+    monkeypatch.setattr(FakeInformerWatch, "streams", [])
+    monkeypatch.setattr(FakeInformerWatch, "idle", threading.Event())
+    monkeypatch.setattr(informer.watch, "Watch", FakeInformerWatch)
+    created = []
+
+    def make(**settings):
+        settings = dict(
+            dict(resync_seconds=60, max_staleness=600, sync_timeout=2), **settings
+        )
+        created.append(
+            informer.Informer(
+                "pods", FakeListApi, "list_pod_for_all_namespaces", **settings
+            )
+        )
+        return created[-1]
+
+    yield make
+    for i in created:
+        i.stop()
+    FakeInformerWatch.idle.set()
+
+
+def names(objs):
+    return [f"{o.metadata.namespace}/{o.metadata.name}" for o in objs]
+
+
+def test_informer_relists_when_its_watch_expires(fake_informer):
+    FakeListApi.lists.extend(
+        [
+            (
+                [k8s_object("b", "web"), k8s_object("a", "db"), k8s_object("a", "api")],
+                "1",
+            ),
+            ([k8s_object("a", "db"), k8s_object("c", "new")], "9"),
+        ]
+    )
+    FakeInformerWatch.streams.append(ApiException(status=410, reason="Gone"))
+    pods = fake_informer()
+    assert pods.list() is not None
+    # the watch after the first list expired straight away
+    wait_until(lambda: pods.relists == 2)
+    assert names(pods.list()) == ["a/db", "c/new"]
+    assert names(pods.list("c")) == ["c/new"]
+    assert pods.resource_version == "9"
+    assert pods.stats()["objects"] == 2
+
+
+def test_informer_applies_each_event_type(fake_informer):
+    FakeListApi.lists.append(([k8s_object("a", "db"), k8s_object("b", "web")], "1"))
+    FakeInformerWatch.streams.append(
+        [
+            {"type": "ADDED", "object": k8s_object("a", "cache", "2")},
+            {"type": "MODIFIED", "object": k8s_object("a", "db", "3")},
+            {"type": "DELETED", "object": k8s_object("b", "web", "4")},
+            {"type": "BOOKMARK", "raw_object": {"metadata": {"resourceVersion": "5"}}},
+        ]
+    )
+    pods = fake_informer()
+    assert pods.list() is not None
+    wait_until(lambda: pods.resource_version == "5")
+    assert names(pods.list()) == ["a/cache", "a/db"]
+    assert pods.list("a")[1].metadata.resource_version == "3"
+    assert pods.list("b") == []
+
+
+def test_informer_falls_back_when_it_can_not_sync(fake_informer):
+    FakeListApi.lists.append(ApiException(status=403, reason="Forbidden"))
+    pods = fake_informer(sync_timeout=0.3)
+    assert pods.list() is None
+    wait_until(lambda: pods.last_error == "403 Forbidden")
+    # later calls do not wait for a list that keeps failing
+    started = time.monotonic()
+    assert pods.list() is None
+    assert time.monotonic() - started < 0.1
+
+
+def test_informer_falls_back_when_it_is_stale(fake_informer):
+    FakeListApi.lists.append(([k8s_object("a", "db")], "1"))
+    pods = fake_informer(max_staleness=60)
+    assert names(pods.list()) == ["a/db"]
+    pods._last_contact = time.monotonic() - 120
+    assert pods.list() is None
+
+
+def test_informer_starts_a_watch_thread_per_process(fake_informer):
+    FakeListApi.lists.append(([k8s_object("a", "db")], "1"))
+    pods = fake_informer()
+    assert pods.list() is not None
+    thread = pods._thread
+    pods.list()
+    assert pods._thread is thread
+    # forked by gunicorn --preload, the thread stayed in the parent
+    pods._pid = -1
+    assert names(pods.list()) == ["a/db"]
+    assert pods._thread is not thread
+
+
+def owned(kind_uid, name, uid=None, **status):
+    return SimpleNamespace(
+        metadata=SimpleNamespace(
+            name=name,
+            uid=uid,
+            labels={"app": "web"},
+            owner_references=[SimpleNamespace(uid=kind_uid)],
+        ),
+        status=SimpleNamespace(**status),
+    )
+
+
+def test_match_deployment_pods_keeps_only_current_replica_sets():
+    replica_sets = [
+        owned(
+            "deploy",
+            "web-new",
+            "rs-new",
+            replicas=2,
+            ready_replicas=2,
+            available_replicas=2,
+        ),
+        # scaled down by the last rollout, its pods are still terminating
+        owned(
+            "deploy",
+            "web-old",
+            "rs-old",
+            replicas=0,
+            ready_replicas=None,
+            available_replicas=None,
+        ),
+        # another deployment selecting the same labels
+        owned(
+            "other",
+            "web-canary",
+            "rs-canary",
+            replicas=1,
+            ready_replicas=1,
+            available_replicas=1,
+        ),
+    ]
+    pods = [
+        owned("rs-new", "web-new-a"),
+        owned("rs-new", "web-new-b"),
+        owned("rs-old", "web-old-a"),
+        owned("rs-canary", "web-canary-a"),
+        owned("job", "web-migrate"),
+    ]
+    matched = k8s.match_deployment_pods("deploy", replica_sets, pods)
+    assert sorted(matched) == ["web-new-a", "web-new-b"]
+    assert matched["web-new-a"] is pods[0]
+
+
+class FollowedLog:
+    """CoreV1Api following a growing log, every read starts at its first line"""
+
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.grew = threading.Condition()
+
+    def append(self, line):
+        with self.grew:
+            self.lines.append(line)
+            self.grew.notify_all()
+
+    def read_namespaced_pod_log(self, pod, namespace, **kwargs):
+        log = self
+
+        class Response:
+            read = 0
+            closed = False
+
+            def readline(self):
+                with log.grew:
+                    log.grew.wait_for(lambda: self.closed or self.read < len(log.lines))
+                    if self.closed:
+                        return b""
+                    self.read += 1
+                    return log.lines[self.read - 1].encode("utf-8")
+
+            def close(self):
+                with log.grew:
+                    self.closed = True
+                    log.grew.notify_all()
+
+            def release_conn(self):
+                pass
+
+        return Response()
+
+
+def test_resumed_log_viewers_each_get_every_line_after_their_cursor(monkeypatch):
+    lines = [f"2022-05-01T10:00:0{i}Z line {i}\n" for i in range(8)]
+    log = FollowedLog(lines[:3])
+    monkeypatch.setattr(k8s.client, "CoreV1Api", lambda: log)
+    hub = StreamHub("test", k8s.follow_pod_log, 2, 100, "drop_oldest")
+    cursor = make_cursor("2022-05-01T10:00:00Z", "line 0\n")
+
+    def resume():
+        key = ws.log_stream_key("default", "web", "app", 2, cursor)
+        return hub.subscribe(key, CursorFilter(cursor))
+
+    first = resume()
+    for line in lines[3:]:
+        log.append(line)
+    assert [first.get(5) for _ in lines[1:]] == lines[1:]
+    # more than tail_lines lines went by before the second viewer resumed
+    second = resume()
+    assert [second.get(5) for _ in lines[1:]] == lines[1:]
+    assert hub.stats()["upstreams_started"] == 2
+    hub.close()
+
+
+@pytest.fixture
+def fake_nameserver(monkeypatch):
+    """dns.query.udp answering truncated after udp_delay, and dns.query.tcp"""
+    calls = SimpleNamespace(udp_delay=0, tcp=[])
+
+    def udp(q, where, timeout):
+        time.sleep(calls.udp_delay)
+        response = dns.message.make_response(q)
+        response.flags |= dns.flags.TC
+        return response
+
+    def tcp(q, where, timeout):
+        calls.tcp.append(timeout)
+        return dns.message.make_response(q)
+
+    monkeypatch.setattr(dinghy_dns.dns.query, "udp", udp)
+    monkeypatch.setattr(dinghy_dns.dns.query, "tcp", tcp)
+    return calls
+
+
+def test_dns_query_retries_truncated_answers_over_tcp(fake_nameserver):
+    fake_nameserver.udp_delay = 0.2
+    query = dinghy_dns.DinghyDNS("example.com", nameserver="10.0.0.10", timeout=1)
+    response = query.dns_query()
+    assert not response.flags & dns.flags.TC
+    assert query.used_tcp
+    # the TCP retry gets what the UDP query left of the timeout
+    assert len(fake_nameserver.tcp) == 1
+    assert 0.7 < fake_nameserver.tcp[0] < 0.85
+
+
+def test_dns_query_times_out_when_udp_used_up_the_timeout(fake_nameserver):
+    fake_nameserver.udp_delay = 0.3
+    result = network.dns_lookup("example.com", "A", "10.0.0.10", timeout=0.2)
+    assert result["response"] is None
+    assert result["error"] == "The DNS operation timed out after 0.200 seconds"
+    assert fake_nameserver.tcp == []